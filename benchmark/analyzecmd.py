@@ -0,0 +1,321 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import datetime
+import json
+import os
+import sys
+
+import numpy as np
+
+from .histogram import LogHistogram
+from .rawlog import RAW_LOG_SCHEMA_FILE, read_raw_log
+from .statsaggregator import STALL_THRESHOLD, _format_human, _request_metrics, _summary
+
+# Snapshot key of the groups of each categorical column.
+GROUP_KEYS = {
+   "workload_class": "classes",
+   "endpoint": "endpoints",
+}
+# Number of raw log rows read at once when selecting the requests of a time range.
+SCAN_CHUNK_ROWS = 1 << 20
+# Counts of the requests completed before a time range, see _scan.
+BASE_COUNTS = ["requests", "failures", "throttled", "retries"]
+
+def analyze(args):
+   """
+   Recomputes periodic stats of a run from its raw log, over any aggregation
+   window, step and time range. Columns are memory mapped and every window is
+   computed with vectorized numpy operations, using the same metric
+   definitions as the live output.
+   """
+   try:
+      _validate(args)
+   except ValueError as e:
+      print(f"invalid argument(s): {e}")
+      sys.exit(1)
+
+   log = read_raw_log(args.raw_log)
+   if len(log["request_start_time"]) == 0:
+      print(f"raw log {args.raw_log} holds no requests")
+      return
+   # reductions stream through the memory mapped columns without copying them
+   first = float(np.min(log["request_start_time"]))
+   last = max(float(np.max(log["request_start_time"])),
+              float(np.fmax.reduce(log["response_time"], initial=-np.inf)),
+              float(np.fmax.reduce(log["response_end_time"], initial=-np.inf)))
+   t = first + (args.start or 0) + args.step
+   end = last if args.end is None else min(last, first + args.end)
+   requests = _Requests.from_log(log, args.stall_threshold, since=min(t, end) - args.aggregation_window, until=end)
+   groups = requests._groups(log)
+
+   while True:
+      snapshot = _snapshot(requests, groups, first, min(t, end), args.aggregation_window)
+      if args.output_format == "jsonl":
+         print(json.dumps(snapshot), flush=True)
+      else:
+         print(_format_human(snapshot), flush=True)
+      if t >= end:
+         break
+      t += args.step
+
+def _validate(args):
+   if not os.path.isfile(os.path.join(args.raw_log, RAW_LOG_SCHEMA_FILE)):
+      raise ValueError(f"{args.raw_log} is not a raw log directory")
+   if args.aggregation_window <= 0:
+      raise ValueError("aggregation-window must be > 0")
+   if args.step <= 0:
+      raise ValueError("step must be > 0")
+   if args.start is not None and args.start < 0:
+      raise ValueError("start must be >= 0")
+   if args.end is not None and args.end <= (args.start or 0):
+      raise ValueError("end must be > start")
+
+def _done_time(start:np.ndarray, response_time:np.ndarray, end_time:np.ndarray) -> np.ndarray:
+   # failed requests have no end time, they completed with their response
+   return np.where(np.isnan(end_time), np.where(np.isnan(response_time), start, response_time), end_time)
+
+def _scan(log:dict, since:float, until:float) -> (np.ndarray, np.ndarray, dict):
+   """
+   Selects the requests windows ending after since can see: started by
+   until and completed after since. Requests completed by since are only
+   summed into BASE_COUNTS, for all requests under None and by category code
+   of each categorical column under its name. The log is read in chunks of
+   SCAN_CHUNK_ROWS, so that only selected requests are held in memory.
+   Returns the selected row indexes, in log order, their token gap offsets
+   and the base counts.
+   """
+   sizes = {None: 1}
+   for name in GROUP_KEYS:
+      if len(log["categories"].get(name, [])) > 0:
+         sizes[name] = len(log["categories"][name])
+   bases = {key: {count: np.zeros(size, dtype=np.int64) for count in BASE_COUNTS} for key, size in sizes.items()}
+   selected = []
+   gap_offsets = []
+   gap_offset = 0
+   for first_row in range(0, len(log["request_start_time"]), SCAN_CHUNK_ROWS):
+      rows = slice(first_row, first_row + SCAN_CHUNK_ROWS)
+      start = log["request_start_time"][rows]
+      gap_counts = log["token_gap_count"][rows].astype(np.int64)
+      chunk_offsets = gap_offset + np.cumsum(gap_counts) - gap_counts
+      gap_offset += int(np.sum(gap_counts))
+      started = start <= until
+      done = _done_time(start, log["response_time"][rows], log["response_end_time"][rows])
+      indexes = np.flatnonzero(started & (done > since))
+      selected.append(first_row + indexes)
+      gap_offsets.append(chunk_offsets[indexes])
+      base = np.flatnonzero(started & (done <= since))
+      if len(base) == 0:
+         continue
+      status = log["status"][rows][base]
+      weights = {
+         "requests": None,
+         "failures": status != 200,
+         "throttled": status == 429,
+         "retries": np.maximum(log["calls"][rows][base].astype(np.int64) - 1, 0),
+      }
+      for key, counts in bases.items():
+         codes = np.zeros(len(base), dtype=np.int64) if key is None else log[key][rows][base].astype(np.int64)
+         known = codes >= 0
+         for count, weight in weights.items():
+            counts[count] += np.bincount(codes[known], weights=None if weight is None else weight[known], minlength=sizes[key]).astype(np.int64)
+   return np.concatenate(selected), np.concatenate(gap_offsets), bases
+
+class _Requests:
+   """
+   Columns of a group of requests, ordered by start time for windows, with
+   completion times ordered separately for cumulative counts.
+   """
+   def __init__(self, columns:dict, token_gaps:np.ndarray, order:np.ndarray, stall_threshold:float=STALL_THRESHOLD, base:dict=None, group_bases:dict=None):
+      """
+      :param columns: columns of the requests, ordered by start time, see from_log.
+      :param token_gaps: gaps between tokens of all requests of the log.
+      :param order: indexes of the requests in the log, ordered by start time.
+      :param base: BASE_COUNTS of the requests left out of columns because they
+      completed before the first window, added to cumulative counts.
+      :param group_bases: base counts by categorical column name, as arrays indexed by category code.
+      """
+      self.columns = columns
+      self.token_gaps = token_gaps
+      self.order = order
+      self.stall_threshold = stall_threshold
+      self.base = base or {count: 0 for count in BASE_COUNTS}
+      self.group_bases = group_bases or {}
+      self._index()
+
+   @classmethod
+   def from_log(cls, log:dict, stall_threshold:float=STALL_THRESHOLD, since:float=-np.inf, until:float=np.inf) -> "_Requests":
+      """
+      Returns the requests of a raw log that windows between since and until
+      can see, see read_raw_log and _scan. Only the columns of these requests
+      are read into memory.
+      """
+      selected, gap_offsets, bases = _scan(log, since, until)
+      start = log["request_start_time"][selected]
+      # rows are appended as requests complete, so nearly in start order
+      by_start = np.argsort(start, kind="stable")
+      order = selected[by_start]
+      start = start[by_start]
+      status = log["status"][order]
+      response_time = log["response_time"][order]
+      end_time = log["response_end_time"][order]
+      first_token_time = log["first_token_time"][order]
+      intended = log["intended_start_time"][order]
+      first_attempt = log["first_attempt_time"][order]
+      # stats without a first attempt time were timed from their only attempt
+      first_attempt = np.where(np.isnan(first_attempt), start, first_attempt)
+      with np.errstate(divide="ignore", invalid="ignore"):
+         columns = {
+            "start": start,
+            "done": _done_time(start, response_time, end_time),
+            "success": status == 200,
+            "failed": status != 200,
+            "throttled": status == 429,
+            "retries": np.maximum(log["calls"][order].astype(np.int64) - 1, 0),
+            "context_tokens": np.where(status == 200, log["context_tokens"][order], 0),
+            "generated_tokens": np.where(status == 200, log["generated_tokens"][order], 0),
+            "e2e": end_time - start,
+            "ttft": first_token_time - start,
+            "gap_offset": gap_offsets[by_start],
+            "gap_count": log["token_gap_count"][order],
+            "util": log["utilization"][order],
+            "ttft_intended": first_token_time - intended,
+            "e2e_intended": end_time - intended,
+            "ttft_user": first_token_time - first_attempt,
+            "e2e_user": end_time - first_attempt,
+            "dns": log["dns_time"][order],
+            "connect": log["connect_time"][order],
+            "headers": log["headers_time"][order],
+            "new_connection": log["new_connection"][order],
+         }
+      base = {count: int(values[0]) for count, values in bases.pop(None).items()}
+      return cls(columns, log["token_gaps"], order, stall_threshold, base, bases)
+
+   def _subset(self, mask:np.ndarray, base:dict=None) -> "_Requests":
+      return _Requests({name: column[mask] for name, column in self.columns.items()}, self.token_gaps, self.order[mask], self.stall_threshold, base)
+
+   def _groups(self, log:dict) -> {str: {str: "_Requests"}}:
+      """
+      Returns the requests of each workload class and routing target, by
+      snapshot key and name.
+      """
+      groups = {}
+      for name, bases in self.group_bases.items():
+         column = log[name][self.order]
+         groups[GROUP_KEYS[name]] = {
+            category: self._subset(column == code, {count: int(values[code]) for count, values in bases.items()})
+            for code, category in enumerate(log["categories"][name])}
+      return groups
+
+   def _index(self):
+      self.start = self.columns["start"]
+      done_order = np.argsort(self.columns["done"], kind="stable")
+      self.done = self.columns["done"][done_order]
+      # cumulative counts by completion time, as counted by the live aggregator
+      self.failed = np.cumsum(self.columns["failed"][done_order])
+      self.throttled = np.cumsum(self.columns["throttled"][done_order])
+      self.retries = np.cumsum(self.columns["retries"][done_order])
+
+   def _window(self, t:float, window:float) -> np.ndarray:
+      """
+      Returns the indexes of the requests in the window ending at t: started
+      within the window and completed by t, as the live aggregator only sees
+      completed requests.
+      """
+      lo = np.searchsorted(self.start, t - window, side="right")
+      hi = np.searchsorted(self.start, t, side="right")
+      return lo + np.flatnonzero(self.columns["done"][lo:hi] <= t)
+
+   def _histogram(self, name:str, indexes:np.ndarray, success_only:bool=True) -> LogHistogram:
+      values = self.columns[name][indexes]
+      if success_only:
+         values = values[self.columns["success"][indexes]]
+      histogram = LogHistogram()
+      histogram.record_many(values[np.isfinite(values)])
+      return histogram
+
+   def _gaps(self, indexes:np.ndarray) -> np.ndarray:
+      """
+      Returns the gaps between tokens of the successful requests of indexes.
+      """
+      success = self.columns["success"][indexes]
+      offsets = self.columns["gap_offset"][indexes][success]
+      counts = self.columns["gap_count"][indexes][success]
+      total = int(np.sum(counts))
+      if total == 0:
+         return np.empty(0)
+      # index of every gap: its request offset plus its rank within the request
+      starts = np.cumsum(counts) - counts
+      indexes = np.repeat(offsets - starts, counts) + np.arange(total)
+      return self.token_gaps[indexes]
+
+   def _metrics(self, t:float, window:float, dynamic_window:float) -> dict:
+      indexes = self._window(t, window)
+      gaps = self._gaps(indexes)
+      tbt = LogHistogram()
+      tbt.record_many(gaps)
+      new_connection = self.columns["new_connection"][indexes]
+      completed = int(np.searchsorted(self.done, t, side="right"))
+      return _request_metrics(dynamic_window,
+         completed=self.base["requests"] + completed,
+         failures=self.base["failures"] + (int(self.failed[completed - 1]) if completed > 0 else 0),
+         throttled=self.base["throttled"] + (int(self.throttled[completed - 1]) if completed > 0 else 0),
+         retries=self.base["retries"] + (int(self.retries[completed - 1]) if completed > 0 else 0),
+         successes=int(np.count_nonzero(self.columns["success"][indexes])),
+         context_tokens=float(np.sum(self.columns["context_tokens"][indexes], dtype=np.float64)),
+         generated_tokens=float(np.sum(self.columns["generated_tokens"][indexes], dtype=np.float64)),
+         stalls=np.count_nonzero(gaps > self.stall_threshold),
+         e2e=self._histogram("e2e", indexes),
+         ttft=self._histogram("ttft", indexes),
+         tbt=tbt,
+         util=self._histogram("util", indexes, success_only=False),
+         ttft_intended=self._histogram("ttft_intended", indexes),
+         e2e_intended=self._histogram("e2e_intended", indexes),
+         ttft_user=self._histogram("ttft_user", indexes),
+         e2e_user=self._histogram("e2e_user", indexes),
+         new_connections=np.count_nonzero(new_connection == 1),
+         reused_connections=np.count_nonzero(new_connection == 0),
+         dns=self._histogram("dns", indexes, success_only=False),
+         connect=self._histogram("connect", indexes, success_only=False),
+         headers=self._histogram("headers", indexes, success_only=False))
+
+def _snapshot(requests:_Requests, groups:{str: {str: _Requests}}, first:float, t:float, window:float) -> dict:
+   """
+   Computes the snapshot the live aggregator would have printed at time t.
+   :param groups: requests of each workload class and routing target, by snapshot key and name.
+   """
+   run_seconds = round(t - first)
+   dynamic_window = max(1, min(run_seconds, window))
+   totals = requests._metrics(t, window, dynamic_window)
+   started = requests.base["requests"] + int(np.searchsorted(requests.start, t, side="right"))
+   snapshot = {
+      "run_seconds": run_seconds,
+      "timestamp": datetime.datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S"),
+      "rpm": totals["rpm"],
+      "processing": started - totals["completed"],
+      "completed": totals["completed"],
+      "failures": totals["failures"],
+      "throttled": totals["throttled"],
+      "retries": totals["retries"],
+      "requests": totals["requests"],
+      # not recorded in raw logs
+      "stats_cpu": "n/a",
+      "tpm": totals["tpm"],
+      "stalls": totals["stalls"],
+      "e2e": totals["e2e"],
+      "ttft": totals["ttft"],
+      "tbt": totals["tbt"],
+      "util": totals["util"],
+      "lag": _summary(LogHistogram(), 4),
+      "ttft_intended": totals["ttft_intended"],
+      "e2e_intended": totals["e2e_intended"],
+      "ttft_user": totals["ttft_user"],
+      "e2e_user": totals["e2e_user"],
+      "connections": totals["connections"],
+      "dns": totals["dns"],
+      "connect": totals["connect"],
+      "headers": totals["headers"],
+   }
+   for key, group in groups.items():
+      snapshot[key] = {name: subset._metrics(t, window, dynamic_window) for name, subset in sorted(group.items())}
+   return snapshot
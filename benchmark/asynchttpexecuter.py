@@ -1,32 +1,75 @@
 
 import aiohttp
 import asyncio
+import contextvars
 import time
 import signal
 import logging
 import os
 from datetime import timedelta
 from typing import Callable
+from yarl import URL
+from .looplag import LoopLagProbe
 from .ratelimiting import NoRateLimiter
 
 # Threshold in seconds to warn about requests lagging behind target rate.
 LAG_WARN_DURATION = 1.0
+# Execution engines: one task per request, or long-lived worker coroutines.
+ENGINES = ["tasks", "workers"]
+
+# Time at which the current request was scheduled to start, for rate limiters
+# that schedule calls ahead of time (see ArrivalScheduler), None otherwise.
+intended_start_time = contextvars.ContextVar("intended_start_time", default=None)
 
 class AsyncHTTPExecuter:
     """
     An implementation of an async HTTP executer class with rate limiting and
-    concurrency control.
+    concurrency control. Two engines are available:
+    - tasks: a single loop takes permits from the rate limiter and creates a
+      task for each request, waiting for one to complete when max_concurrency
+      are running.
+    - workers: max_concurrency long-lived worker coroutines each take a permit
+      and run the request themselves, one after the other. Permits are taken
+      under a shared lock, so the rate limiter sees one caller at a time, and
+      there is no per-request task creation or wait, whose cost grows with the
+      number of running requests.
     """
-    def __init__(self, async_http_func: Callable[[aiohttp.ClientSession], None], rate_limiter=NoRateLimiter(), max_concurrency=12):
+    def __init__(self, async_http_func: Callable[[aiohttp.ClientSession], None], rate_limiter=NoRateLimiter(), max_concurrency=12, trace_configs=None, loop_lag_callback: Callable[[float, float], None]=None, loop="asyncio",
+                 keepalive_timeout=15.0, dns_cache_ttl=10, limit_per_host=0, prewarm_connections=0, prewarm_urls=None,
+                 concurrency_controller=None, engine="tasks", stop=None):
         """
         Creates a new executer.
         :param async_http_func: A callable function that takes aiohttp.ClientSession to use to perform request.
-        :param rate_limiter: Rate limiter object to use, defaults to NoRateLimiter.
+        :param rate_limiter: Rate limiter object to use, defaults to NoRateLimiter. It may end the run by raising StopAsyncIteration on enter.
         :param max_concurrency: Maximum number of concurrent requests, defaults to 12.
+        :param trace_configs: Optional list of aiohttp.TraceConfig to instrument the session with.
+        :param loop_lag_callback: Optional callable taking timestamp and event loop lag in seconds, called periodically during the run.
+        :param loop: Event loop implementation, either asyncio or uvloop, defaults to asyncio.
+        :param keepalive_timeout: Seconds an idle connection is kept open for reuse, defaults to 15.
+        :param dns_cache_ttl: Seconds resolved host addresses are cached, None to cache forever, defaults to 10.
+        :param limit_per_host: Maximum number of connections to each host, 0 for unlimited, defaults to 0.
+        :param prewarm_connections: Number of connections opened to the origin of each of prewarm_urls before the run starts, defaults to 0.
+        :param prewarm_urls: Urls requests of the run are sent to.
+        :param concurrency_controller: Optional controller whose limit attribute replaces max_concurrency, read before every request, see AdaptiveConcurrency.
+        :param engine: Execution engine, one of ENGINES, defaults to tasks.
+        :param stop: Optional threading.Event or multiprocessing.Event that drains the run once set, as a terminate signal does.
         """
+        if engine not in ENGINES:
+            raise ValueError(f"unknown engine {engine}, use one of {', '.join(ENGINES)}")
         self.async_http_func = async_http_func
         self.rate_limiter = rate_limiter
         self.max_concurrency = max_concurrency
+        self.trace_configs = trace_configs
+        self.loop_lag_callback = loop_lag_callback
+        self.loop = loop
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.limit_per_host = limit_per_host
+        self.prewarm_connections = prewarm_connections
+        self.prewarm_urls = prewarm_urls or []
+        self.concurrency_controller = concurrency_controller
+        self.engine = engine
+        self.stop = stop
         self.max_lag_warn = timedelta(seconds=5).seconds
         self.terminate = False
 
@@ -36,36 +79,148 @@ class AsyncHTTPExecuter:
         :param call_count: Number of calls to execute, default infinite.
         :param duration: Duration in second for the run, default infinite.
         """
-        asyncio.run(self._run(call_count=call_count, duration=duration))
+        loop_factory = None
+        if self.loop == "uvloop":
+            import uvloop
+            loop_factory = uvloop.new_event_loop
+        with asyncio.Runner(loop_factory=loop_factory) as runner:
+            runner.run(self._run(call_count=call_count, duration=duration))
 
     async def _run(self, call_count=None, duration=None):
         orig_sigint_handler = signal.signal(signal.SIGINT, self._terminate)
         orig_sigterm_handler = signal.signal(signal.SIGTERM, self._terminate)
-        # disable all TCP limits for highly parallel loads
-        conn = aiohttp.TCPConnector(limit=0)
-        async with aiohttp.ClientSession(connector=conn) as session:
-            start_time = time.time()
-            calls_made = 0
-            request_tasks = set()
-            while (call_count is None or calls_made < call_count) and (duration is None or (time.time() - start_time) < duration) and not self.terminate:
+        lag_probe = None
+        if self.loop_lag_callback is not None:
+            lag_probe = LoopLagProbe(self.loop_lag_callback)
+            lag_probe.start(asyncio.get_running_loop())
+        # disable the total TCP limit for highly parallel loads
+        conn = aiohttp.TCPConnector(limit=0, limit_per_host=self.limit_per_host, keepalive_timeout=self.keepalive_timeout, ttl_dns_cache=self.dns_cache_ttl)
+        async with aiohttp.ClientSession(connector=conn, trace_configs=self.trace_configs) as session:
+            if self.prewarm_connections > 0:
+                await self._prewarm(session)
+            if self.engine == "workers":
+                await self._run_workers(session, call_count, duration)
+            else:
+                await self._run_tasks(session, call_count, duration)
+
+        if lag_probe is not None:
+            lag_probe.stop()
+        signal.signal(signal.SIGINT, orig_sigint_handler)
+        signal.signal(signal.SIGTERM, orig_sigterm_handler)
+
+    async def _run_tasks(self, session: aiohttp.ClientSession, call_count=None, duration=None):
+        start_time = time.time()
+        calls_made = 0
+        request_tasks = set()
+        while (call_count is None or calls_made < call_count) and (duration is None or (time.time() - start_time) < duration) and not self._stopping():
+            try:
                 async with self.rate_limiter:
-                    if len(request_tasks) > self.max_concurrency:
+                    max_concurrency = self.max_concurrency if self.concurrency_controller is None else self.concurrency_controller.limit
+                    if len(request_tasks) > max_concurrency:
+                        if self.concurrency_controller is not None:
+                            self.concurrency_controller.record_saturation()
                         wait_start_time = time.time()
-                        _, crs_pending = await asyncio.wait(request_tasks, return_when=asyncio.FIRST_COMPLETED)
-                        request_tasks = crs_pending
+                        # the limit may have decreased by more than one request
+                        while len(request_tasks) > max_concurrency:
+                            _, crs_pending = await asyncio.wait(request_tasks, return_when=asyncio.FIRST_COMPLETED)
+                            request_tasks = crs_pending
                         waited = time.time() - wait_start_time
                         if waited > LAG_WARN_DURATION and type(self.rate_limiter) is not NoRateLimiter:
                             logging.warning(f"falling behind committed rate by {round(waited, 3)}s, consider increasing number of clients.")
+                    # tasks copy the current context, so each request sees its own value
+                    intended_start_time.set(getattr(self.rate_limiter, "intended_time", None))
                     v = asyncio.create_task(self.async_http_func(session))
                     request_tasks.add(v)
                     calls_made += 1
+            except StopAsyncIteration:
+                # rate limiter has no more calls to release, see TraceReplay
+                break
 
-            if len(request_tasks) > 0:
-                logging.info(f"waiting for {len(request_tasks)} requests to drain")
-                await asyncio.wait(request_tasks)
+        if len(request_tasks) > 0:
+            logging.info(f"waiting for {len(request_tasks)} requests to drain")
+            await asyncio.wait(request_tasks)
 
-        signal.signal(signal.SIGINT, orig_sigint_handler)
-        signal.signal(signal.SIGTERM, orig_sigterm_handler)
+    async def _run_workers(self, session: aiohttp.ClientSession, call_count=None, duration=None):
+        controller = self.concurrency_controller
+        worker_count = self.max_concurrency if controller is None else controller.max_limit
+        state = _WorkerState(call_count, duration, self.max_concurrency if controller is None else controller.limit)
+        workers = [asyncio.create_task(self._worker(i, session, state)) for i in range(worker_count)]
+        await asyncio.wait(workers)
+
+    async def _worker(self, index: int, session: aiohttp.ClientSession, state: "_WorkerState"):
+        controller = self.concurrency_controller
+        while True:
+            if controller is not None and index >= state.limit and not state.stopping:
+                # parked until the adaptive limit grows past this worker, or the run stops
+                await state.limit_changed.wait()
+                continue
+            async with state.lock:
+                if not state.stopping and not self._more_calls(state):
+                    self._stop_workers(state)
+                if state.stopping:
+                    return
+                try:
+                    async with self.rate_limiter:
+                        intended = getattr(self.rate_limiter, "intended_time", None)
+                except StopAsyncIteration:
+                    # rate limiter has no more calls to release, see TraceReplay
+                    self._stop_workers(state)
+                    return
+                state.calls_made += 1
+                state.busy += 1
+                if state.busy >= state.limit:
+                    # all workers busy, the next permit waits for one to complete
+                    if controller is not None:
+                        controller.record_saturation()
+                    if state.busy_since is None:
+                        state.busy_since = time.time()
+            # the worker's own context, shared by its requests one at a time
+            intended_start_time.set(intended)
+            try:
+                await self.async_http_func(session)
+            except Exception as e:
+                # a failed request must not stop its worker
+                logging.error(f"request failed: {e}")
+            finally:
+                state.busy -= 1
+                if state.busy_since is not None:
+                    waited = time.time() - state.busy_since
+                    state.busy_since = None
+                    if waited > LAG_WARN_DURATION and type(self.rate_limiter) is not NoRateLimiter and not state.stopping:
+                        logging.warning(f"falling behind committed rate by {round(waited, 3)}s, consider increasing number of clients.")
+                if controller is not None and controller.limit != state.limit:
+                    state.limit = controller.limit
+                    state.wake()
+
+    def _more_calls(self, state: "_WorkerState") -> bool:
+        return (state.call_count is None or state.calls_made < state.call_count) and \
+            (state.duration is None or (time.time() - state.start_time) < state.duration) and not self._stopping()
+
+    def _stopping(self) -> bool:
+        return self.terminate or (self.stop is not None and self.stop.is_set())
+
+    def _stop_workers(self, state: "_WorkerState"):
+        state.stopping = True
+        if state.busy > 0:
+            logging.info(f"waiting for {state.busy} requests to drain")
+        state.wake()
+
+    async def _prewarm(self, session: aiohttp.ClientSession):
+        """
+        Opens prewarm_connections connections to each origin concurrently, so
+        that first requests do not pay for DNS, TCP and TLS setup. Connections
+        return to the pool once their response is read.
+        """
+        origins = sorted({str(URL(url).origin()) for url in self.prewarm_urls})
+        async def connect(origin):
+            try:
+                async with session.head(origin + "/") as response:
+                    await response.read()
+            except aiohttp.ClientError as e:
+                logging.warning(f"unable to prewarm connection to {origin}: {e}")
+        start_time = time.time()
+        await asyncio.gather(*(connect(origin) for origin in origins for _ in range(self.prewarm_connections)))
+        logging.info(f"prewarmed {self.prewarm_connections} connections to {', '.join(origins)} in {round(time.time() - start_time, 3)}s")
 
     def _terminate(self, *args):
         if not self.terminate:
@@ -74,3 +229,30 @@ class AsyncHTTPExecuter:
         else:
             logging.info("forcing program exit")
             os._exit(0)
+
+class _WorkerState:
+    """
+    State shared by the worker coroutines of a run.
+    """
+    def __init__(self, call_count, duration, limit: int):
+        self.call_count = call_count
+        self.duration = duration
+        self.start_time = time.time()
+        self.calls_made = 0
+        # workers running a request
+        self.busy = 0
+        # time all active workers became busy, None while one is free
+        self.busy_since = None
+        # number of active workers, the limit of the concurrency controller if any
+        self.limit = limit
+        self.stopping = False
+        # held while taking a permit, so the rate limiter sees one caller at a time
+        self.lock = asyncio.Lock()
+        self.limit_changed = asyncio.Event()
+
+    def wake(self):
+        """
+        Wakes parked workers to check the limit and stopping again.
+        """
+        self.limit_changed.set()
+        self.limit_changed = asyncio.Event()
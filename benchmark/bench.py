@@ -2,11 +2,60 @@
 # Licensed under the MIT License.
 
 import argparse
+import functools
+import importlib
 import logging
 
-from .loadcmd import load
-from .tokenizecmd import tokenize
 
+def _command(module: str, name: str):
+    """
+    Returns a subcommand function that imports its module when called, so
+    that parsing arguments, --help and light subcommands such as tokenize do
+    not pay for importing the dependencies of every other subcommand. It is
+    a partial of a module level function, so that arguments holding it can
+    be pickled into worker processes.
+    """
+    return functools.partial(_run_command, module, name)
+
+def _run_command(module: str, name: str, args):
+    return getattr(importlib.import_module(module, __package__), name)(args)
+
+def _int_list(value: str) -> [int]:
+    try:
+        return [int(v) for v in value.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected comma separated integers, got {value}")
+
+def _add_request_arguments(parser: argparse.ArgumentParser):
+    """
+    Adds arguments shared by subcommands that send requests to a deployment.
+    """
+    parser.add_argument("-a", "--api-version", type=str, default="2023-05-15", help="Set OpenAI API version.")
+    parser.add_argument("-k", "--api-key-env", type=str, default="OPENAI_API_KEY", help="Environment variable that contains the API KEY.")
+    parser.add_argument("-c", "--clients", type=int, default=20, help="Set number of parallel clients to use for load generation.")
+    parser.add_argument("--keepalive-timeout", type=float, default=15, help="Seconds an idle connection is kept open for reuse.")
+    parser.add_argument("--dns-cache-ttl", type=int, default=10, help="Seconds resolved host addresses are cached, -1 to cache them for the whole run.")
+    parser.add_argument("--limit-per-host", type=int, default=0, help="Maximum number of connections to each host. Defaults to unlimited.")
+    parser.add_argument("--prewarm-connections", type=int, default=0, help="Number of connections opened to each endpoint before load starts.")
+    parser.add_argument("--loop", type=str, default="asyncio", help="Event loop implementation. uvloop requires the uvloop package.", choices=["asyncio", "uvloop"])
+    parser.add_argument("--engine", type=str, default="tasks", help="Request execution engine. See README for details.", choices=["tasks", "workers"])
+    parser.add_argument("-s", "--shape-profile", type=str, default="balanced", help="Shape profile of requests.", choices=["balanced", "context", "generation", "custom"])
+    parser.add_argument("-p", "--context-tokens", type=int, help="Number of context tokens to use when --shape-profile=custom.")
+    parser.add_argument("-m", "--max-tokens", type=int, help="Number of requested max_tokens when --shape-profile=custom. Defaults to unset.")
+    parser.add_argument("--workload", type=str, help="Mix of request shapes, either inline or a json file. Overrides shape profile options. See README for details.")
+    parser.add_argument("--prompt-pool-size", type=int, default=16, help="Number of distinct prompts generated at startup and cycled through during the run.")
+    parser.add_argument("-i", "--completions", type=int, default=1, help="Number of completion for each request.")
+    parser.add_argument("--frequency-penalty", type=float, help="Request frequency_penalty.")
+    parser.add_argument("--presence-penalty", type=float, help="Request frequency_penalty.")
+    parser.add_argument("--temperature", type=float, help="Request temperature.")
+    parser.add_argument("--top-p", type=float, help="Request top_p.")
+    parser.add_argument("-f", "--output-format", type=str, default="human", help="Output format, none to turn periodic output off.", choices=["jsonl", "human", "none"])
+    parser.add_argument("-t", "--retry", type=str, default="none", help="Request retry strategy. See README for details", choices=["none", "exponential"])
+    parser.add_argument("--retry-budget", type=float, help="Retries allowed per request on average with --retry exponential, such as 0.2 for 20%%. Defaults to unlimited.")
+    parser.add_argument("--targets", type=str, help="Json file of deployments to route requests to, instead of api_base_endpoint and deployment. See README for details.")
+    parser.add_argument("--routing", type=str, default="round-robin", help="Routing policy across targets. See README for details.", choices=["round-robin", "weighted", "spillover"])
+    parser.add_argument("-e", "--deployment", type=str, help="Azure OpenAI deployment name. Required unless --targets is set.")
+    parser.add_argument("api_base_endpoint", help="Azure OpenAI deployment base endpoint. Required unless --targets is set.", nargs="?")
 
 def main():
     logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)-8s %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
@@ -15,26 +64,50 @@ def main():
     sub_parsers = parser.add_subparsers()
 
     load_parser = sub_parsers.add_parser("load", help="Run load generation tool.")
-    load_parser.add_argument("-a", "--api-version", type=str, default="2023-05-15", help="Set OpenAI API version.")
-    load_parser.add_argument("-k", "--api-key-env", type=str, default="OPENAI_API_KEY", help="Environment variable that contains the API KEY.")
-    load_parser.add_argument("-c", "--clients", type=int, default=20, help="Set number of parallel clients to use for load generation.")
+    _add_request_arguments(load_parser)
+    load_parser.add_argument("--workers", type=int, default=1, help="Number of load generation processes. Rate, clients and requests are spread evenly across workers.")
+    load_parser.add_argument("--controller", action="store_true", help="Run load on the remote agents of --agents instead of locally. Rate, clients and requests are spread evenly across agents. See README for details.")
+    load_parser.add_argument("--agents", type=str, help="Comma separated host:port addresses of agents started with the agent subcommand, with --controller.")
+    load_parser.add_argument("--agent-token-env", type=str, default="AOAI_BENCHMARK_AGENT_TOKEN", help="Environment variable that contains the token shared with agents, with --controller.")
     load_parser.add_argument("-n", "--requests", type=int, help="Number of requests for the load run. Default to 'until killed'.")
     load_parser.add_argument("-d", "--duration", type=int, help="Duration of load in seconds. Defaults to 'until killed'.")
     load_parser.add_argument("-r", "--rate", type=float, help="Rate of request generation in Requests Per Minute (RPM). Default to as fast as possible.")
+    load_parser.add_argument("--tpm", type=float, help="Rate of request generation in Tokens Per Minute (TPM), counting context and generated tokens. Cannot be combined with --rate.")
+    load_parser.add_argument("--arrivals", type=str, default="sliding", help="Request arrival process used with --rate. See README for details.", choices=["sliding", "constant", "poisson"])
+    load_parser.add_argument("--adaptive-concurrency", action="store_true", help="Adapt the number of concurrent requests to the deployment, up to --clients. See README for details.")
+    load_parser.add_argument("--target-utilization", type=float, default=95, help="Utilization in percent adaptive concurrency stays under.")
+    load_parser.add_argument("--adaptive-max-ttft", type=float, help="95th percentile time to first token in seconds adaptive concurrency stays under. Defaults to unlimited.")
+    load_parser.add_argument("--replay", type=str, help="Replay requests from a jsonl trace on their recorded schedule instead of generating them. See README for details.")
+    load_parser.add_argument("--replay-speed", type=float, default=1.0, help="Speed-up factor of the replayed schedule.")
+    load_parser.add_argument("--raw-log", type=str, help="Directory to write every request to, in a columnar format. See README for details.")
+    load_parser.add_argument("--prometheus-port", type=int, help="Serve live metrics for Prometheus on this port at /metrics. See README for details.")
+    load_parser.add_argument("--prometheus-host", type=str, default="127.0.0.1", help="Address to serve Prometheus metrics on, 0.0.0.0 for all interfaces.")
+    load_parser.add_argument("--stall-threshold", type=float, default=1.0, help="Gap in seconds between two generated tokens counted as a stall.")
     load_parser.add_argument("-w", "--aggregation-window", type=float, default=60, help="Statistics aggregation sliding window duration in seconds. See README.md for more details.")
-    load_parser.add_argument("-s", "--shape-profile", type=str, default="balanced", help="Shape profile of requests.", choices=["balanced", "context", "generation", "custom"])
-    load_parser.add_argument("-p", "--context-tokens", type=int, help="Number of context tokens to use when --shape-profile=custom.")
-    load_parser.add_argument("-m", "--max-tokens", type=int, help="Number of requested max_tokens when --shape-profile=custom. Defaults to unset.")
-    load_parser.add_argument("-i", "--completions", type=int, default=1, help="Number of completion for each request.")
-    load_parser.add_argument("--frequency-penalty", type=float, help="Request frequency_penalty.")
-    load_parser.add_argument("--presence-penalty", type=float, help="Request frequency_penalty.")
-    load_parser.add_argument("--temperature", type=float, help="Request temperature.")
-    load_parser.add_argument("--top-p", type=float, help="Request top_p.")
-    load_parser.add_argument("-f", "--output-format", type=str, default="human", help="Output format.", choices=["jsonl", "human"])
-    load_parser.add_argument("-t", "--retry", type=str, default="none", help="Request retry strategy. See README for details", choices=["none", "exponential"])
-    load_parser.add_argument("-e", "--deployment", type=str, help="Azure OpenAI deployment name.", required=True)
-    load_parser.add_argument("api_base_endpoint", help="Azure OpenAI deployment base endpoint.", nargs=1)
-    load_parser.set_defaults(func=load)
+    load_parser.set_defaults(func=_command(".loadcmd", "load"))
+
+    search_parser = sub_parsers.add_parser("search", help="Search for the highest request rate a deployment sustains.")
+    _add_request_arguments(search_parser)
+    search_parser.add_argument("--strategy", type=str, default="staircase", help="Search strategy. See README for details.", choices=["staircase", "binary"])
+    search_parser.add_argument("--start-rate", type=float, default=10, help="First rate to test in Requests Per Minute (RPM).")
+    search_parser.add_argument("--max-rate", type=float, default=1000, help="Highest rate to test in Requests Per Minute (RPM).")
+    search_parser.add_argument("--rate-step", type=float, default=10, help="Rate increment of staircase search, and resolution of binary search, in Requests Per Minute (RPM).")
+    search_parser.add_argument("--step-duration", type=float, default=180, help="Duration in seconds of each rate step, including warmup.")
+    search_parser.add_argument("--warmup", type=float, default=60, help="Duration in seconds at the start of each step excluded from measurements, to let the deployment reach a steady state.")
+    search_parser.add_argument("--max-throttle-ratio", type=float, default=0.01, help="Highest ratio of throttled (429) requests for a step to pass.")
+    search_parser.add_argument("--max-ttft", type=float, help="Highest 95th percentile time to first token in seconds for a step to pass. Defaults to unlimited.")
+    search_parser.add_argument("--arrivals", type=str, default="constant", help="Request arrival process of each step. See README for details.", choices=["sliding", "constant", "poisson"])
+    search_parser.set_defaults(func=_command(".searchcmd", "search"))
+
+    analyze_parser = sub_parsers.add_parser("analyze", help="Recompute stats of a run from its raw log.")
+    analyze_parser.add_argument("-w", "--aggregation-window", type=float, default=60, help="Statistics aggregation sliding window duration in seconds.")
+    analyze_parser.add_argument("--step", type=float, default=60, help="Interval in seconds between two outputs.")
+    analyze_parser.add_argument("--start", type=float, help="Start of the analyzed time range, in seconds since the first request. Defaults to the first request.")
+    analyze_parser.add_argument("--end", type=float, help="End of the analyzed time range, in seconds since the first request. Defaults to the last request.")
+    analyze_parser.add_argument("--stall-threshold", type=float, default=1.0, help="Gap in seconds between two generated tokens counted as a stall.")
+    analyze_parser.add_argument("-f", "--output-format", type=str, default="human", help="Output format.", choices=["jsonl", "human"])
+    analyze_parser.add_argument("raw_log", help="Raw log directory written by load --raw-log.")
+    analyze_parser.set_defaults(func=_command(".analyzecmd", "analyze"))
 
     tokenizer_parser = sub_parsers.add_parser("tokenize", help="Text tokenization tool.")
     tokenizer_parser.add_argument(
@@ -44,7 +117,35 @@ def main():
             "gpt-3.5-turbo", "gpt-3.5-turbo-0613", "gpt-3.5-turbo-16k-0613"], 
         required=True)
     tokenizer_parser.add_argument("text", help="Input text or chat messages json to tokenize. Default to stdin.", nargs="?")
-    tokenizer_parser.set_defaults(func=tokenize)
+    tokenizer_parser.set_defaults(func=_command(".tokenizecmd", "tokenize"))
+
+    mock_server_parser = sub_parsers.add_parser("mock-server", help="Run a local mock Azure OpenAI deployment endpoint.")
+    mock_server_parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on.")
+    mock_server_parser.add_argument("--port", type=int, default=8080, help="Port to listen on.")
+    mock_server_parser.add_argument("--ttft", type=float, default=0.5, help="Delay in seconds before the first token is sent.")
+    mock_server_parser.add_argument("--token-delay", type=float, default=0.02, help="Delay in seconds between two generated tokens.")
+    mock_server_parser.add_argument("--capacity-tpm", type=float, help="Simulated deployment capacity in tokens per minute, including max_tokens. Defaults to unlimited.")
+    mock_server_parser.add_argument("--default-max-tokens", type=int, default=100, help="Number of tokens generated for requests that do not set max_tokens.")
+    mock_server_parser.set_defaults(func=_command(".mockserver", "mock_server"))
+
+    agent_parser = sub_parsers.add_parser("agent", help="Run load generation for a remote load --controller.")
+    agent_parser.add_argument("--listen", type=str, default="127.0.0.1:7777", help="host:port address to listen on for controllers.")
+    agent_parser.add_argument("--token-env", type=str, default="AOAI_BENCHMARK_AGENT_TOKEN", help="Environment variable that contains the token controllers must present.")
+    agent_parser.add_argument("-k", "--api-key-env", type=str, default="OPENAI_API_KEY", help="Environment variable that contains the API KEY, whatever the controller asks for.")
+    agent_parser.add_argument("--allow-endpoint", type=str, action="append", help="Endpoint controllers may send requests to, can be repeated. Defaults to none, allowing only --targets files of --data-dir.")
+    agent_parser.add_argument("--data-dir", type=str, help="Directory of the --targets, --workload and --replay files controllers may name. Defaults to none, allowing no files.")
+    agent_parser.add_argument("--workers", type=int, default=1, help="Number of load generation processes. The share of the agent is spread evenly across workers.")
+    agent_parser.add_argument("--raw-log", type=str, help="Directory to record every request of every run in, one sub-directory per run. See README for details.")
+    agent_parser.set_defaults(func=_command(".distributed", "agent"))
+
+    harness_parser = sub_parsers.add_parser("bench-harness", help="Measure load generation client overhead against a local zero-latency endpoint.")
+    harness_parser.add_argument("--concurrency", type=_int_list, default=[1, 4, 16, 64, 256], help="Comma separated list of concurrency levels to run, in order.")
+    harness_parser.add_argument("--step-duration", type=float, default=10, help="Duration in seconds of each concurrency level.")
+    harness_parser.add_argument("--tokens", type=int, default=100, help="Number of tokens streamed in each response.")
+    harness_parser.add_argument("--engine", type=str, default="tasks", help="Request execution engine to measure.", choices=["tasks", "workers"])
+    harness_parser.add_argument("--startup-runs", type=int, default=5, help="Number of runs of each command timed by the startup benchmark, 0 to skip it.")
+    harness_parser.add_argument("-o", "--output", type=str, help="Also write json results to given file.")
+    harness_parser.set_defaults(func=_command(".harnesscmd", "bench_harness"))
 
     args = parser.parse_args()
     if "func" in args:
@@ -52,4 +153,5 @@ def main():
     else:
         parser.parse_args("--help")
 
-main()
+if __name__ == "__main__":
+    main()
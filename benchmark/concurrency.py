@@ -0,0 +1,113 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import logging
+import time
+
+import numpy as np
+
+from .oairequester import RequestStats
+
+# Seconds between two adjustments of the concurrency limit.
+CONTROL_INTERVAL = 5.0
+# Factor the limit is multiplied by when the deployment is overloaded.
+DECREASE_FACTOR = 0.75
+# Largest fraction of the limit added at once, scaled down by the remaining
+# utilization headroom.
+INCREASE_GAIN = 0.1
+
+class AdaptiveConcurrency:
+   """
+   Adjusts the concurrency limit of AsyncHTTPExecuter to the highest value
+   the deployment sustains, with additive increase and multiplicative
+   decrease (AIMD). Every control interval, the limit is:
+   - decreased by DECREASE_FACTOR when requests were throttled or retried, the average
+     utilization reported by the service reached target_utilization, or the
+     95th percentile time to first token exceeded max_ttft;
+   - otherwise increased when requests had to wait for a free slot, doubling
+     until the first decrease (slow start), then by up to INCREASE_GAIN of the
+     limit, scaled by the utilization headroom left.
+   Requests started before the last change are ignored, as they reflect the
+   previous limit. Changes are logged and kept in trajectory.
+   """
+   def __init__(self, max_limit:int, min_limit:int=1, target_utilization:float=95.0, max_ttft:float=None, interval:float=CONTROL_INTERVAL):
+      """
+      :param max_limit: highest concurrency limit.
+      :param min_limit: lowest and initial concurrency limit.
+      :param target_utilization: utilization in percent to stay under.
+      :param max_ttft: optional 95th percentile time to first token in seconds to stay under.
+      :param interval: seconds between two adjustments.
+      """
+      self.max_limit = max_limit
+      self.min_limit = min_limit
+      self.target_utilization = target_utilization
+      self.max_ttft = max_ttft
+      self.interval = interval
+      self.limit = min_limit
+      self.slow_start = True
+      self.interval_start = time.time()
+      self.change_time = self.interval_start
+      self.trajectory = [(self.interval_start, self.limit)]
+      self._reset()
+
+   def _reset(self):
+      self.requests = 0
+      self.throttled = 0
+      self.utilizations = []
+      self.ttfts = []
+      self.saturated = False
+
+   def record_saturation(self):
+      """
+      Records that a request waited for a free slot under the current limit.
+      """
+      self.saturated = True
+
+   def record(self, stats:RequestStats):
+      """
+      Records a completed request, and adjusts the limit once per interval.
+      """
+      if stats.request_start_time is not None and stats.request_start_time >= self.change_time:
+         self.requests += 1
+         # retried requests were throttled before succeeding
+         if stats.response_status_code == 429 or stats.calls > 1:
+            self.throttled += 1
+         if stats.deployment_utilization is not None:
+            self.utilizations.append(stats.deployment_utilization)
+         if stats.first_token_time is not None:
+            self.ttfts.append(stats.first_token_time - stats.request_start_time)
+      now = time.time()
+      # wait for requests started under the current limit to complete
+      if now - self.interval_start >= self.interval and self.requests > 0:
+         self._adjust(now)
+
+   def _adjust(self, now:float):
+      utilization = float(np.mean(self.utilizations)) if len(self.utilizations) > 0 else None
+      ttft = float(np.percentile(self.ttfts, 95)) if len(self.ttfts) > 0 else None
+      limit = self.limit
+      if self.throttled > 0:
+         reason = f"{self.throttled} of {self.requests} requests throttled"
+      elif utilization is not None and utilization >= self.target_utilization:
+         reason = f"utilization {round(utilization, 1)}% at or above {self.target_utilization}%"
+      elif self.max_ttft is not None and ttft is not None and ttft > self.max_ttft:
+         reason = f"ttft 95th {round(ttft, 3)}s above {self.max_ttft}s"
+      else:
+         reason = None
+      if reason is not None:
+         limit = max(self.min_limit, int(self.limit * DECREASE_FACTOR))
+         self.slow_start = False
+      elif self.saturated:
+         if self.slow_start:
+            limit = self.limit * 2
+         else:
+            headroom = 1.0 if utilization is None else (self.target_utilization - utilization) / self.target_utilization
+            limit = self.limit + max(1, int(self.limit * INCREASE_GAIN * headroom))
+         limit = min(self.max_limit, limit)
+         reason = f"all slots busy, utilization {'n/a' if utilization is None else str(round(utilization, 1)) + '%'}"
+      if limit != self.limit:
+         logging.info(f"concurrency limit {self.limit} -> {limit}: {reason}")
+         self.limit = limit
+         self.change_time = now
+         self.trajectory.append((now, limit))
+      self.interval_start = now
+      self._reset()
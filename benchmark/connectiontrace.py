@@ -0,0 +1,59 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import time
+
+import aiohttp
+
+def connection_trace_config() -> aiohttp.TraceConfig:
+   """
+   Returns a TraceConfig recording the connection timings of every request
+   made with a RequestStats as trace_request_ctx into that RequestStats:
+   dns_time, connect_time, headers_time and new_connection, see RequestStats.
+   Requests made without one, such as connection warm-up, are not recorded.
+   Timings of a request retried several times are those of its last call.
+   """
+   trace_config = aiohttp.TraceConfig()
+   trace_config.on_request_start.append(_on_request_start)
+   trace_config.on_dns_resolvehost_start.append(_on_dns_resolvehost_start)
+   trace_config.on_dns_resolvehost_end.append(_on_dns_resolvehost_end)
+   trace_config.on_connection_create_start.append(_on_connection_create_start)
+   trace_config.on_connection_create_end.append(_on_connection_create_end)
+   trace_config.on_connection_reuseconn.append(_on_connection_reuseconn)
+   trace_config.on_request_end.append(_on_request_end)
+   return trace_config
+
+async def _on_request_start(session, context, params):
+   context.start = time.time()
+   stats = context.trace_request_ctx
+   if stats is not None:
+      stats.dns_time = None
+      stats.connect_time = None
+      stats.headers_time = None
+      stats.new_connection = None
+
+async def _on_dns_resolvehost_start(session, context, params):
+   context.dns_start = time.time()
+
+async def _on_dns_resolvehost_end(session, context, params):
+   if context.trace_request_ctx is not None:
+      context.trace_request_ctx.dns_time = time.time() - context.dns_start
+
+async def _on_connection_create_start(session, context, params):
+   context.connect_start = time.time()
+
+async def _on_connection_create_end(session, context, params):
+   stats = context.trace_request_ctx
+   if stats is not None:
+      # connection creation resolves the host first
+      stats.connect_time = time.time() - context.connect_start - (stats.dns_time or 0)
+      stats.new_connection = True
+
+async def _on_connection_reuseconn(session, context, params):
+   if context.trace_request_ctx is not None:
+      context.trace_request_ctx.new_connection = False
+
+async def _on_request_end(session, context, params):
+   # called once response headers are received
+   if context.trace_request_ctx is not None:
+      context.trace_request_ctx.headers_time = time.time() - context.start
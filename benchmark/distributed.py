@@ -0,0 +1,436 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import argparse
+import hmac
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from .loadworkers import WorkerPool, _QueueStatsSink, _worker_args
+from .rawlog import RawLogWriter
+from .statsaggregator import _StatsAggregator, _encode_interval
+
+# Version of the controller to agent protocol, both ends must match.
+PROTOCOL_VERSION = 3
+# Port agents listen on when none is given.
+AGENT_PORT = 7777
+# Time in seconds the controller keeps trying to connect to an agent.
+AGENT_CONNECT_TIMEOUT = 30
+# Number of round trips used to estimate the clock offset of each agent.
+CLOCK_SYNC_SAMPLES = 8
+# Delay in seconds between sending the run to agents and its start, so that
+# all agents start at the same time.
+AGENT_START_DELAY = 1.0
+# Time in seconds a controller has to authenticate once connected to an agent.
+AGENT_HELLO_TIMEOUT = 10
+# Interval in seconds between two stats messages of an agent.
+AGENT_FLUSH_INTERVAL = 0.5
+
+def _parse_address(value:str) -> (str, int):
+   """
+   Parses a host[:port] address, the port defaulting to AGENT_PORT.
+   """
+   host, _, port = value.strip().rpartition(":")
+   if host == "":
+      return port, AGENT_PORT
+   try:
+      return host, int(port)
+   except ValueError:
+      raise ValueError(f"invalid agent address {value}, expected host:port")
+
+def _parse_agents(value:str) -> [(str, int)]:
+   return [_parse_address(address) for address in value.split(",")]
+
+def _clock_offset(exchanges:list) -> (float, float):
+   """
+   Estimates the clock offset of an agent from ping exchanges, as NTP does.
+   Each exchange holds the controller send time t0, the agent receive time
+   t1, the agent send time t2 and the controller receive time t3. The
+   exchange with the shortest round trip is used, as its offset has the
+   smallest error bound.
+   Returns the offset in seconds the agent clock is ahead of the controller
+   clock, and the round trip time of the exchange used.
+   """
+   t0, t1, t2, t3 = min(exchanges, key=lambda e: (e[3] - e[0]) - (e[2] - e[1]))
+   return ((t1 - t0) + (t2 - t3)) / 2, (t3 - t0) - (t2 - t1)
+
+class _Channel:
+   """
+   Newline delimited json messages over a connected socket. Sending is safe
+   from any thread.
+   """
+   def __init__(self, sock:socket.socket):
+      self.sock = sock
+      self.reader = sock.makefile("r", encoding="utf-8")
+      self.lock = threading.Lock()
+
+   def send(self, message:dict):
+      data = (json.dumps(message, separators=(",", ":")) + "\n").encode()
+      with self.lock:
+         self.sock.sendall(data)
+
+   def receive(self) -> dict:
+      """
+      Returns the next message, None once the connection is closed. Raises
+      ValueError if the peer sent something else than a message.
+      """
+      try:
+         line = self.reader.readline()
+      except (OSError, ValueError):
+         return None
+      if len(line) == 0:
+         return None
+      message = json.loads(line)
+      if not isinstance(message, dict) or not isinstance(message.get("type"), str):
+         raise ValueError("invalid message")
+      return message
+
+   def close(self):
+      self.reader.close()
+      self.sock.close()
+
+class _IntervalForwarder:
+   """
+   Queue _QueueStatsSink forwards batches of stats to. Each batch is sent to
+   the controller as the metrics of an interval, see _encode_interval, and
+   recorded in the raw log of the agent, if any.
+   """
+   def __init__(self, channel:_Channel, slot_duration:float, stall_threshold:float, raw_log:RawLogWriter=None):
+      self.channel = channel
+      self.slot_duration = slot_duration
+      self.stall_threshold = stall_threshold
+      self.raw_log = raw_log
+      self.failed = False
+
+   def put(self, item):
+      new_requests, batch, loop_lags = item
+      if self.raw_log is not None:
+         for stats in batch:
+            self.raw_log.append(stats)
+      interval = _encode_interval(new_requests, batch, loop_lags, self.slot_duration, self.stall_threshold)
+      try:
+         self.channel.send({"type": "stats", "interval": interval})
+      except OSError as e:
+         if not self.failed:
+            logging.warning(f"unable to send stats to controller: {e}")
+            self.failed = True
+
+class _Agent:
+   """
+   State of an agent connected to the controller.
+   """
+   def __init__(self, name:str, channel:_Channel, offset:float):
+      self.name = name
+      self.channel = channel
+      self.offset = offset
+      self.thread = None
+
+class AgentController:
+   """
+   Runs load on remote agents started with the agent subcommand, and merges
+   the interval metrics they send into a single aggregator, as WorkerPool
+   does with the stats of local processes. Rate, clients, requests and trace records are spread
+   evenly across agents. The clock offset of every agent is estimated when
+   connecting, so that all agents start at the same time and the timestamps
+   they report are moved to the controller clock.
+   """
+   def __init__(self, args, aggregator:_StatsAggregator):
+      """
+      :param args: parsed load command arguments, with agent addresses in args.agents.
+      :param aggregator: aggregator receiving the stats of all agents.
+      """
+      self.args = args
+      self.addresses = _parse_agents(args.agents)
+      self.aggregator = aggregator
+      self.agents = []
+      self.terminate = False
+
+   def connect(self):
+      """
+      Connects to all agents and estimates their clock offsets. Raises
+      OSError if an agent cannot be reached.
+      """
+      token = os.getenv(self.args.agent_token_env)
+      for host, port in self.addresses:
+         channel = _Channel(_connect(host, port))
+         channel.send({"type": "hello", "version": PROTOCOL_VERSION, "token": token})
+         reply = channel.receive()
+         if reply is None:
+            raise ConnectionError(f"agent {host}:{port} closed the connection")
+         if reply["type"] == "error":
+            raise ConnectionError(f"agent {host}:{port} refused the connection: {reply['message']}")
+         exchanges = []
+         for _ in range(CLOCK_SYNC_SAMPLES):
+            t0 = time.time()
+            channel.send({"type": "ping"})
+            reply = channel.receive()
+            t3 = time.time()
+            if reply is None:
+               raise ConnectionError(f"agent {host}:{port} closed the connection")
+            exchanges.append((t0, reply["receive_time"], reply["send_time"], t3))
+         offset, round_trip = _clock_offset(exchanges)
+         logging.info(f"connected to agent {host}:{port}, clock offset {round(offset * 1000, 3)}ms, round trip {round(round_trip * 1000, 3)}ms")
+         self.agents.append(_Agent(f"{host}:{port}", channel, offset))
+
+   def run(self):
+      """
+      Starts the load on all connected agents and blocks until all of them finished.
+      """
+      args = dict(vars(self.args))
+      args.pop("func", None)
+      start_time = time.time() + AGENT_START_DELAY
+      for i, agent in enumerate(self.agents):
+         agent_args = vars(_worker_args(argparse.Namespace(**args), i, len(self.agents)))
+         agent.channel.send({"type": "run", "args": agent_args, "start_time": start_time + agent.offset,
+                             "slot_duration": self.aggregator.dump_duration})
+         agent.thread = threading.Thread(target=self._collect, args=(agent,), daemon=True)
+         agent.thread.start()
+      logging.info(f"started load on {len(self.agents)} agents")
+
+      orig_sigint_handler = signal.signal(signal.SIGINT, self._terminate)
+      orig_sigterm_handler = signal.signal(signal.SIGTERM, self._terminate)
+      try:
+         for agent in self.agents:
+            # join with a timeout, so that signals are handled while waiting
+            while agent.thread.is_alive():
+               agent.thread.join(timeout=1)
+      finally:
+         signal.signal(signal.SIGINT, orig_sigint_handler)
+         signal.signal(signal.SIGTERM, orig_sigterm_handler)
+         for agent in self.agents:
+            agent.channel.close()
+
+   def _collect(self, agent:_Agent):
+      while True:
+         try:
+            message = agent.channel.receive()
+         except ValueError as e:
+            logging.error(f"agent {agent.name} sent an invalid message: {e}")
+            return
+         if message is None:
+            logging.warning(f"agent {agent.name} disconnected before completing")
+            return
+         if message["type"] == "done":
+            return
+         if message["type"] == "error":
+            logging.error(f"agent {agent.name}: {message['message']}")
+            continue
+         self.aggregator.aggregate_interval(message["interval"], agent.offset)
+
+   def _terminate(self, *args):
+      if not self.terminate:
+         logging.warning("got terminate signal, draining agents. signal again to exit immediately.")
+         self.terminate = True
+         for agent in self.agents:
+            try:
+               agent.channel.send({"type": "stop"})
+            except OSError:
+               pass
+      else:
+         logging.info("forcing program exit")
+         os._exit(0)
+
+def _connect(host:str, port:int) -> socket.socket:
+   """
+   Connects to an agent, retrying until AGENT_CONNECT_TIMEOUT, so that agents
+   and the controller can be started together.
+   """
+   deadline = time.time() + AGENT_CONNECT_TIMEOUT
+   while True:
+      try:
+         sock = socket.create_connection((host, port), timeout=AGENT_CONNECT_TIMEOUT)
+         sock.settimeout(None)
+         sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+         return sock
+      except OSError as e:
+         if time.time() > deadline:
+            raise ConnectionError(f"unable to connect to agent {host}:{port}: {e}")
+         time.sleep(0.2)
+
+def agent(args):
+   """
+   Serves load runs of controllers, one at a time, until killed.
+   """
+   try:
+      host, port = _parse_address(args.listen)
+      if not os.getenv(args.token_env):
+         raise ValueError(f"token-env {args.token_env} not set")
+      if args.data_dir is not None and not os.path.isdir(args.data_dir):
+         raise ValueError(f"data-dir {args.data_dir} not found")
+   except ValueError as e:
+      print(f"invalid argument(s): {e}")
+      sys.exit(1)
+   with socket.create_server((host, port)) as server:
+      logging.info(f"agent listening on {host}:{port}")
+      while True:
+         sock, (peer_host, peer_port) = server.accept()
+         sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+         logging.info(f"controller connected from {peer_host}:{peer_port}")
+         channel = _Channel(sock)
+         try:
+            _serve(channel, args)
+         except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"dropped controller {peer_host}:{peer_port}: {e!r}")
+         finally:
+            channel.close()
+         logging.info("controller disconnected, waiting for the next run")
+
+def _serve(channel:_Channel, options):
+   """
+   Serves a controller connection. The controller must first authenticate
+   with the token of options.token_env, within AGENT_HELLO_TIMEOUT.
+   """
+   channel.sock.settimeout(AGENT_HELLO_TIMEOUT)
+   try:
+      message = channel.receive()
+   except ValueError:
+      message = {"type": "invalid"}
+   if message is None:
+      return
+   channel.sock.settimeout(None)
+   error = None
+   if message["type"] != "hello" or not hmac.compare_digest(str(message.get("token")).encode(), os.getenv(options.token_env).encode()):
+      error = "invalid token"
+   elif message.get("version") != PROTOCOL_VERSION:
+      error = f"controller protocol version {message.get('version')} does not match agent version {PROTOCOL_VERSION}"
+   if error is not None:
+      logging.warning(f"refused controller: {error}")
+      channel.send({"type": "error", "message": error})
+      return
+   channel.send({"type": "hello"})
+   while True:
+      message = channel.receive()
+      receive_time = time.time()
+      if message is None:
+         return
+      if message["type"] == "ping":
+         channel.send({"type": "pong", "receive_time": receive_time, "send_time": time.time()})
+      elif message["type"] == "run":
+         _AgentRun(channel, options).run(message)
+         return
+
+class _AgentRun:
+   """
+   Load run of an agent, stopped when the controller asks to or disconnects.
+   The api key, endpoints and files a run uses are set by the agent options,
+   not by the controller.
+   """
+   def __init__(self, channel:_Channel, options):
+      """
+      :param channel: connection to the controller.
+      :param options: parsed agent command arguments.
+      """
+      self.channel = channel
+      self.options = options
+      self.finished = False
+      # drains the run, polled by AsyncHTTPExecuter and WorkerPool
+      self.stop = threading.Event()
+
+   def run(self, message:dict):
+      try:
+         args = self._args(message["args"])
+      except ValueError as e:
+         logging.error(f"invalid run: {e}")
+         self._send({"type": "error", "message": str(e)})
+         self._send({"type": "done"})
+         return
+
+      threading.Thread(target=self._watch, daemon=True).start()
+      # start time is in the agent clock, see AgentController.connect
+      if self.stop.wait(max(0.0, message["start_time"] - time.time())):
+         self._send({"type": "done"})
+         return
+      logging.info(f"starting load with {args.clients} clients...")
+      raw_log = None
+      if self.options.raw_log is not None:
+         # one directory per run, named after its start time
+         raw_log = RawLogWriter(os.path.join(self.options.raw_log, time.strftime("%Y%m%d-%H%M%S")))
+         raw_log.start()
+         logging.info(f"recording requests in {raw_log.directory}")
+      forwarder = _IntervalForwarder(self.channel, message["slot_duration"], args.stall_threshold, raw_log)
+      sink = _QueueStatsSink(forwarder, flush_interval=AGENT_FLUSH_INTERVAL)
+      sink.start()
+      try:
+         if args.clients > 0 and (args.requests is None or args.requests > 0):
+            if args.workers > 1:
+               WorkerPool(args, sink, stop=self.stop).run()
+            else:
+               # local import to avoid a circular dependency with loadcmd
+               from .loadcmd import _run_load_args
+               _run_load_args(args, stats_sink=sink, stop=self.stop)
+      except Exception as e:
+         logging.exception("load failed")
+         self._send({"type": "error", "message": f"load failed: {e}"})
+      finally:
+         sink.stop()
+         if raw_log is not None:
+            raw_log.stop()
+         self.finished = True
+         self._send({"type": "done"})
+      logging.info("finished load")
+
+   def _args(self, values:dict) -> argparse.Namespace:
+      # local import to avoid a circular dependency with loadcmd
+      from .loadcmd import _validate
+      args = argparse.Namespace(**values)
+      # stats are printed by the controller, and recorded by the agent sink
+      args.controller = False
+      args.agents = None
+      args.output_format = "none"
+      args.raw_log = None
+      args.prometheus_port = None
+      args.workers = max(1, min(self.options.workers, args.clients))
+      args.api_key_env = self.options.api_key_env
+      if args.api_base_endpoint is not None:
+         allowed = [endpoint.rstrip("/") for endpoint in self.options.allow_endpoint or []]
+         if args.api_base_endpoint.rstrip("/") not in allowed:
+            raise ValueError(f"endpoint {args.api_base_endpoint} not allowed, see agent --allow-endpoint")
+      if args.targets is not None:
+         args.targets = self._data_file(args.targets, "targets")
+      if args.replay is not None:
+         args.replay = self._data_file(args.replay, "replay")
+      if args.workload is not None:
+         # inline workloads hold name:weight classes, file names do not
+         if ":" not in args.workload:
+            args.workload = self._data_file(args.workload, "workload")
+         elif os.path.exists(args.workload):
+            raise ValueError(f"workload {args.workload} must be inline or a file name within the agent data-dir")
+      if args.clients > 0:
+         _validate(args)
+      return args
+
+   def _data_file(self, name:str, option:str) -> str:
+      """
+      Returns the path of a file the controller named, which must be a file
+      name within the agent data directory.
+      """
+      if self.options.data_dir is None:
+         raise ValueError(f"{option} files require agent --data-dir")
+      if name in ("", ".", "..") or os.path.basename(name) != name:
+         raise ValueError(f"{option} {name} must be a file name within the agent data-dir")
+      return os.path.join(self.options.data_dir, name)
+
+   def _send(self, message:dict):
+      try:
+         self.channel.send(message)
+      except OSError:
+         pass
+
+   def _watch(self):
+      try:
+         message = self.channel.receive()
+      except ValueError:
+         message = None
+      if self.finished:
+         return
+      if message is None:
+         logging.warning("lost connection to controller, stopping")
+      else:
+         logging.warning("controller asked to stop, draining")
+      self.stop.set()
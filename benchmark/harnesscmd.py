@@ -0,0 +1,178 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+from .asynchttpexecuter import AsyncHTTPExecuter
+from .histogram import LogHistogram
+from .mockserver import SEND_TIME_HEADER, MockServer
+from .oairequester import OAIRequester
+from .statsaggregator import _StatsAggregator, _summary
+
+# Time in seconds to wait for the local endpoint to accept connections.
+SERVER_START_TIMEOUT = 30
+# Environment variable holding the api key of startup load runs.
+HARNESS_KEY_ENV = "AOAI_BENCHMARK_HARNESS_KEY"
+# Command lines timed by the startup benchmark, each run as a new process of
+# `python -m benchmark.bench`, with {endpoint} replaced by the local endpoint.
+STARTUP_COMMANDS = {
+   "help": ["--help"],
+   "tokenize": ["tokenize", "-m", "gpt-4-0613", "startup"],
+   "load": ["load", "-n", "1", "-c", "1", "-s", "custom", "-p", "100", "-m", "10", "-f", "none", "-k", HARNESS_KEY_ENV, "-e", "harness", "{endpoint}"],
+}
+
+def bench_harness(args):
+   """
+   Measures the overhead of the load generation client itself, by running
+   AsyncHTTPExecuter, OAIRequester and _StatsAggregator against a local
+   zero-latency endpoint at increasing concurrency levels, then the startup
+   time of short runs of the tool. Prints results as json.
+   """
+   port = _free_port()
+   server = multiprocessing.get_context("spawn").Process(target=_serve, args=(port,), daemon=True)
+   server.start()
+   try:
+      _wait_for_port(port)
+      url = f"http://127.0.0.1:{port}/openai/deployments/harness/chat/completions?api-version=2023-05-15"
+      body = json.dumps({
+         "messages": [{"role": "user", "content": "harness"}],
+         "max_tokens": args.tokens,
+         "stream": True,
+      }).encode()
+      levels = []
+      for concurrency in args.concurrency:
+         logging.info(f"running harness at concurrency {concurrency} for {args.step_duration}s")
+         levels.append(_run_level(url, body, concurrency, args.step_duration, engine=args.engine))
+      startup = None
+      if args.startup_runs > 0:
+         logging.info(f"timing startup of {', '.join(STARTUP_COMMANDS)} over {args.startup_runs} runs")
+         startup = _startup_times(f"http://127.0.0.1:{port}", args.startup_runs)
+   finally:
+      server.terminate()
+      server.join()
+
+   best = max(levels, key=lambda level: level["rps"])
+   results = {
+      "python": platform.python_version(),
+      "platform": platform.platform(),
+      "engine": args.engine,
+      "tokens_per_response": args.tokens,
+      "step_duration": args.step_duration,
+      "max_rps": best["rps"],
+      "max_rps_concurrency": best["concurrency"],
+      "levels": levels,
+      "startup": startup,
+   }
+   output = json.dumps(results, indent=2)
+   if args.output is not None:
+      with open(args.output, "w") as f:
+         f.write(output)
+   print(output, flush=True)
+
+def _run_level(url:str, body:bytes, concurrency:int, duration:float, engine:str="tasks") -> dict:
+   completed = 0
+   failed = 0
+   tokens = 0
+   send_gaps = LogHistogram()
+
+   async def on_request_end(session, trace_config_ctx, params):
+      # response headers received, compare to the time the server sent them
+      send_time = params.response.headers.get(SEND_TIME_HEADER)
+      if send_time is not None:
+         send_gaps.record(max(0.0, time.time() - float(send_time)))
+
+   trace_config = aiohttp.TraceConfig()
+   trace_config.on_request_end.append(on_request_end)
+
+   aggregator = _StatsAggregator(clients=concurrency, dump_duration=1, window_duration=duration, json_output=True, print_stats=False)
+   requester = OAIRequester("", url)
+
+   async def request_func(session:aiohttp.ClientSession):
+      nonlocal completed, failed, tokens
+      aggregator.record_new_request()
+      stats = await requester.call(session, body)
+      aggregator.aggregate_request(stats)
+      if stats.response_status_code == 200:
+         completed += 1
+         tokens += stats.generated_tokens or 0
+      else:
+         failed += 1
+
+   executer = AsyncHTTPExecuter(request_func, max_concurrency=concurrency, trace_configs=[trace_config], engine=engine)
+   cpu_start = time.process_time()
+   start = time.time()
+   aggregator.start()
+   executer.run(duration=duration)
+   aggregator.stop()
+   elapsed = time.time() - start
+   cpu = time.process_time() - cpu_start
+
+   snapshot = aggregator._snapshot()
+   return {
+      "concurrency": concurrency,
+      "requests": completed,
+      "failures": failed,
+      "elapsed": round(elapsed, 3),
+      "rps": round(completed / elapsed, 1),
+      "tokens_per_second": round(tokens / elapsed, 1),
+      "cpu_seconds_per_request": round(cpu / completed, 6) if completed > 0 else "n/a",
+      "cpu_us_per_token": round(1e6 * cpu / tokens, 3) if tokens > 0 else "n/a",
+      "client_cpu_utilization": round(cpu / elapsed, 3),
+      "header_send_gap": _summary(send_gaps, 6),
+      "ttft": snapshot["ttft"],
+      "e2e": snapshot["e2e"],
+   }
+
+def _startup_times(endpoint:str, runs:int) -> dict:
+   """
+   Runs each of STARTUP_COMMANDS runs times in a new process, and returns
+   the minimum, median and maximum wall time in seconds of each, from
+   process creation to exit.
+   """
+   root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+   env = dict(os.environ, **{HARNESS_KEY_ENV: "harness"})
+   times = {}
+   for name, command in STARTUP_COMMANDS.items():
+      command = [sys.executable, "-m", "benchmark.bench"] + [arg.replace("{endpoint}", endpoint) for arg in command]
+      samples = []
+      for _ in range(runs):
+         start = time.perf_counter()
+         subprocess.run(command, cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+         samples.append(time.perf_counter() - start)
+      samples.sort()
+      times[name] = {
+         "min": round(samples[0], 3),
+         "median": round(samples[len(samples) // 2], 3),
+         "max": round(samples[-1], 3),
+      }
+   return times
+
+def _serve(port:int):
+   from aiohttp import web
+   web.run_app(MockServer().app(), host="127.0.0.1", port=port, access_log=None, print=None)
+
+def _free_port() -> int:
+   with socket.socket() as s:
+      s.bind(("127.0.0.1", 0))
+      return s.getsockname()[1]
+
+def _wait_for_port(port:int):
+   deadline = time.time() + SERVER_START_TIMEOUT
+   while True:
+      try:
+         with socket.create_connection(("127.0.0.1", port), timeout=1):
+            return
+      except OSError:
+         if time.time() > deadline:
+            raise
+         time.sleep(0.1)
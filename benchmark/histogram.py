@@ -0,0 +1,123 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import math
+
+import numpy as np
+
+# Maximum relative error of values reported by histograms.
+HISTOGRAM_RELATIVE_ACCURACY = 0.01
+# Values at or below HISTOGRAM_MIN_VALUE are reported as 0.
+HISTOGRAM_MIN_VALUE = 1e-6
+# Values above HISTOGRAM_MAX_VALUE are reported as HISTOGRAM_MAX_VALUE.
+HISTOGRAM_MAX_VALUE = 1e6
+
+class HistogramLayout:
+   """
+   Logarithmic bucket layout shared by histograms that can be merged. Bucket 0
+   holds all values <= min_value, bucket i > 0 holds values in
+   (min_value * gamma^(i-1), min_value * gamma^i].
+   """
+   def __init__(self, relative_accuracy:float=HISTOGRAM_RELATIVE_ACCURACY, min_value:float=HISTOGRAM_MIN_VALUE, max_value:float=HISTOGRAM_MAX_VALUE):
+      self.relative_accuracy = relative_accuracy
+      self.min_value = min_value
+      self.max_value = max_value
+      self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+      self.log_gamma = math.log(self.gamma)
+      self.bucket_count = int(math.ceil(math.log(max_value / min_value) / self.log_gamma)) + 1
+      # representative value of each bucket, within relative_accuracy of all
+      # values that fall into that bucket.
+      self.bucket_values = np.empty(self.bucket_count, dtype=np.float64)
+      self.bucket_values[0] = 0.0
+      self.bucket_values[1:] = min_value * np.power(self.gamma, np.arange(1, self.bucket_count)) * 2 / (self.gamma + 1)
+
+   def index(self, value:float) -> int:
+      if value <= self.min_value:
+         return 0
+      return min(int(math.ceil(math.log(value / self.min_value) / self.log_gamma)), self.bucket_count - 1)
+
+   def indexes(self, values:np.ndarray) -> np.ndarray:
+      values = np.asarray(values, dtype=np.float64)
+      indexes = np.zeros(len(values), dtype=np.int64)
+      positive = values > self.min_value
+      indexes[positive] = np.ceil(np.log(values[positive] / self.min_value) / self.log_gamma)
+      return np.minimum(indexes, self.bucket_count - 1)
+
+   def __eq__(self, other) -> bool:
+      return (isinstance(other, HistogramLayout)
+         and self.relative_accuracy == other.relative_accuracy
+         and self.min_value == other.min_value
+         and self.max_value == other.max_value)
+
+DEFAULT_LAYOUT = HistogramLayout()
+
+class LogHistogram:
+   """
+   Mergeable histogram with logarithmic buckets. Recording is O(1) and
+   percentiles are computed from bucket counts, so their cost does not depend on
+   the number of recorded values. Average, min and max are exact.
+   """
+   def __init__(self, layout:HistogramLayout=DEFAULT_LAYOUT):
+      self.layout = layout
+      self.counts = np.zeros(layout.bucket_count, dtype=np.int64)
+      self.count = 0
+      self.sum = 0.0
+      self.min = math.inf
+      self.max = -math.inf
+
+   def record(self, value:float):
+      self.counts[self.layout.index(value)] += 1
+      self.count += 1
+      self.sum += value
+      if value < self.min:
+         self.min = value
+      if value > self.max:
+         self.max = value
+
+   def record_many(self, values:np.ndarray):
+      values = np.asarray(values, dtype=np.float64)
+      if len(values) == 0:
+         return
+      self.counts += np.bincount(self.layout.indexes(values), minlength=self.layout.bucket_count)
+      self.count += len(values)
+      self.sum += float(np.sum(values))
+      self.min = min(self.min, float(np.min(values)))
+      self.max = max(self.max, float(np.max(values)))
+
+   def merge(self, other:"LogHistogram"):
+      """
+      Adds all values recorded by other to this histogram.
+      """
+      if self.layout != other.layout:
+         raise ValueError("cannot merge histograms with different layouts")
+      self.counts += other.counts
+      self.count += other.count
+      self.sum += other.sum
+      self.min = min(self.min, other.min)
+      self.max = max(self.max, other.max)
+
+   def reset(self):
+      self.counts[:] = 0
+      self.count = 0
+      self.sum = 0.0
+      self.min = math.inf
+      self.max = -math.inf
+
+   def mean(self) -> float:
+      return self.sum / self.count if self.count > 0 else math.nan
+
+   def percentile(self, q:float) -> float:
+      """
+      Returns the q-th percentile, q in [0, 100], within the layout relative
+      accuracy.
+      """
+      return self.percentiles([q])[0]
+
+   def percentiles(self, qs:[float]) -> [float]:
+      if self.count == 0:
+         return [math.nan for _ in qs]
+      cumulative = np.cumsum(self.counts)
+      ranks = np.asarray(qs, dtype=np.float64) / 100.0 * (self.count - 1)
+      indexes = np.searchsorted(cumulative, ranks, side="right")
+      values = self.layout.bucket_values[np.minimum(indexes, self.layout.bucket_count - 1)]
+      return [float(v) for v in np.clip(values, self.min, self.max)]
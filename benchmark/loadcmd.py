@@ -1,26 +1,57 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+import asyncio
+import json
 import logging
-import math
 import os
+import random
 import sys
+import threading
 import time
 from typing import Iterable, Iterator
 
 import aiohttp
 import wonderwords
 
-from .asynchttpexecuter import AsyncHTTPExecuter
+from .asynchttpexecuter import AsyncHTTPExecuter, intended_start_time
+from .concurrency import AdaptiveConcurrency
+from .connectiontrace import connection_trace_config
+from .loadworkers import WorkerPool
 from .oairequester import OAIRequester
-from .oaitokenizer import num_tokens_from_messages
-from .ratelimiting import NoRateLimiter, RateLimiter
-from .statsaggregator import _StatsAggregator
+from .oaitokenizer import _encoding, num_tokens_from_messages
+from .prometheus import PROMETHEUS_HOST
+from .rawlog import RAW_LOG_SCHEMA_FILE
+from .ratelimiting import ArrivalScheduler, NoRateLimiter, RateLimiter, TokenRateLimiter
+from .retry import RetryBudget
+from .routing import Router, _parse_targets
+from .statsaggregator import STALL_THRESHOLD, _StatsAggregator
 
 
+# Default number of distinct prompts in the request builder pool.
+PROMPT_POOL_SIZE = 16
+# Placeholder for the unique per-request prefix in pre-serialized bodies.
+PREFIX_SLOT = "@@prefix@@"
+# Context and max tokens of each shape profile.
+SHAPE_PROFILES = {
+   "balanced": (500, 500),
+   "context": (2000, 200),
+   "generation": (500, 1000),
+}
+# Number of distinct random words the text prompts are cut from is sampled
+# from, and number of words added to the text at a time.
+TEXT_CHUNK_WORDS = 2000
+# Number of tokens of random text generated up front, longer prompts extend
+# the text the first time they are needed.
+INITIAL_TEXT_TOKENS = 8192
+
 class _RequestBuilder:
    """
-   Wrapper iterator class to build request payloads.
+   Wrapper iterator class to build request payloads. A pool of distinct
+   prompts is generated and serialized once, so building a request only
+   splices a unique prefix into a pre-serialized json body. The pool is
+   generated in a background thread, overlapping the rest of startup such
+   as connection pre-warming, and waited for on first use.
    """
    def __init__(self, model:str, context_tokens:int,
                 max_tokens:None, 
@@ -28,7 +59,8 @@ class _RequestBuilder:
                 frequency_penalty:None, 
                 presence_penalty:None, 
                 temperature:None, 
-                top_p:None):
+                top_p:None,
+                pool_size:int=PROMPT_POOL_SIZE):
       self.model = model
       self.context_tokens = context_tokens
       self.max_tokens = max_tokens
@@ -38,17 +70,69 @@ class _RequestBuilder:
       self.temperature = temperature
       self.top_p = top_p
 
-      logging.info("warming up prompt cache")
-      _generate_messages(self.model, self.context_tokens, self.max_tokens)
+      self.pool = []
+      self.pool_index = 0
+      self.pool_error = None
+      self.pool_ready = pool_size == 0
+      self.pool_thread = None
+      if pool_size > 0:
+         logging.info(f"warming up prompt pool of {pool_size} prompts")
+         self.pool_thread = threading.Thread(target=self._build_pool, args=(pool_size,), daemon=True)
+         self.pool_thread.start()
+
+   def _build_pool(self, pool_size:int):
+      try:
+         # prompts are cut from consecutive slices of one random text
+         text = _RandomText(self.model, initial_tokens=pool_size * self.context_tokens)
+         self.pool = [self._build_body(text, i * self.context_tokens) for i in range(pool_size)]
+      except Exception as e:
+         self.pool_error = e
+
+   def _wait_pool(self):
+      """
+      Waits for the prompt pool to be generated, raising its error if any.
+      """
+      if self.pool_ready:
+         return
+      self.pool_thread.join()
+      if self.pool_error is not None:
+         raise self.pool_error
+      self.pool_ready = True
+
+   def expected_tokens(self) -> float:
+      """
+      Returns the expected number of tokens used by a request: the average
+      context size plus max_tokens for each completion.
+      """
+      self._wait_pool()
+      context_tokens = sum(messages_tokens for _, messages_tokens in self.pool) / len(self.pool)
+      return context_tokens + (self.max_tokens or 0) * (self.completions or 1)
 
-   def __iter__(self) -> Iterator[dict]:
+   def __iter__(self) -> Iterator[bytes]:
       return self
 
-   def __next__(self) -> (dict, int):
-      messages, messages_tokens = _generate_messages(self.model, self.context_tokens, self.max_tokens)
+   def __next__(self) -> (bytes, int):
+      if not self.pool_ready:
+         self._wait_pool()
+      body_parts, messages_tokens = self.pool[self.pool_index]
+      self.pool_index = (self.pool_index + 1) % len(self.pool)
+      return _unique_prefix().encode().join(body_parts), messages_tokens
+
+   def _build_body(self, text:"_RandomText", offset:int) -> ([bytes], int):
+      """
+      Builds a serialized request body split around the prefix slots, with
+      a prompt cut from text at offset.
+      """
+      messages, messages_tokens = text.messages(self.context_tokens, self.max_tokens, offset=offset, exact=True)
+      return self._serialize(messages, self.max_tokens), messages_tokens
+
+   def _serialize(self, messages:[dict], max_tokens:int) -> [bytes]:
+      """
+      Serializes a request body with messages and max_tokens, split around the prefix slots.
+      """
       body = {"messages":messages}
-      if self.max_tokens is not None:
-         body["max_tokens"] = self.max_tokens
+      if max_tokens is not None:
+         body["max_tokens"] = max_tokens
       if self.completions is not None:
          body["n"] = self.completions
       if self.frequency_penalty is not None:
@@ -59,7 +143,9 @@ class _RequestBuilder:
          body["temperature"] = self.temperature
       if self.top_p is not None:
          body["top_p"] = self.top_p
-      return body, messages_tokens
+      # operate only in streaming mode so we can collect token stats.
+      body["stream"] = True
+      return json.dumps(body).encode().split(PREFIX_SLOT.encode())
 
 def load(args):
    try:
@@ -68,149 +154,471 @@ def load(args):
        print(f"invalid argument(s): {e}")
        sys.exit(1)
 
-   api_key = os.getenv(args.api_key_env)
-   url = args.api_base_endpoint[0] + "/openai/deployments/" + args.deployment + "/chat/completions"
+   if args.controller:
+      _run_load_agents(args)
+      return
+
+   if args.workers > 1:
+      _run_load_workers(args)
+      return
+
+   _run_load_args(args)
+
+def _run_load_workers(args):
+   aggregator = _StatsAggregator(
+      window_duration=args.aggregation_window,
+      dump_duration=1,
+      clients=args.clients,
+      json_output=args.output_format=="jsonl",
+      print_stats=args.output_format!="none",
+      raw_log_dir=args.raw_log,
+      stall_threshold=args.stall_threshold,
+      prometheus_port=args.prometheus_port,
+      prometheus_host=args.prometheus_host)
+   pool = WorkerPool(args, aggregator)
+
+   logging.info(f"starting load with {args.workers} workers...")
+
+   aggregator.start()
+   try:
+      pool.run()
+   finally:
+      # the aggregator thread would otherwise keep the process alive
+      aggregator.stop()
+
+   logging.info("finished load test")
+
+def _run_load_agents(args):
+   # local import, only controllers need the agent protocol
+   from .distributed import AgentController
+   aggregator = _StatsAggregator(
+      window_duration=args.aggregation_window,
+      dump_duration=1,
+      clients=args.clients,
+      json_output=args.output_format=="jsonl",
+      print_stats=args.output_format!="none",
+      stall_threshold=args.stall_threshold,
+      prometheus_port=args.prometheus_port,
+      prometheus_host=args.prometheus_host)
+   controller = AgentController(args, aggregator)
+   try:
+      controller.connect()
+   except (OSError, ValueError) as e:
+      print(f"unable to connect to agents: {e}")
+      sys.exit(1)
+
+   logging.info(f"starting load on {len(controller.agents)} agents...")
+
+   aggregator.start()
+   try:
+      controller.run()
+   finally:
+      aggregator.stop()
+
+   logging.info("finished load test")
+
+def _run_load_args(args, stats_sink=None, stop=None):
+   """
+   Runs load in the current process as configured by parsed load arguments.
+   The run drains once stop is set, see AsyncHTTPExecuter.
+   """
+   if args.replay is not None:
+      # local import, replay builds on _RequestBuilder defined here
+      from .tracereplay import TraceReplay
+      shard, shards = getattr(args, "replay_shard", (0, 1))
+      request_builder = TraceReplay(args.replay, "gpt-4-0613",
+         speed=args.replay_speed,
+         shard=shard,
+         shards=shards,
+         completions=args.completions,
+         frequency_penalty=args.frequency_penalty,
+         presence_penalty=args.presence_penalty,
+         temperature=args.temperature,
+         top_p=args.top_p)
+      rate_limiter = request_builder
+      logging.info(f"replaying {args.replay} at {args.replay_speed}x speed")
+   else:
+      request_builder = _build_request_builder(args)
+      rate_limiter = _build_rate_limiter(args, request_builder)
+
+   concurrency_controller = None
+   if args.adaptive_concurrency:
+      concurrency_controller = AdaptiveConcurrency(args.clients,
+         target_utilization=args.target_utilization,
+         max_ttft=args.adaptive_max_ttft)
+      logging.info(f"adapting concurrency up to {args.clients} clients, for utilization under {args.target_utilization}%")
+
+   logging.info("starting load...")
+
+   _run_load(request_builder,
+      max_concurrency=args.clients, 
+      requester=_build_requester(args),
+      rate_limiter=rate_limiter,
+      connection_options=_connection_options(args),
+      concurrency_controller=concurrency_controller,
+      request_count=args.requests,
+      duration=args.duration,
+      aggregation_duration=args.aggregation_window,
+      json_output=args.output_format=="jsonl",
+      print_stats=args.output_format!="none",
+      loop=args.loop,
+      engine=args.engine,
+      raw_log_dir=args.raw_log,
+      stall_threshold=args.stall_threshold,
+      prometheus_port=args.prometheus_port,
+      prometheus_host=args.prometheus_host,
+      stats_sink=stats_sink,
+      stop=stop)
+
+def _url(args) -> str:
+   url = args.api_base_endpoint + "/openai/deployments/" + args.deployment + "/chat/completions"
    url += "?api-version=" + args.api_version
+   return url
+
+def _build_requester(args):
+   """
+   Builds the requester of a run: an OAIRequester for a single deployment, or
+   a Router across the deployments of --targets.
+   """
+   backoff = args.retry == "exponential"
+   retry_budget = None
+   if backoff and args.retry_budget is not None:
+      logging.info(f"retrying up to {args.retry_budget} times per request on average")
+      retry_budget = RetryBudget(args.retry_budget)
+   if args.targets is not None:
+      targets = _parse_targets(args.targets, args.api_version, args.api_key_env)
+      logging.info(f"routing requests {args.routing} across {', '.join(t.name for t in targets)}")
+      return Router(targets, args.routing, backoff=backoff, retry_budget=retry_budget)
+   return OAIRequester(os.getenv(args.api_key_env), _url(args), backoff=backoff, retry_budget=retry_budget)
 
-   rate_limiter = NoRateLimiter()
+def _connection_options(args) -> dict:
+   """
+   Returns the connection pool options of AsyncHTTPExecuter set by arguments.
+   """
+   return {
+      "keepalive_timeout": args.keepalive_timeout,
+      "dns_cache_ttl": args.dns_cache_ttl if args.dns_cache_ttl >= 0 else None,
+      "limit_per_host": args.limit_per_host,
+      "prewarm_connections": args.prewarm_connections,
+   }
+
+def _build_rate_limiter(args, request_builder:"_RequestBuilder"):
+   if args.tpm is not None and args.tpm > 0:
+      expected_tokens = request_builder.expected_tokens()
+      logging.info(f"pacing requests for {args.tpm} tokens per minute, starting at {round(expected_tokens)} tokens per request")
+      return TokenRateLimiter(args.tpm, 60, expected_tokens)
    if args.rate is not None and args.rate > 0:
-      rate_limiter = RateLimiter(args.rate, 60)
+      if args.arrivals == "sliding":
+         return RateLimiter(args.rate, 60)
+      return ArrivalScheduler(args.rate, 60, arrivals=args.arrivals)
+   return NoRateLimiter()
+
+def _build_request_builder(args) -> "_RequestBuilder":
+   if args.workload is not None:
+      # local import, workloads build on _RequestBuilder defined here
+      from .workload import WorkloadBuilder, _parse_workload
+      classes = _parse_workload(args.workload)
+      logging.info(f"using workload {args.workload}: {', '.join(c.name for c in classes)}")
+      return WorkloadBuilder(classes, "gpt-4-0613",
+         completions=args.completions,
+         frequency_penalty=args.frequency_penalty,
+         presence_penalty=args.presence_penalty,
+         temperature=args.temperature,
+         top_p=args.top_p,
+         pool_size=args.prompt_pool_size)
 
    max_tokens = args.max_tokens
    context_tokens = args.context_tokens
-   if args.shape_profile == "balanced":
-      context_tokens = 500
-      max_tokens = 500
-   elif args.shape_profile == "context":
-      context_tokens = 2000
-      max_tokens = 200
-   elif args.shape_profile == "generation":
-      context_tokens = 500
-      max_tokens = 1000
+   if args.shape_profile in SHAPE_PROFILES:
+      context_tokens, max_tokens = SHAPE_PROFILES[args.shape_profile]
 
    logging.info(f"using shape profile {args.shape_profile}: context tokens: {context_tokens}, max tokens: {max_tokens}")
 
-   request_builder = _RequestBuilder("gpt-4-0613", context_tokens,
+   return _RequestBuilder("gpt-4-0613", context_tokens,
       max_tokens=max_tokens,
       completions=args.completions,
       frequency_penalty=args.frequency_penalty,
       presence_penalty=args.presence_penalty,
       temperature=args.temperature,
-      top_p=args.top_p)
-
-   logging.info("starting load...")
+      top_p=args.top_p,
+      pool_size=args.prompt_pool_size)
 
-   _run_load(request_builder,
-      max_concurrency=args.clients, 
-      api_key=api_key,
-      url=url,
-      rate_limiter=rate_limiter,
-      backoff=args.retry=="exponential",
-      request_count=args.requests,
-      duration=args.duration,
-      aggregation_duration=args.aggregation_window,
-      json_output=args.output_format=="jsonl")
-
-def _run_load(request_builder: Iterable[dict],
+def _run_load(request_builder: Iterable[bytes],
               max_concurrency: int, 
-              api_key: str,
-              url: str,
+              requester,
               rate_limiter=None, 
-              backoff=False,
+              connection_options=None,
+              concurrency_controller=None,
               duration=None, 
               aggregation_duration=60,
               request_count=None,
-              json_output=False):
-   aggregator = _StatsAggregator(
-      window_duration=aggregation_duration,
-      dump_duration=1, 
-      clients=max_concurrency,
-      json_output=json_output)
-   requester = OAIRequester(api_key, url, backoff=backoff)
+              json_output=False,
+              print_stats=True,
+              loop="asyncio",
+              engine="tasks",
+              raw_log_dir=None,
+              stall_threshold=STALL_THRESHOLD,
+              prometheus_port=None,
+              prometheus_host=PROMETHEUS_HOST,
+              stats_sink=None,
+              stop=None):
+   """
+   Runs load in the current process, sending requests with requester, either
+   an OAIRequester or a Router, over a connection pool configured by the
+   AsyncHTTPExecuter options in connection_options. Up to max_concurrency
+   requests run at once, or the limit of concurrency_controller if given,
+   with the execution engine of AsyncHTTPExecuter named by engine.
+   Stats are aggregated and printed by a new _StatsAggregator, unless
+   stats_sink is given, in which case they are handed to stats_sink and its
+   lifecycle is left to the caller. The run drains once stop is set.
+   """
+   aggregator = stats_sink
+   if aggregator is None:
+      aggregator = _StatsAggregator(
+         window_duration=aggregation_duration,
+         dump_duration=1, 
+         clients=max_concurrency,
+         json_output=json_output,
+         print_stats=print_stats,
+         raw_log_dir=raw_log_dir,
+         stall_threshold=stall_threshold,
+         prometheus_port=prometheus_port,
+         prometheus_host=prometheus_host)
 
    async def request_func(session:aiohttp.ClientSession):
       nonlocal aggregator
       nonlocal requester
       request_body, messages_tokens = request_builder.__next__()
+      # builders mixing several workload classes tell the class of the last request
+      workload_class = getattr(request_builder, "workload_class", None)
       aggregator.record_new_request()
       stats = await requester.call(session, request_body)
       stats.context_tokens = messages_tokens
+      stats.intended_start_time = intended_start_time.get()
+      stats.workload_class = workload_class
+      # failed requests keep their estimated cost, so that throttling
+      # does not speed up the request rate
+      if isinstance(rate_limiter, TokenRateLimiter) and stats.response_status_code == 200:
+         rate_limiter.record_usage(stats.context_tokens + (stats.generated_tokens or 0))
+      if concurrency_controller is not None:
+         concurrency_controller.record(stats)
       try:
          aggregator.aggregate_request(stats)
       except Exception as e:
          print(e)
+      if concurrency_controller is not None and stats.response_status_code == 429 and stats.retry_after is not None:
+         # a throttled request holds its slot for the delay the service asked
+         # for, so that throttling slows requests down rather than speeding them up
+         await asyncio.sleep(stats.retry_after)
 
+   # requests go to the url of the requester, or of each of its targets
+   urls = [t.url for t in requester.targets] if isinstance(requester, Router) else [requester.url]
    executer = AsyncHTTPExecuter(
       request_func, 
       rate_limiter=rate_limiter, 
-      max_concurrency=max_concurrency)
+      max_concurrency=max_concurrency,
+      trace_configs=[connection_trace_config()],
+      loop_lag_callback=aggregator.record_loop_lag,
+      loop=loop,
+      engine=engine,
+      prewarm_urls=urls,
+      concurrency_controller=concurrency_controller,
+      stop=stop,
+      **(connection_options or {}))
 
-   aggregator.start()
-   executer.run(
-      call_count=request_count, 
-      duration=duration)
-   aggregator.stop()
+   if stats_sink is None:
+      aggregator.start()
+   try:
+      executer.run(
+         call_count=request_count, 
+         duration=duration)
+   finally:
+      if stats_sink is None:
+         aggregator.stop()
+   if stats_sink is None:
+      logging.info("finished load test")
 
-   logging.info("finished load test")
+def _unique_prefix() -> str:
+   # fixed width, so that every prefix encodes to the same number of tokens
+   return f"{time.time():.6f}"
+
+def _with_prefix(messages:[dict], prefix:str) -> [dict]:
+   return [{k: v.replace(PREFIX_SLOT, prefix) for k, v in m.items()} for m in messages]
 
-CACHED_PROMPT=""
-CACHED_MESSAGES_TOKENS=0
-def _generate_messages(model:str, tokens:int, max_tokens:int=None) -> ([dict], int):
+class _RandomText:
    """
-   Generate `messages` array based on tokens and max_tokens.
-   Returns Tuple of messages array and actual context token count.
+   Long random text that prompts of any size are cut from, so building a
+   prompt costs one decode instead of generating and counting random words.
    """
-   global CACHED_PROMPT
-   global CACHED_MESSAGES_TOKENS
-   try:
-      r = wonderwords.RandomWord()
-      messages = [{"role":"user", "content":str(time.time()) + " "}]
+   def __init__(self, model:str, initial_tokens:int=INITIAL_TEXT_TOKENS):
+      self.model = model
+      self.tokens = []
+      # stand-in for the unique prefix when counting tokens, it has the
+      # same digits and separator, so encodes to the same number of tokens.
+      self.counting_prefix = "".join("0" if c.isdigit() else c for c in _unique_prefix())
+      # words texts are sampled from, drawn once as drawing is slow
+      self.vocabulary = None
+      self._extend(initial_tokens)
+
+   def messages(self, tokens:int, max_tokens:int=None, offset:int=0, exact:bool=False) -> ([dict], int):
+      """
+      Builds messages of tokens context tokens, with a prompt cut from the
+      text at offset. Message contents start with PREFIX_SLOT, to be replaced
+      with a unique prefix for every request.
+      Cutting may split a word whose halves encode differently, so the count
+      is exact up to a few tokens, unless exact is set, in which case the
+      messages are counted again and extended until they reach tokens.
+      Returns Tuple of messages array and context token count.
+      """
+      messages = [{"role":"user", "content":PREFIX_SLOT + " "}]
       if max_tokens is not None:
-         messages.append({"role":"user", "content":str(time.time()) + f" write a long essay about life in at least {max_tokens} tokens"})
-      messages_tokens = 0
-
-      if len(CACHED_PROMPT) > 0:
-         messages[0]["content"] += CACHED_PROMPT
-         messages_tokens = CACHED_MESSAGES_TOKENS
-      else:
-         prompt = ""
-         base_prompt = messages[0]["content"]
-         while True:
-            messages_tokens = num_tokens_from_messages(messages, model)
-            remaining_tokens = tokens - messages_tokens
-            if remaining_tokens <= 0:
-               break
-            prompt += " ".join(r.random_words(amount=math.ceil(remaining_tokens/4))) + " "
-            messages[0]["content"] = base_prompt + prompt
-
-         CACHED_PROMPT = prompt
-         CACHED_MESSAGES_TOKENS = messages_tokens
-
-   except Exception as e:
-      print (e)
-
-   return (messages, messages_tokens)
+         messages.append({"role":"user", "content":PREFIX_SLOT + f" write a long essay about life in at least {max_tokens} tokens"})
+      base_prompt = messages[0]["content"]
+      overhead = num_tokens_from_messages(_with_prefix(messages, self.counting_prefix), self.model)
+      prompt_tokens = max(0, tokens - overhead)
+      while True:
+         self._extend(offset + prompt_tokens)
+         messages[0]["content"] = base_prompt + _encoding(self.model).decode(self.tokens[offset:offset + prompt_tokens])
+         if not exact:
+            return messages, overhead + prompt_tokens
+         messages_tokens = num_tokens_from_messages(_with_prefix(messages, self.counting_prefix), self.model)
+         if messages_tokens >= tokens:
+            return messages, messages_tokens
+         prompt_tokens += tokens - messages_tokens
+
+   def _extend(self, tokens:int):
+      encoding = _encoding(self.model)
+      if len(self.tokens) < tokens and self.vocabulary is None:
+         # loading the word list takes a while, so it is only loaded here
+         self.vocabulary = wonderwords.RandomWord().random_words(amount=TEXT_CHUNK_WORDS)
+      while len(self.tokens) < tokens:
+         words = random.choices(self.vocabulary, k=TEXT_CHUNK_WORDS)
+         self.tokens.extend(encoding.encode_ordinary(" ".join(words) + " "))
+
+class _BackgroundText:
+   """
+   _RandomText generated in a background thread, as loading the word list
+   takes a while, and waited for on first use.
+   """
+   def __init__(self, model:str):
+      self.model = model
+      self.text = None
+      self.error = None
+      self.thread = threading.Thread(target=self._build, daemon=True)
+      self.thread.start()
+
+   def _build(self):
+      try:
+         self.text = _RandomText(self.model)
+      except Exception as e:
+         self.error = e
+
+   def get(self) -> _RandomText:
+      if self.text is None:
+         self.thread.join()
+         if self.error is not None:
+            raise self.error
+      return self.text
 
 def _validate(args):
-    if len(args.api_version) == 0:
-      raise ValueError("api-version is required")
-    if len(args.api_key_env) == 0:
-       raise ValueError("api-key-env is required")
-    if os.getenv(args.api_key_env) is None:
-       raise ValueError(f"api-key-env {args.api_key_env} not set")
-    if args.clients < 1:
-       raise ValueError("clients must be > 0")
+    _validate_request(args)
+    if args.workers < 1:
+       raise ValueError("workers must be > 0")
+    if args.clients < args.workers:
+       raise ValueError("clients must be >= workers")
     if args.requests is not None and args.requests < 0:
        raise ValueError("requests must be > 0")
     if args.duration is not None and args.duration != 0 and args.duration < 30:
        raise ValueError("duration must be > 30")
     if args.rate is not None and  args.rate < 0:
        raise ValueError("rate must be > 0")
-    if args.shape_profile == "custom":
-       if args.context_tokens < 1:
+    if args.tpm is not None and args.tpm < 0:
+       raise ValueError("tpm must be > 0")
+    if args.tpm is not None and args.rate is not None:
+       raise ValueError("only one of rate and tpm can be set")
+    if args.arrivals != "sliding" and (args.rate is None or args.rate == 0):
+       raise ValueError(f"arrivals {args.arrivals} requires rate")
+    if args.replay is not None:
+       # agents of a controller read replay traces from their data directory
+       if not args.controller and not os.path.isfile(args.replay):
+          raise ValueError(f"replay trace {args.replay} not found")
+       if args.rate is not None or args.tpm is not None:
+          raise ValueError("replay sends requests on the recorded schedule, rate and tpm cannot be set")
+    if args.target_utilization <= 0:
+       raise ValueError("target-utilization must be > 0")
+    if args.adaptive_max_ttft is not None and args.adaptive_max_ttft <= 0:
+       raise ValueError("adaptive-max-ttft must be > 0")
+    if args.prometheus_port is not None and (args.prometheus_port < 0 or args.prometheus_port > 65535):
+       raise ValueError("prometheus-port must be between 0 and 65535")
+    if args.stall_threshold <= 0:
+       raise ValueError("stall-threshold must be > 0")
+    if args.replay_speed <= 0:
+       raise ValueError("replay-speed must be > 0")
+    if args.raw_log is not None and os.path.exists(os.path.join(args.raw_log, RAW_LOG_SCHEMA_FILE)):
+       raise ValueError(f"raw-log {args.raw_log} already holds a raw log")
+    if args.controller:
+       if args.agents is None:
+          raise ValueError("controller requires agents")
+       if args.workers > 1:
+          raise ValueError("workers cannot be combined with controller, set workers on each agent instead")
+       if args.raw_log is not None:
+          raise ValueError("raw-log cannot be combined with controller, set raw-log on each agent instead")
+       # local import, only controllers need the agent protocol
+       from .distributed import _parse_agents
+       if args.clients < len(_parse_agents(args.agents)):
+          raise ValueError("clients must be >= agents")
+       if not os.getenv(args.agent_token_env):
+          raise ValueError(f"agent-token-env {args.agent_token_env} not set")
+    elif args.agents is not None:
+       raise ValueError("agents requires controller")
+
+def _validate_request(args):
+    """
+    Validates arguments shared by all subcommands sending requests.
+    """
+    controller = getattr(args, "controller", False)
+    if len(args.api_version) == 0:
+      raise ValueError("api-version is required")
+    if len(args.api_key_env) == 0:
+       raise ValueError("api-key-env is required")
+    if args.targets is not None:
+       if args.api_base_endpoint is not None or args.deployment is not None:
+          raise ValueError("api_base_endpoint and deployment cannot be combined with targets")
+       # agents of a controller read targets and api keys on their own host
+       if not controller:
+          _parse_targets(args.targets, args.api_version, args.api_key_env)
+    else:
+       if args.api_base_endpoint is None or args.deployment is None:
+          raise ValueError("api_base_endpoint and deployment are required, unless targets is set")
+       if not controller and os.getenv(args.api_key_env) is None:
+          raise ValueError(f"api-key-env {args.api_key_env} not set")
+    if args.clients < 1:
+       raise ValueError("clients must be > 0")
+    # agents of a controller read workload files from their data directory
+    if args.workload is not None and (not controller or ":" in args.workload):
+       # local import, workloads build on _RequestBuilder defined here
+       from .workload import _parse_workload
+       _parse_workload(args.workload)
+    if args.shape_profile == "custom" and args.workload is None:
+       if args.context_tokens is None or args.context_tokens < 1:
           raise ValueError("context-tokens must be specified with shape=custom")
     if args.max_tokens is not None and args.max_tokens < 0:
        raise ValueError("max-tokens must be > 0")
+    if args.loop == "uvloop":
+       try:
+          import uvloop
+       except ImportError:
+          raise ValueError("loop uvloop requires uvloop package, install it with: pip install uvloop")
+    if args.retry_budget is not None and args.retry_budget < 0:
+       raise ValueError("retry-budget must be >= 0")
+    if args.keepalive_timeout < 0:
+       raise ValueError("keepalive-timeout must be >= 0")
+    if args.limit_per_host < 0:
+       raise ValueError("limit-per-host must be >= 0")
+    if args.prewarm_connections < 0:
+       raise ValueError("prewarm-connections must be >= 0")
+    if args.prompt_pool_size < 1:
+       raise ValueError("prompt-pool-size must be > 0")
     if args.completions < 1:
        raise ValueError("completions must be > 0")
     if args.frequency_penalty is not None and (args.frequency_penalty < -2 or args.frequency_penalty > 2):
@@ -0,0 +1,196 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import collections
+import copy
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+
+from .oairequester import RequestStats
+from .statsaggregator import _StatsAggregator
+
+# Interval in seconds at which workers forward collected stats to the parent.
+WORKER_FLUSH_INTERVAL = 0.1
+
+class _QueueStatsSink:
+   """
+   Stats sink used inside worker processes. It exposes the same ingestion
+   interface as _StatsAggregator, but forwards batches of stats to the parent
+   process through a multiprocessing queue from a background thread, so the
+   worker event loop never waits on inter-process communication.
+   """
+   def __init__(self, stats_queue, flush_interval:float=WORKER_FLUSH_INTERVAL):
+      self.stats_queue = stats_queue
+      self.flush_interval = flush_interval
+      self.pending = collections.deque()
+      self.pending_loop_lags = collections.deque()
+      self.terminate = threading.Event()
+      self.thread = threading.Thread(target=self._flush_loop, daemon=True)
+
+   def start(self):
+      self.thread.start()
+
+   def stop(self):
+      self.terminate.set()
+      self.thread.join()
+      self._flush()
+
+   def record_new_request(self):
+      self.pending.append(None)
+
+   def aggregate_request(self, stats: RequestStats):
+      self.pending.append(stats)
+
+   def record_loop_lag(self, timestamp:float, lag:float):
+      self.pending_loop_lags.append((timestamp, lag))
+
+   def _flush_loop(self):
+      while not self.terminate.wait(self.flush_interval):
+         self._flush()
+
+   def _flush(self):
+      new_requests = 0
+      batch = []
+      while len(self.pending) > 0:
+         stats = self.pending.popleft()
+         if stats is None:
+            new_requests += 1
+         else:
+            batch.append(_picklable(stats))
+      loop_lags = [self.pending_loop_lags.popleft() for _ in range(len(self.pending_loop_lags))]
+      if new_requests > 0 or len(batch) > 0 or len(loop_lags) > 0:
+         self.stats_queue.put((new_requests, batch, loop_lags))
+
+def _picklable(stats: RequestStats) -> RequestStats:
+   # Exceptions raised by aiohttp carry request state that cannot always be
+   # pickled, so only their description crosses the process boundary.
+   if stats.last_exception is not None:
+      stats = copy.copy(stats)
+      stats.last_exception = RuntimeError(repr(stats.last_exception))
+   return stats
+
+def _split(total:int, parts:int, index:int) -> int:
+   """
+   Returns the share of total assigned to part index, spreading the remainder
+   over the first parts.
+   """
+   return total // parts + (1 if index < total % parts else 0)
+
+def _worker_args(args, index:int, workers:int):
+   worker_args = copy.copy(args)
+   worker_args.workers = 1
+   worker_args.clients = _split(args.clients, workers, index)
+   if args.requests is not None:
+      worker_args.requests = _split(args.requests, workers, index)
+   if args.rate is not None:
+      worker_args.rate = args.rate / workers
+   if args.tpm is not None:
+      worker_args.tpm = args.tpm / workers
+   # every worker replays its own share of the trace records, within the
+   # share of the agent it runs on, if any
+   shard, shards = getattr(args, "replay_shard", (0, 1))
+   worker_args.replay_shard = (shard + index * shards, shards * workers)
+   return worker_args
+
+def _worker_main(args, index:int, workers:int, stats_queue, stop):
+   logging.basicConfig(level=logging.INFO, format=f"%(asctime)s %(levelname)-8s [worker {index}] %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+   # local import to avoid a circular dependency with loadcmd
+   from .loadcmd import _run_load_args
+
+   args = _worker_args(args, index, workers)
+   sink = _QueueStatsSink(stats_queue)
+   sink.start()
+   try:
+      if args.clients > 0 and (args.requests is None or args.requests > 0):
+         _run_load_args(args, stats_sink=sink, stop=stop)
+   finally:
+      sink.stop()
+      # signal parent that this worker will not produce any more stats
+      stats_queue.put(None)
+
+class WorkerPool:
+   """
+   Runs load generation in several processes and merges their per-request
+   stats into a single aggregator running in the parent process.
+   """
+   def __init__(self, args, aggregator: _StatsAggregator, stop:threading.Event=None):
+      """
+      :param args: parsed load command arguments, rate, clients and requests are
+                   spread over args.workers processes.
+      :param aggregator: aggregator receiving the stats of all workers.
+      :param stop: optional event that drains all workers once set, as a terminate signal does.
+      """
+      self.args = args
+      self.workers = args.workers
+      self.aggregator = aggregator
+      self.stop = stop
+      self.terminate = False
+
+   def run(self):
+      """
+      Starts all workers and blocks until all of them finished.
+      """
+      ctx = multiprocessing.get_context("spawn")
+      stats_queue = ctx.Queue()
+      # set when stop is, for workers to drain without being signaled
+      workers_stop = ctx.Event()
+      processes = [
+         ctx.Process(target=_worker_main, args=(self.args, i, self.workers, stats_queue, workers_stop), daemon=True)
+         for i in range(self.workers)]
+
+      orig_sigint_handler = signal.signal(signal.SIGINT, self._terminate)
+      orig_sigterm_handler = signal.signal(signal.SIGTERM, self._terminate)
+      try:
+         for p in processes:
+            p.start()
+         logging.info(f"started {self.workers} load workers")
+         self._collect(stats_queue, processes, workers_stop)
+         for p in processes:
+            p.join()
+      finally:
+         signal.signal(signal.SIGINT, orig_sigint_handler)
+         signal.signal(signal.SIGTERM, orig_sigterm_handler)
+
+   def _collect(self, stats_queue, processes:list, workers_stop):
+      # queues must be drained before joining processes that write to them
+      running = len(processes)
+      while running > 0:
+         if self.stop is not None and self.stop.is_set() and not workers_stop.is_set():
+            logging.warning("asked to stop, draining workers")
+            workers_stop.set()
+         try:
+            item = stats_queue.get(timeout=1)
+         except queue.Empty:
+            if not any(p.is_alive() for p in processes):
+               logging.warning("all workers exited without completing")
+               return
+            continue
+         if item is None:
+            running -= 1
+            continue
+         new_requests, batch, loop_lags = item
+         for _ in range(new_requests):
+            self.aggregator.record_new_request()
+         for timestamp, lag in loop_lags:
+            self.aggregator.record_loop_lag(timestamp, lag)
+         for stats in batch:
+            try:
+               self.aggregator.aggregate_request(stats)
+            except Exception:
+               logging.exception("unable to aggregate worker request stats")
+
+   def _terminate(self, signum, *args):
+      if not self.terminate:
+         logging.warning("got terminate signal, draining workers. signal again to exit immediately.")
+         self.terminate = True
+         # workers in the same process group already received SIGINT
+         if signum != signal.SIGINT:
+            for child in multiprocessing.active_children():
+               os.kill(child.pid, signum)
+      else:
+         logging.info("forcing program exit")
+         os._exit(0)
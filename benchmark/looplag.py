@@ -0,0 +1,40 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import asyncio
+import time
+from typing import Callable
+
+# Interval in seconds between two event loop lag probes.
+LOOP_LAG_PROBE_INTERVAL = 0.01
+
+class LoopLagProbe:
+   """
+   Measures event loop lag, the delay between the time a callback was scheduled
+   to run and the time it actually ran, with a periodic scheduled callback.
+   Every sample is reported to callback(timestamp, lag_seconds).
+   """
+   def __init__(self, callback: Callable[[float, float], None], interval:float=LOOP_LAG_PROBE_INTERVAL):
+      self.callback = callback
+      self.interval = interval
+      self.loop = None
+      self.handle = None
+      self.scheduled_time = 0.0
+
+   def start(self, loop:asyncio.AbstractEventLoop):
+      self.loop = loop
+      self._schedule()
+
+   def stop(self):
+      if self.handle is not None:
+         self.handle.cancel()
+         self.handle = None
+
+   def _schedule(self):
+      self.scheduled_time = self.loop.time() + self.interval
+      self.handle = self.loop.call_at(self.scheduled_time, self._probe)
+
+   def _probe(self):
+      lag = max(0.0, self.loop.time() - self.scheduled_time)
+      self.callback(time.time(), lag)
+      self._schedule()
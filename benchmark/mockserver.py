@@ -0,0 +1,174 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import asyncio
+import json
+import logging
+import threading
+import time
+import uuid
+
+from aiohttp import web
+
+from .oairequester import REQUEST_ID_HEADER, RETRY_AFTER_MS_HEADER, UTILIZATION_HEADER
+
+# Number of tokens generated when a request does not set max_tokens.
+DEFAULT_GENERATED_TOKENS = 100
+# Rough number of characters per token used to estimate prompt size.
+CHARS_PER_TOKEN = 4
+# Response header with the server time at which response headers were sent.
+SEND_TIME_HEADER = "x-mock-send-time"
+
+class CapacityModel:
+   """
+   Leaky bucket model of a provisioned deployment. Every admitted request adds
+   its prompt and max generated tokens to the bucket, which drains at
+   capacity_tpm tokens per minute. Utilization is the bucket level relative to
+   one minute of capacity, and requests are rejected while it is above 100%.
+   """
+   def __init__(self, capacity_tpm:float):
+      """
+      :param capacity_tpm: deployment capacity in tokens per minute.
+      """
+      self.capacity = capacity_tpm
+      self.drain_rate = capacity_tpm / 60.0
+      self.level = 0.0
+      self.last_update = time.monotonic()
+
+   def _drain(self):
+      now = time.monotonic()
+      self.level = max(0.0, self.level - (now - self.last_update) * self.drain_rate)
+      self.last_update = now
+
+   def utilization(self) -> float:
+      self._drain()
+      return 100.0 * self.level / self.capacity
+
+   def admit(self, tokens:int) -> (bool, float):
+      """
+      Tries to admit a request costing tokens.
+      Returns Tuple of whether request was admitted and the time in seconds
+      until utilization drops back under 100%.
+      """
+      self._drain()
+      if self.level >= self.capacity:
+         return False, (self.level - self.capacity) / self.drain_rate
+      self.level += tokens
+      return True, 0.0
+
+class MockServer:
+   """
+   Local stand-in for an Azure OpenAI deployment. Answers streaming chat
+   completions with synthetic tokens after configurable delays, and reports
+   utilization and throttling according to a CapacityModel.
+   """
+   def __init__(self, ttft:float=0.0, token_delay:float=0.0, capacity_tpm:float=None, default_max_tokens:int=DEFAULT_GENERATED_TOKENS):
+      """
+      :param ttft: delay in seconds before the response is sent.
+      :param token_delay: delay in seconds between two generated tokens.
+      :param capacity_tpm: simulated capacity in tokens per minute, unlimited if None.
+      :param default_max_tokens: number of tokens generated when request sets no max_tokens.
+      """
+      self.ttft = ttft
+      self.token_delay = token_delay
+      self.capacity = CapacityModel(capacity_tpm) if capacity_tpm else None
+      self.default_max_tokens = default_max_tokens
+
+   def app(self) -> web.Application:
+      app = web.Application()
+      app.router.add_post("/openai/deployments/{deployment}/chat/completions", self._chat_completions)
+      return app
+
+   def start_in_thread(self, host:str="127.0.0.1", port:int=0) -> str:
+      """
+      Serves the mock endpoint from a background thread with its own event
+      loop, useful in tests. Use stop() to shut it down.
+      Returns the base endpoint url.
+      """
+      started = threading.Event()
+      self.loop = asyncio.new_event_loop()
+      self.runner = web.AppRunner(self.app(), access_log=None)
+
+      def serve():
+         asyncio.set_event_loop(self.loop)
+         self.loop.run_until_complete(self.runner.setup())
+         site = web.TCPSite(self.runner, host, port)
+         self.loop.run_until_complete(site.start())
+         self.port = site._server.sockets[0].getsockname()[1]
+         started.set()
+         self.loop.run_forever()
+         self.loop.run_until_complete(self.runner.cleanup())
+         self.loop.close()
+
+      self.thread = threading.Thread(target=serve, daemon=True)
+      self.thread.start()
+      started.wait()
+      return f"http://{host}:{self.port}"
+
+   def stop(self):
+      self.loop.call_soon_threadsafe(self.loop.stop)
+      self.thread.join()
+
+   async def _chat_completions(self, request: web.Request) -> web.StreamResponse:
+      try:
+         body = json.loads(await request.read())
+      except ValueError:
+         return web.json_response({"error": {"code": "BadRequest", "message": "invalid json body"}}, status=400)
+
+      max_tokens = body.get("max_tokens") or self.default_max_tokens
+      choices = body.get("n") or 1
+      prompt_chars = sum(len(m.get("content") or "") for m in body.get("messages", []))
+      cost = prompt_chars // CHARS_PER_TOKEN + max_tokens * choices
+
+      headers = {REQUEST_ID_HEADER: str(uuid.uuid4())}
+      if self.capacity is not None:
+         admitted, retry_after = self.capacity.admit(cost)
+         headers[UTILIZATION_HEADER] = f"{round(self.capacity.utilization(), 1)}%"
+         if not admitted:
+            headers[RETRY_AFTER_MS_HEADER] = str(int(retry_after * 1000) + 1)
+            headers["retry-after"] = str(int(retry_after) + 1)
+            return web.json_response({"error": {"code": "429", "message": "Requests to the deployment have exceeded the provisioned capacity."}}, status=429, headers=headers)
+      else:
+         headers[UTILIZATION_HEADER] = "0.0%"
+
+      if self.ttft > 0:
+         await asyncio.sleep(self.ttft)
+      response = web.StreamResponse(headers=headers)
+      response.content_type = "text/event-stream"
+      response.headers[SEND_TIME_HEADER] = repr(time.time())
+      await response.prepare(request)
+      # azure sends prompt filter results ahead of any choices
+      await response.write(_event({"id": "", "object": "", "created": 0, "model": "", "choices": []}))
+      await response.write(b"".join(_event(_chunk(i, {"role": "assistant", "content": ""})) for i in range(choices)))
+      for t in range(max_tokens):
+         if t > 0 and self.token_delay > 0:
+            await asyncio.sleep(self.token_delay)
+         await response.write(b"".join(_event(_chunk(i, {"content": "token"})) for i in range(choices)))
+      await response.write(b"".join(_event(_chunk(i, {}, "length")) for i in range(choices)))
+      await response.write(b"data: [DONE]\n\n")
+      await response.write_eof()
+      return response
+
+def _chunk(index:int, delta:dict, finish_reason:str=None) -> dict:
+   return {
+      "id": "chatcmpl-mock",
+      "object": "chat.completion.chunk",
+      "created": int(time.time()),
+      "model": "gpt-4",
+      "choices": [{"index": index, "finish_reason": finish_reason, "delta": delta}],
+   }
+
+def _event(data:dict) -> bytes:
+   return b"data: " + json.dumps(data).encode() + b"\n\n"
+
+def mock_server(args):
+   """
+   Runs a mock Azure OpenAI deployment endpoint until killed.
+   """
+   server = MockServer(
+      ttft=args.ttft,
+      token_delay=args.token_delay,
+      capacity_tpm=args.capacity_tpm,
+      default_max_tokens=args.default_max_tokens)
+   logging.info(f"serving mock deployment endpoint on http://{args.host}:{args.port}")
+   web.run_app(server.app(), host=args.host, port=args.port, access_log=None, print=None)
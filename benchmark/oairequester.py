@@ -2,42 +2,105 @@
 # Licensed under the MIT License.
 
 import asyncio
+import collections
 import logging
+import re
 import time
-from typing import Optional
+from array import array
+from typing import Optional, Union
 
 import aiohttp
-import backoff
+import numpy as np
+
+from .retry import MAX_RETRY_SECONDS, RetryBudget, backoff_delay
 
 # TODO: switch to using OpenAI client library once new headers are exposed.
 
 REQUEST_ID_HEADER = "apim-request-id"
 UTILIZATION_HEADER = "azure-openai-deployment-utilization"
 RETRY_AFTER_MS_HEADER = "retry-after-ms"
-MAX_RETRY_SECONDS = 60.0
 
 TELEMETRY_USER_AGENT_HEADER = "x-ms-useragent"
 USER_AGENT = "aoai-benchmark"
 
+# Non-empty content of a streamed chat completion chunk. Role, finish and
+# content filter chunks carry no content or an empty one. Quotes inside
+# content are escaped, so the pattern cannot match within generated text.
+_CONTENT_PATTERN = re.compile(rb'"content": ?"[^"]')
+# Choice index of a streamed chat completion chunk.
+_INDEX_PATTERN = re.compile(rb'"index": ?(\d+)')
+
+# Outcome of one attempt of a request: start and end time, and status code,
+# 0 if the attempt failed without a response.
+Attempt = collections.namedtuple("Attempt", ["start_time", "end_time", "status"])
+
 class RequestStats:
     """
-    Statistics collected for a particular AOAI request.
+    Statistics collected for a particular AOAI request. Response times and
+    tokens are those of the last attempt, timed from request_start_time.
     """
     def __init__(self):
+        # start of the first and of the last attempt
+        self.first_attempt_time: Optional[float] = None
         self.request_start_time: Optional[float] = None
+        self.intended_start_time: Optional[float] = None
+        self.workload_class: Optional[str] = None
+        # name of the target that served the request, when routing across several
+        self.endpoint: Optional[str] = None
         self.response_status_code: int = 0
         self.response_time: Optional[float] = None
         self.first_token_time: Optional[float] = None
         self.response_end_time: Optional[float] = None
         self.context_tokens: int = 0
         self.generated_tokens: Optional[int] = None
+        # arrival time and choice index of every generated token
+        self.token_times = array('d')
+        self.token_choices = array('H')
         self.deployment_utilization: Optional[float] = None
+        # connection timings of the last call, see connection_trace_config:
+        # host resolution, TCP connect and TLS handshake of a new connection,
+        # and time from sending the request to receiving response headers.
+        self.dns_time: Optional[float] = None
+        self.connect_time: Optional[float] = None
+        self.headers_time: Optional[float] = None
+        self.new_connection: Optional[bool] = None
         self.calls: int = 0
+        self.attempts: list[Attempt] = []
+        # seconds from the first attempt to the end of the last one, the
+        # time a user waited for the request, retries included
+        self.total_time: Optional[float] = None
+        # delay in seconds asked by the last throttled response, if any
+        self.retry_after: Optional[float] = None
         self.last_exception: Optional[Exception] = None
 
-def _terminal_http_code(e) -> bool:
-    # we only retry on 429
-    return e.response.status != 429
+    def token_gaps(self) -> np.ndarray:
+        """
+        Returns the time in seconds between consecutive generated tokens of
+        each choice.
+        """
+        times = np.frombuffer(self.token_times, dtype=np.float64)
+        if len(times) < 2:
+            return np.empty(0)
+        choices = np.frombuffer(self.token_choices, dtype=np.uint16)
+        if not choices.any():
+            return np.diff(times)
+        # tokens of each choice keep their arrival order within a stable sort
+        order = np.argsort(choices, kind="stable")
+        gaps = np.diff(times[order])
+        # drop gaps between the last token of a choice and the first of the next
+        return gaps[choices[order][1:] == choices[order][:-1]]
+
+def _content_choice(line: bytes) -> int:
+    """
+    Returns the choice index of a server-sent event line carrying a generated
+    token, or -1 for any other line, such as role, empty, finish or content
+    filter chunks and the [DONE] sentinel. Lines are scanned rather than
+    parsed as json, which would dominate the cost of reading the stream.
+    """
+    if not line.startswith(b'data:') or _CONTENT_PATTERN.search(line) is None:
+        return -1
+    match = _INDEX_PATTERN.search(line)
+    return int(match.group(1)) if match is not None else 0
 
 class OAIRequester:
     """
@@ -46,89 +109,144 @@ class OAIRequester:
     :param api_key: Azure OpenAI resource endpoint key.
     :param url: Full deployment URL in the form of https://<resource>.openai.azure.com/openai/deployments/<deployment>/chat/completins?api-version=<api_version>
     :param backoff: Whether to retry throttled or unsuccessful requests.
+    :param retry_budget: Optional budget retries are withdrawn from, shared by all requesters of a run.
     """
-    def __init__(self, api_key: str, url: str, backoff=False):
+    def __init__(self, api_key: str, url: str, backoff=False, retry_budget: Optional[RetryBudget]=None):
         self.api_key = api_key
         self.url = url
         self.backoff = backoff
+        self.retry_budget = retry_budget
 
-    async def call(self, session:aiohttp.ClientSession, body: dict) -> RequestStats:
+    async def call(self, session:aiohttp.ClientSession, body: Union[dict, bytes], new_request=True) -> RequestStats:
         """
         Makes a single call with body and returns statistics. The function
         forces the request in streaming mode to be able to collect token
         generation latency.
-        In case of failure, if the status code is 429 due to throttling, value
-        of header retry-after-ms will be honored. Otherwise, request
-        will be retried with an exponential backoff.
-        Any other non-200 status code will fail immediately.
+        With backoff, throttled requests are retried after the delay of header
+        retry-after-ms, and requests failing without a response, including
+        while streaming, after an exponential backoff, for up to
+        MAX_RETRY_SECONDS from the first attempt and as long as the retry
+        budget allows. Any other non-200 status code will fail immediately.
 
-        :param body: json request body.
+        :param body: json request body, either as dict or as serialized json
+                     bytes, which must already set "stream": true.
+        :param new_request: whether the call starts a request, deposited into
+                            the retry budget, rather than continues a request
+                            spilled over from another target.
         :return RequestStats.
         """
         stats = RequestStats()
-        # operate only in streaming mode so we can collect token stats.
-        body["stream"] = True
+        if isinstance(body, dict):
+            # operate only in streaming mode so we can collect token stats.
+            body["stream"] = True
         try:
-            await self._call(session, body, stats)
+            await self._call(session, body, stats, new_request)
         except Exception as e:
             stats.last_exception = e
+        if stats.first_attempt_time is not None:
+            stats.total_time = time.time() - stats.first_attempt_time
 
         return stats
 
-    @backoff.on_exception(backoff.expo,
-                      aiohttp.ClientError,
-                      jitter=backoff.full_jitter,
-                      max_time=MAX_RETRY_SECONDS,
-                      giveup=_terminal_http_code)
-    async def _call(self, session:aiohttp.ClientSession, body: dict, stats: RequestStats):
+    async def _call(self, session:aiohttp.ClientSession, body: Union[dict, bytes], stats: RequestStats, new_request: bool):
         headers = {
             "api-key": self.api_key,
             "Content-Type": "application/json",
             TELEMETRY_USER_AGENT_HEADER: USER_AGENT,
         }
-        stats.request_start_time = time.time()
-        while stats.calls == 0 or time.time() - stats.request_start_time < MAX_RETRY_SECONDS:
+        if new_request and self.retry_budget is not None:
+            self.retry_budget.record_request()
+        while True:
+            self._reset_attempt(stats)
+            if stats.first_attempt_time is None:
+                stats.first_attempt_time = stats.request_start_time
             stats.calls += 1
-            response = await session.post(self.url, headers=headers, json=body)
-            stats.response_status_code = response.status
-            # capture utilization in all cases, if found
-            self._read_utilization(response, stats)
+            try:
+                if isinstance(body, bytes):
+                    response = await session.post(self.url, headers=headers, data=body, trace_request_ctx=stats)
+                else:
+                    response = await session.post(self.url, headers=headers, json=body, trace_request_ctx=stats)
+                stats.response_status_code = response.status
+                # capture utilization in all cases, if found
+                self._read_utilization(response, stats)
+                if response.status == 200:
+                    await self._handle_response(response, stats)
+                    stats.attempts.append(Attempt(stats.request_start_time, stats.response_end_time, 200))
+                    return
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                stats.attempts.append(Attempt(stats.request_start_time, time.time(), 0))
+                delay = self._retry_delay(stats)
+                if delay is None:
+                    raise
+                logging.debug(f"attempt {stats.calls} failed, retrying in {round(delay, 3)}s")
+                await asyncio.sleep(delay)
+                continue
+
+            response.release()
+            stats.attempts.append(Attempt(stats.request_start_time, time.time(), response.status))
             if response.status != 429:
+                logging.warning(f"call failed: {REQUEST_ID_HEADER}={response.headers.get(REQUEST_ID_HEADER)} {response.status}: {response.reason}")
                 break
-            if self.backoff and RETRY_AFTER_MS_HEADER in response.headers:
-                try:
-                    retry_after_str = response.headers[RETRY_AFTER_MS_HEADER]
-                    retry_after_ms = float(retry_after_str)
-                    logging.debug(f"retry-after sleeping for {retry_after_ms}ms")
-                    await asyncio.sleep(retry_after_ms/1000.0)
-                except ValueError as e:
-                    logging.warning(f"unable to parse retry-after header value: {UTILIZATION_HEADER}={retry_after_str}: {e}")   
-                    # fallback to backoff
-                    break
-            else:
-                # fallback to backoff
+            self._read_retry_after(response, stats)
+            delay = self._retry_delay(stats)
+            if delay is None:
                 break
+            logging.debug(f"throttled, retrying in {round(delay * 1000)}ms")
+            await asyncio.sleep(delay)
 
-        if response.status != 200 and response.status != 429:
-            logging.warning(f"call failed: {REQUEST_ID_HEADER}={response.headers[REQUEST_ID_HEADER]} {response.status}: {response.reason}")
         if self.backoff:
             response.raise_for_status()
-        if response.status == 200:
-            await self._handle_response(response, stats)
-        
+
+    def _reset_attempt(self, stats: RequestStats):
+        stats.request_start_time = time.time()
+        stats.response_status_code = 0
+        stats.response_time = None
+        stats.first_token_time = None
+        stats.response_end_time = None
+        stats.generated_tokens = None
+        stats.retry_after = None
+        del stats.token_times[:]
+        del stats.token_choices[:]
+
+    def _retry_delay(self, stats: RequestStats) -> Optional[float]:
+        """
+        Returns the delay before the next attempt, or None to give up.
+        """
+        if not self.backoff:
+            return None
+        delay = stats.retry_after if stats.retry_after is not None else backoff_delay(stats.calls)
+        if time.time() + delay - stats.first_attempt_time > MAX_RETRY_SECONDS:
+            return None
+        if self.retry_budget is not None and not self.retry_budget.try_retry():
+            logging.debug("retry budget exhausted, giving up")
+            return None
+        return delay
+
     async def _handle_response(self, response: aiohttp.ClientResponse, stats: RequestStats):
         async with response:
             stats.response_time = time.time()
+            stats.generated_tokens = 0
             async for line in response.content:
-                if not line.startswith(b'data:'):
+                choice = _content_choice(line)
+                if choice < 0:
                     continue
+                now = time.time()
                 if stats.first_token_time is None:
-                    stats.first_token_time = time.time()
-                if stats.generated_tokens is None:
-                    stats.generated_tokens = 0
+                    stats.first_token_time = now
                 stats.generated_tokens += 1
+                stats.token_times.append(now)
+                stats.token_choices.append(choice)
             stats.response_end_time = time.time()
 
+    def _read_retry_after(self, response: aiohttp.ClientResponse, stats: RequestStats):
+        stats.retry_after = None
+        if RETRY_AFTER_MS_HEADER in response.headers:
+            retry_after_str = response.headers[RETRY_AFTER_MS_HEADER]
+            try:
+                stats.retry_after = float(retry_after_str) / 1000.0
+            except ValueError as e:
+                logging.warning(f"unable to parse retry-after header value: {RETRY_AFTER_MS_HEADER}={retry_after_str}: {e}")
+
     def _read_utilization(self, response: aiohttp.ClientResponse, stats: RequestStats):
         if UTILIZATION_HEADER in response.headers:
             util_str = response.headers[UTILIZATION_HEADER]
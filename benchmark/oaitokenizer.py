@@ -1,20 +1,32 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+import collections
+import functools
 import logging
-import tiktoken
+import threading
 
-def num_tokens_from_text(text, model):
-    """Return the number of tokens used by text."""
+import tiktoken
 
-    encoding = tiktoken.encoding_for_model(model)
-    return len(encoding.encode(text))
+# Maximum number of distinct texts whose token count is remembered per process.
+TOKEN_COUNT_CACHE_SIZE = 1024
 
-def num_tokens_from_messages(messages, model):
-    """Return the number of tokens used by a list of messages."""
-
-    encoding = tiktoken.encoding_for_model(model)
+@functools.lru_cache(maxsize=None)
+def _encoding(model: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except (OSError, ValueError) as e:
+        # tiktoken downloads encoding files on first use, and caches them in
+        # a temporary directory unless TIKTOKEN_CACHE_DIR is set
+        raise RuntimeError(f"unable to load tokenizer of model {model}: {e}. "
+            f"To run offline, download it once with TIKTOKEN_CACHE_DIR set to a persistent directory, see README.") from e
 
+@functools.lru_cache(maxsize=None)
+def _message_format(model: str) -> (str, int, int):
+    """
+    Returns the model used for counting, tokens per message and tokens per name
+    for given model. Cached, so that the unpinned model warning is only logged once.
+    """
     if model in {
         "gpt-3.5-turbo-0613",
         "gpt-3.5-turbo-16k-0613",
@@ -23,27 +35,82 @@ def num_tokens_from_messages(messages, model):
         "gpt-4-0613",
         "gpt-4-32k-0613",
         }:
-        tokens_per_message = 3
-        tokens_per_name = 1
+        return model, 3, 1
     elif model == "gpt-3.5-turbo-0301":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
+        # every message follows <|start|>{role/name}\n{content}<|end|>\n
+        # if there's a name, the role is omitted
+        return model, 4, -1
     elif "gpt-3.5-turbo" in model:
-        logging.warn("Warning: gpt-3.5-turbo may update over time. Returning num tokens assuming gpt-3.5-turbo-0613.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613")
+        logging.warning("Warning: gpt-3.5-turbo may update over time. Returning num tokens assuming gpt-3.5-turbo-0613.")
+        return _message_format("gpt-3.5-turbo-0613")
     elif "gpt-4" in model:
-        logging.warn("Warning: gpt-4 may update over time. Returning num tokens assuming gpt-4-0613.")
-        return num_tokens_from_messages(messages, model="gpt-4-0613")
+        logging.warning("Warning: gpt-4 may update over time. Returning num tokens assuming gpt-4-0613.")
+        return _message_format("gpt-4-0613")
     else:
         raise NotImplementedError(
             f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
         )
-    num_tokens = 0
+
+class _TokenCountCache:
+    """
+    Thread-safe LRU cache of token counts keyed by encoding name and text.
+    """
+    def __init__(self, size: int):
+        self.size = size
+        self.counts = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            count = self.counts.get(key)
+            if count is not None:
+                self.counts.move_to_end(key)
+            return count
+
+    def put(self, key, count: int):
+        with self.lock:
+            self.counts[key] = count
+            self.counts.move_to_end(key)
+            while len(self.counts) > self.size:
+                self.counts.popitem(last=False)
+
+_token_counts = _TokenCountCache(TOKEN_COUNT_CACHE_SIZE)
+
+def num_tokens_from_texts(texts, model) -> [int]:
+    """Return the number of tokens used by each of texts, encoding all uncached texts in one batch."""
+
+    encoding = _encoding(model)
+    counts = [_token_counts.get((encoding.name, text)) for text in texts]
+    missing = [i for i, count in enumerate(counts) if count is None]
+    if len(missing) > 0:
+        if len(missing) == 1:
+            # batch encoding spins up a thread pool, not worth it for one text
+            tokens = [encoding.encode_ordinary(texts[missing[0]])]
+        else:
+            tokens = encoding.encode_ordinary_batch([texts[i] for i in missing])
+        for i, encoded in zip(missing, tokens):
+            counts[i] = len(encoded)
+            _token_counts.put((encoding.name, texts[i]), counts[i])
+    return counts
+
+def num_tokens_from_text(text, model):
+    """Return the number of tokens used by text."""
+
+    return num_tokens_from_texts([text], model)[0]
+
+def num_tokens_from_messages(messages, model):
+    """Return the number of tokens used by a list of messages."""
+
+    model, tokens_per_message, tokens_per_name = _message_format(model)
+    keys = []
+    values = []
     for message in messages:
-        num_tokens += tokens_per_message
         for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
+            keys.append(key)
+            values.append(value)
+
+    num_tokens = tokens_per_message * len(messages)
+    num_tokens += sum(num_tokens_from_texts(values, model))
+    num_tokens += tokens_per_name * keys.count("name")
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     return num_tokens
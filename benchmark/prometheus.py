@@ -0,0 +1,122 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from .histogram import DEFAULT_LAYOUT
+
+# Prefix of all exported metric names.
+METRIC_PREFIX = "aoai_benchmark"
+# Upper bounds of the exported buckets of each histogram.
+PROMETHEUS_BUCKETS = {
+   "e2e_seconds": [0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120],
+   "ttft_seconds": [0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60],
+   "tbt_seconds": [0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.25, 0.5, 1, 2.5],
+   "utilization_percent": [10, 20, 30, 40, 50, 60, 70, 80, 90, 100, 110],
+}
+# Help of each exported metric.
+METRIC_HELP = {
+   "requests_total": ("counter", "Completed requests."),
+   "failures_total": ("counter", "Failed requests, including throttled ones."),
+   "throttled_total": ("counter", "Requests throttled with status 429."),
+   "retries_total": ("counter", "Retried attempts of completed requests."),
+   "context_tokens_total": ("counter", "Context tokens of successful requests."),
+   "generated_tokens_total": ("counter", "Generated tokens of successful requests."),
+   "e2e_seconds": ("histogram", "End to end time of successful requests."),
+   "ttft_seconds": ("histogram", "Time to first token of successful requests."),
+   "tbt_seconds": ("histogram", "Time between consecutive generated tokens."),
+   "utilization_percent": ("histogram", "Deployment utilization reported by the service."),
+}
+
+# Address metrics are served on by default, use "" or 0.0.0.0 for all interfaces.
+PROMETHEUS_HOST = "127.0.0.1"
+
+class PrometheusExporter:
+   """
+   Serves the metrics published by the aggregator at /metrics in the
+   Prometheus text format, from a background thread. The aggregator hands
+   over a complete copy of its counters and histograms with publish(), so
+   scrapes never read state the aggregator is updating, nor take its lock.
+   """
+   def __init__(self, port:int, host:str=PROMETHEUS_HOST):
+      """
+      :param port: port to listen on, 0 to pick a free one.
+      :param host: address to listen on, the loopback interface by default.
+      """
+      self.published = None
+      exporter = self
+
+      class Handler(BaseHTTPRequestHandler):
+         def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+               self.send_error(404)
+               return
+            body = _render(exporter.published).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+         def log_message(self, format, *args):
+            pass
+
+      self.server = ThreadingHTTPServer((host, port), Handler)
+      self.server.daemon_threads = True
+      self.port = self.server.server_address[1]
+      self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+   def start(self):
+      self.thread.start()
+      logging.info(f"serving prometheus metrics on port {self.port} at /metrics")
+
+   def stop(self):
+      if self.thread.is_alive():
+         self.server.shutdown()
+      self.server.server_close()
+
+   def publish(self, published:dict):
+      """
+      Replaces the served metrics. The dict must not be modified afterwards.
+      :param published: processing requests count under "processing", and
+      under "groups" a list of dicts with "labels", the counters of
+      METRIC_HELP and the histograms of PROMETHEUS_BUCKETS as LogHistogram
+      counts arrays with "<name>_count" and "<name>_sum".
+      """
+      # a reference assignment, atomic for readers
+      self.published = published
+
+def _render(published:dict) -> str:
+   lines = []
+   processing = published["processing"] if published is not None else 0
+   lines.append(f"# HELP {METRIC_PREFIX}_processing Requests currently being processed.")
+   lines.append(f"# TYPE {METRIC_PREFIX}_processing gauge")
+   lines.append(f"{METRIC_PREFIX}_processing {processing}")
+   groups = published["groups"] if published is not None else []
+   for name, (kind, help) in METRIC_HELP.items():
+      metric = f"{METRIC_PREFIX}_{name}"
+      lines.append(f"# HELP {metric} {help}")
+      lines.append(f"# TYPE {metric} {kind}")
+      for group in groups:
+         labels = ",".join(f'{key}="{_escape(value)}"' for key, value in group["labels"].items())
+         if kind == "counter":
+            lines.append(f"{metric}{{{labels}}} {group[name]}" if labels else f"{metric} {group[name]}")
+            continue
+         bounds = PROMETHEUS_BUCKETS[name]
+         # values up to a bound are in the buckets up to the one holding it
+         cumulative = np.cumsum(group[name])[DEFAULT_LAYOUT.indexes(bounds)]
+         prefix = labels + "," if labels else ""
+         for bound, count in zip(bounds, cumulative):
+            lines.append(f'{metric}_bucket{{{prefix}le="{bound}"}} {count}')
+         lines.append(f'{metric}_bucket{{{prefix}le="+Inf"}} {group[name + "_count"]}')
+         suffix = f"{{{labels}}}" if labels else ""
+         lines.append(f"{metric}_sum{suffix} {group[name + '_sum']}")
+         lines.append(f"{metric}_count{suffix} {group[name + '_count']}")
+   return "\n".join(lines) + "\n"
+
+def _escape(value:str) -> str:
+   return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
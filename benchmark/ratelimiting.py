@@ -6,8 +6,18 @@ import collections
 import time
 import math
 
+import numpy as np
+
 # allow up to 5% burst of max calls
 RATE_ESTIMATOR_BURST_FACTOR = 1.0
+# Number of intended send times ArrivalScheduler computes at once.
+ARRIVAL_BATCH_SIZE = 4096
+# Calls due within this many seconds are released without sleeping.
+ARRIVAL_SLEEP_GRANULARITY = 0.002
+# Seconds of unused token budget TokenRateLimiter may spend in a burst.
+TOKEN_RATE_BURST_DURATION = 1.0
+# Weight of each observed call in TokenRateLimiter's moving average cost.
+TOKEN_RATE_ESTIMATE_WEIGHT = 0.05
 
 class RateLimiter:
     """
@@ -42,6 +52,98 @@ class RateLimiter:
         return self.calls[-1] - self.calls[0]
 
 
+class ArrivalScheduler:
+    """
+    Open loop request scheduler. Intended send times are precomputed from the
+    target rate, with either constant or Poisson (exponentially distributed)
+    spacing, and do not depend on how fast calls complete. A call that is
+    released late keeps its intended time in intended_time, so latency can be
+    measured from when the call should have started.
+    """
+    def __init__(self, calls: int, period: float, arrivals: str="constant", seed=None):
+        """
+        Create a new ArrivalScheduler releasing calls per period on average.
+        :param arrivals: spacing of calls, either constant or poisson.
+        :param seed: optional random seed for poisson arrivals.
+        """
+        if arrivals not in ("constant", "poisson"):
+            raise ValueError(f"unknown arrivals {arrivals}")
+        self.interval = period / calls
+        self.arrivals = arrivals
+        self.rng = np.random.default_rng(seed)
+        self.start_time = None
+        self.offsets = []
+        self.index = 0
+        self.next_offset = 0.0
+        self.intended_time = None
+
+    def _compute_offsets(self):
+        if self.arrivals == "poisson":
+            gaps = self.rng.exponential(self.interval, ARRIVAL_BATCH_SIZE)
+        else:
+            gaps = np.full(ARRIVAL_BATCH_SIZE, self.interval)
+        cumulative = np.cumsum(gaps)
+        self.offsets = (self.next_offset + cumulative - gaps).tolist()
+        self.next_offset += cumulative[-1]
+        self.index = 0
+
+    async def __aenter__(self):
+        if self.start_time is None:
+            self.start_time = time.time()
+        if self.index == len(self.offsets):
+            self._compute_offsets()
+        self.intended_time = self.start_time + self.offsets[self.index]
+        self.index += 1
+        # calls that are due, or late, are released without yielding, so
+        # high rates do not pay for one sleep per call.
+        delay = self.intended_time - time.time()
+        if delay > ARRIVAL_SLEEP_GRANULARITY:
+            await asyncio.sleep(delay)
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class TokenRateLimiter:
+    """
+    Rate limiter that paces calls by their token cost instead of their count.
+    Each call is admitted charging the current estimate of tokens per call.
+    Once the actual usage of a call is known, record_usage() corrects the
+    schedule by the difference and moves the estimate towards observed usage.
+    """
+    def __init__(self, tokens: float, period: float, expected_tokens: float):
+        """
+        Create a new TokenRateLimiter allowing tokens per period.
+        :param expected_tokens: initial estimate of tokens used per call,
+                                typically context tokens + max_tokens.
+        """
+        self.rate = tokens / period
+        self.expected_tokens = expected_tokens
+        self.next_time = None
+
+    async def __aenter__(self):
+        now = time.time()
+        if self.next_time is None or self.next_time < now - TOKEN_RATE_BURST_DURATION:
+            self.next_time = now
+        sleep_time = self.next_time - now
+        self.next_time += self.expected_tokens / self.rate
+        if sleep_time > 0:
+            await asyncio.sleep(sleep_time)
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def record_usage(self, tokens: float):
+        """
+        Records the actual number of tokens used by a completed call.
+        """
+        if self.next_time is not None:
+            self.next_time += (tokens - self.expected_tokens) / self.rate
+        self.expected_tokens += TOKEN_RATE_ESTIMATE_WEIGHT * (tokens - self.expected_tokens)
+
+
 class NoRateLimiter:
     """
     Dummy rate limiter that does not impose any limits.
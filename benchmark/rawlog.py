@@ -0,0 +1,207 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import collections
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+from .oairequester import RequestStats
+
+# Version of the raw log layout, stored in its schema.
+RAW_LOG_VERSION = 1
+# Name of the file describing the columns of a raw log.
+RAW_LOG_SCHEMA_FILE = "schema.json"
+# Interval in seconds between two writes of queued requests.
+RAW_LOG_FLUSH_INTERVAL = 1.0
+# Size in bytes of the write buffer of each column file.
+RAW_LOG_BUFFER_SIZE = 1 << 20
+
+# Columns of a raw log: name, numpy dtype, and function extracting the column
+# value from RequestStats. Missing times and utilizations are stored as NaN,
+# missing counts as -1. Categorical columns hold an int16 code, -1 if missing,
+# into the categories listed in the schema.
+RAW_LOG_COLUMNS = [
+   ("request_start_time", "<f8", lambda s: s.request_start_time),
+   ("intended_start_time", "<f8", lambda s: s.intended_start_time),
+   ("first_attempt_time", "<f8", lambda s: s.first_attempt_time),
+   ("response_time", "<f8", lambda s: s.response_time),
+   ("first_token_time", "<f8", lambda s: s.first_token_time),
+   ("response_end_time", "<f8", lambda s: s.response_end_time),
+   ("status", "<i2", lambda s: s.response_status_code),
+   ("calls", "<i2", lambda s: s.calls),
+   ("context_tokens", "<i4", lambda s: s.context_tokens),
+   ("generated_tokens", "<i4", lambda s: s.generated_tokens),
+   ("utilization", "<f4", lambda s: s.deployment_utilization),
+   ("dns_time", "<f4", lambda s: s.dns_time),
+   ("connect_time", "<f4", lambda s: s.connect_time),
+   ("headers_time", "<f4", lambda s: s.headers_time),
+   ("new_connection", "i1", lambda s: None if s.new_connection is None else int(s.new_connection)),
+]
+RAW_LOG_CATEGORICAL_COLUMNS = [
+   ("workload_class", lambda s: s.workload_class),
+   ("endpoint", lambda s: s.endpoint),
+]
+# Ragged columns hold a variable number of values per request, concatenated
+# in request order, with the number of values of each request in a lengths
+# column: name, numpy dtype, lengths column name, and function extracting the
+# values from RequestStats.
+RAW_LOG_RAGGED_COLUMNS = [
+   ("token_gaps", "<f4", "token_gap_count", lambda s: s.token_gaps()),
+]
+
+class RawLogWriter:
+   """
+   Writes every request stat to a directory of append-only column files, one
+   raw little-endian array per column, described by schema.json. Stats are
+   queued by append() and written in large batches from a background thread,
+   so recording never waits on disk.
+   """
+   def __init__(self, directory:str, flush_interval:float=RAW_LOG_FLUSH_INTERVAL):
+      """
+      :param directory: directory of the column files, created if missing.
+      :param flush_interval: interval in seconds between two writes.
+      """
+      os.makedirs(directory, exist_ok=True)
+      self.directory = directory
+      self.flush_interval = flush_interval
+      self.pending = collections.deque()
+      self.terminate = threading.Event()
+      self.thread = threading.Thread(target=self._flush_loop, daemon=True)
+      self.rows = 0
+      self.files = {}
+      for name, _, _ in RAW_LOG_COLUMNS:
+         self.files[name] = self._open(name)
+      self.categories = {}
+      for name, _ in RAW_LOG_CATEGORICAL_COLUMNS:
+         self.files[name] = self._open(name)
+         self.categories[name] = {}
+      for name, _, lengths, _ in RAW_LOG_RAGGED_COLUMNS:
+         self.files[name] = self._open(name)
+         self.files[lengths] = self._open(lengths)
+      self._write_schema()
+
+   def _open(self, name:str):
+      path = os.path.join(self.directory, f"{name}.bin")
+      if os.path.exists(path):
+         raise ValueError(f"raw log {self.directory} already holds column {name}")
+      return open(path, "ab", buffering=RAW_LOG_BUFFER_SIZE)
+
+   def start(self):
+      self.thread.start()
+
+   def stop(self):
+      """
+      Writes all queued stats and closes the column files.
+      """
+      self.terminate.set()
+      if self.thread.is_alive():
+         self.thread.join()
+      self._flush()
+      for f in self.files.values():
+         f.close()
+      self._write_schema()
+      logging.info(f"wrote {self.rows} requests to raw log {self.directory}")
+
+   def append(self, stats: RequestStats):
+      """
+      Queues a request stat to be written. Safe to call from any thread.
+      """
+      self.pending.append(stats)
+
+   def _flush_loop(self):
+      while not self.terminate.wait(self.flush_interval):
+         self._flush()
+
+   def _flush(self):
+      batch = [self.pending.popleft() for _ in range(len(self.pending))]
+      if len(batch) == 0:
+         return
+      for name, dtype, value in RAW_LOG_COLUMNS:
+         missing = np.nan if dtype[1] == "f" else -1
+         column = np.array([_or(value(s), missing) for s in batch], dtype=dtype)
+         self.files[name].write(column.tobytes())
+      new_categories = False
+      for name, value in RAW_LOG_CATEGORICAL_COLUMNS:
+         codes = self.categories[name]
+         column = np.empty(len(batch), dtype="<i2")
+         for i, s in enumerate(batch):
+            category = value(s)
+            if category is None:
+               column[i] = -1
+               continue
+            code = codes.get(category)
+            if code is None:
+               code = len(codes)
+               codes[category] = code
+               new_categories = True
+            column[i] = code
+         self.files[name].write(column.tobytes())
+      for name, dtype, lengths, value in RAW_LOG_RAGGED_COLUMNS:
+         values = [value(s) for s in batch]
+         self.files[name].write(np.concatenate(values).astype(dtype).tobytes())
+         self.files[lengths].write(np.array([len(v) for v in values], dtype="<i4").tobytes())
+      self.rows += len(batch)
+      if new_categories:
+         self._write_schema()
+
+   def _write_schema(self):
+      columns = [{"name": name, "dtype": dtype} for name, dtype, _ in RAW_LOG_COLUMNS]
+      for name, _ in RAW_LOG_CATEGORICAL_COLUMNS:
+         columns.append({"name": name, "dtype": "<i2", "categories": list(self.categories[name])})
+      for name, dtype, lengths, _ in RAW_LOG_RAGGED_COLUMNS:
+         columns.append({"name": lengths, "dtype": "<i4"})
+         columns.append({"name": name, "dtype": dtype, "lengths": lengths})
+      schema = {"version": RAW_LOG_VERSION, "columns": columns}
+      # replaced atomically, so readers never see a partial schema
+      path = os.path.join(self.directory, RAW_LOG_SCHEMA_FILE)
+      with open(path + ".tmp", "w") as f:
+         json.dump(schema, f, indent=2)
+      os.replace(path + ".tmp", path)
+
+def _or(value, missing):
+   return missing if value is None else value
+
+def read_raw_log(directory:str) -> dict:
+   """
+   Maps the columns of a raw log into memory without reading them.
+   Returns dict of column name to read-only numpy array, and the categories of
+   categorical columns under "categories". Ragged columns hold the values of
+   all requests, split by their lengths column.
+   """
+   with open(os.path.join(directory, RAW_LOG_SCHEMA_FILE)) as f:
+      schema = json.load(f)
+   if schema.get("version") != RAW_LOG_VERSION:
+      raise ValueError(f"unsupported raw log version {schema.get('version')}")
+   columns = {"categories": {}}
+   rows = None
+   for column in schema["columns"]:
+      if "lengths" in column:
+         continue
+      # rows still being written by a running test may be partial
+      column_rows = _file_items(directory, column)
+      rows = column_rows if rows is None else min(rows, column_rows)
+      if "categories" in column:
+         columns["categories"][column["name"]] = column["categories"]
+   ragged = [column for column in schema["columns"] if "lengths" in column]
+   for column in ragged:
+      # only keep rows whose ragged values are all written
+      lengths = np.cumsum(_map(directory, {"name": column["lengths"], "dtype": "<i4"}, rows), dtype=np.int64)
+      rows = min(rows, int(np.searchsorted(lengths, _file_items(directory, column), side="right")))
+   for column in schema["columns"]:
+      if "lengths" not in column:
+         columns[column["name"]] = _map(directory, column, rows)
+   for column in ragged:
+      columns[column["name"]] = _map(directory, column, int(np.sum(columns[column["lengths"]], dtype=np.int64)))
+   return columns
+
+def _file_items(directory:str, column:dict) -> int:
+   return os.path.getsize(os.path.join(directory, f"{column['name']}.bin")) // np.dtype(column["dtype"]).itemsize
+
+def _map(directory:str, column:dict, items:int) -> np.ndarray:
+   if items == 0:
+      return np.empty(0, dtype=column["dtype"])
+   return np.memmap(os.path.join(directory, f"{column['name']}.bin"), dtype=column["dtype"], mode="r", shape=(items,))
@@ -0,0 +1,57 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import random
+
+# Longest time in seconds a request is retried for, from its first attempt.
+MAX_RETRY_SECONDS = 60.0
+# Upper bound in seconds of the exponential backoff between two attempts.
+MAX_BACKOFF_SECONDS = 8.0
+# Retries a budget allows before any request has been made, so that the
+# first requests of a run can be retried.
+DEFAULT_RETRY_RESERVE = 10.0
+
+def backoff_delay(attempt:int, cap:float=MAX_BACKOFF_SECONDS) -> float:
+   """
+   Returns the delay before retrying a failed attempt without retry-after,
+   exponential with full jitter: uniform between 0 and 2^(attempt-1) seconds,
+   capped.
+   :param attempt: number of the failed attempt, starting at 1.
+   """
+   return random.uniform(0, min(cap, 2.0 ** (attempt - 1)))
+
+class RetryBudget:
+   """
+   Global retry budget shared by all requests of a run. Each request deposits
+   ratio retries, up to the reserve, and each retry withdraws one, so that
+   retries stay under ratio of requests in the long run, while short bursts
+   of failures can still be retried. Under sustained throttling, retries are
+   denied rather than multiplying the load on the deployment.
+   """
+   def __init__(self, ratio:float, reserve:float=DEFAULT_RETRY_RESERVE):
+      """
+      :param ratio: retries allowed per request.
+      :param reserve: initial and largest number of retries available at once.
+      """
+      self.ratio = ratio
+      self.reserve = max(reserve, 1.0)
+      self.balance = self.reserve
+      self.retries = 0
+      self.denied = 0
+
+   def record_request(self):
+      """
+      Records the first attempt of a request.
+      """
+      self.balance = min(self.reserve, self.balance + self.ratio)
+
+   def try_retry(self) -> bool:
+      """
+      Withdraws one retry, returns False if the budget is exhausted.
+      """
+      if self.balance < 1.0:
+         self.denied += 1
+         return False
+      self.balance -= 1.0
+      self.retries += 1
+      return True
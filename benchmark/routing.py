@@ -0,0 +1,143 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import json
+import logging
+import os
+import time
+from typing import Union
+
+import aiohttp
+import numpy as np
+
+from .oairequester import OAIRequester, RequestStats
+from .retry import RetryBudget
+
+# Routing policies across targets.
+ROUTING_POLICIES = ["round-robin", "weighted", "spillover"]
+# Seconds a throttled target is skipped when it does not send retry-after-ms.
+DEFAULT_COOLDOWN = 1.0
+
+class Target:
+   """
+   A deployment requests can be routed to.
+   """
+   def __init__(self, name:str, url:str, api_key:str, weight:float=1):
+      self.name = name
+      self.url = url
+      self.api_key = api_key
+      self.weight = weight
+      # time until which the target is skipped by spillover routing
+      self.cooldown_until = 0.0
+
+def _parse_targets(path:str, api_version:str, api_key_env:str) -> [Target]:
+   """
+   Parses a json file holding a targets list, each with an endpoint, a
+   deployment and optionally a name, an api_key_env, an api_version and a
+   weight. Missing api_key_env and api_version default to the given ones.
+   """
+   if not os.path.isfile(path):
+      raise ValueError(f"targets file {path} not found")
+   with open(path) as f:
+      try:
+         config = json.load(f)
+      except ValueError as e:
+         raise ValueError(f"invalid targets file {path}: {e}")
+   entries = config.get("targets") if isinstance(config, dict) else None
+   if not isinstance(entries, list) or len(entries) == 0:
+      raise ValueError(f"targets file {path} must hold a non empty targets list")
+   targets = []
+   for entry in entries:
+      if not isinstance(entry, dict) or "endpoint" not in entry or "deployment" not in entry:
+         raise ValueError(f"target must be an object with an endpoint and a deployment, got {entry}")
+      name = str(entry.get("name", entry["deployment"]))
+      key_env = entry.get("api_key_env", api_key_env)
+      api_key = os.getenv(key_env)
+      if api_key is None:
+         raise ValueError(f"api-key-env {key_env} of target {name} not set")
+      weight = entry.get("weight", 1)
+      if not isinstance(weight, (int, float)) or weight <= 0:
+         raise ValueError(f"weight of target {name} must be > 0")
+      url = entry["endpoint"].rstrip("/") + "/openai/deployments/" + entry["deployment"] + "/chat/completions"
+      url += "?api-version=" + entry.get("api_version", api_version)
+      targets.append(Target(name, url, api_key, weight))
+   names = [t.name for t in targets]
+   if len(set(names)) != len(names):
+      raise ValueError("target names must be unique, set name on targets sharing a deployment name")
+   return targets
+
+class Router:
+   """
+   Requester routing each request to one of several targets, with one
+   OAIRequester per target, all sharing the session of the caller so
+   connections are pooled across targets. Policies are:
+   - round-robin: targets in turn.
+   - weighted: a random target, with probability proportional to its weight.
+   - spillover: the first target in order that is not cooling down. A target
+     that throttles a request cools down for the retry-after-ms it sent, and
+     the request is sent to the next target. The last target, such as a
+     pay-as-you-go deployment behind provisioned ones, takes every request
+     the others did not.
+   Stats of a request are those of the target that served it, with the name
+   of that target in endpoint, and the attempts made on all targets.
+   """
+   def __init__(self, targets:[Target], policy:str="round-robin", backoff=False, retry_budget:RetryBudget=None, seed=None):
+      """
+      :param targets: targets to route requests to, in spillover order.
+      :param policy: one of ROUTING_POLICIES.
+      :param backoff: whether to retry throttled or unsuccessful requests,
+      only on the last target with spillover routing.
+      :param retry_budget: optional retry budget shared by all targets.
+      :param seed: optional random seed for weighted routing.
+      """
+      if policy not in ROUTING_POLICIES:
+         raise ValueError(f"unknown routing policy {policy}, use one of {', '.join(ROUTING_POLICIES)}")
+      self.targets = targets
+      self.policy = policy
+      self.requesters = []
+      for i, target in enumerate(targets):
+         # spilling requests must see throttling, rather than wait it out
+         retry = backoff and (policy != "spillover" or i == len(targets) - 1)
+         self.requesters.append(OAIRequester(target.api_key, target.url, backoff=retry, retry_budget=retry_budget))
+      weights = np.array([t.weight for t in targets], dtype=float)
+      self.cumulative_weights = np.cumsum(weights / np.sum(weights))
+      self.rng = np.random.default_rng(seed)
+      self.next_index = 0
+
+   async def call(self, session:aiohttp.ClientSession, body: Union[dict, bytes]) -> RequestStats:
+      if self.policy == "spillover":
+         return await self._spillover(session, body)
+      if self.policy == "weighted":
+         index = min(int(np.searchsorted(self.cumulative_weights, self.rng.random(), side="right")), len(self.targets) - 1)
+      else:
+         index = self.next_index
+         self.next_index = (self.next_index + 1) % len(self.targets)
+      stats = await self.requesters[index].call(session, body)
+      stats.endpoint = self.targets[index].name
+      return stats
+
+   async def _spillover(self, session:aiohttp.ClientSession, body: Union[dict, bytes]) -> RequestStats:
+      now = time.time()
+      last = len(self.targets) - 1
+      candidates = [i for i in range(last) if self.targets[i].cooldown_until <= now] + [last]
+      first_attempt_time = None
+      attempts = []
+      for i in candidates:
+         # the request is deposited into the retry budget once, on its first target
+         stats = await self.requesters[i].call(session, body, new_request=first_attempt_time is None)
+         if first_attempt_time is None:
+            first_attempt_time = stats.first_attempt_time
+         attempts += stats.attempts
+         if stats.response_status_code != 429 or i == last:
+            break
+         target = self.targets[i]
+         cooldown = stats.retry_after if stats.retry_after is not None else DEFAULT_COOLDOWN
+         target.cooldown_until = max(target.cooldown_until, time.time() + cooldown)
+         logging.debug(f"target {target.name} throttled, spilling over for {cooldown}s")
+      if first_attempt_time is not None:
+         stats.first_attempt_time = first_attempt_time
+         stats.total_time = time.time() - first_attempt_time
+      stats.attempts = attempts
+      stats.calls = len(attempts)
+      stats.endpoint = self.targets[i].name
+      return stats
@@ -0,0 +1,170 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import datetime
+import json
+import logging
+import sys
+import threading
+import time
+
+from .loadcmd import _build_request_builder, _build_requester, _connection_options, _run_load, _validate_request
+from .ratelimiting import ArrivalScheduler, RateLimiter
+from .statsaggregator import _StatsAggregator
+
+def search(args):
+   """
+   Searches for the highest request rate a deployment sustains. Every step runs
+   load at a fixed rate for step-duration seconds, discards the first warmup
+   seconds and passes if the ratio of throttled requests and the 95th percentile
+   time to first token stay within the configured limits. Prints every step,
+   then a summary with the highest passing rate and the latency curve.
+   """
+   try:
+      _validate(args)
+   except ValueError as e:
+      print(f"invalid argument(s): {e}")
+      sys.exit(1)
+
+   requester = _build_requester(args)
+   request_builder = _build_request_builder(args)
+   steps = []
+
+   def run_step(rate:float) -> bool:
+      logging.info(f"running search step at {rate} RPM for {args.step_duration}s")
+      step = _run_step(args, request_builder, requester, rate)
+      steps.append(step)
+      _print_step(step, args.output_format == "jsonl")
+      if step["interrupted"]:
+         raise KeyboardInterrupt
+      return step["passed"]
+
+   try:
+      if args.strategy == "staircase":
+         rate = args.start_rate
+         while rate <= args.max_rate and run_step(rate):
+            rate += args.rate_step
+      else:
+         # invariant: low passed, high failed or is the untested upper bound
+         low, high = args.start_rate, args.max_rate
+         if run_step(low) and not run_step(high):
+            while high - low > args.rate_step:
+               mid = round((low + high) / 2, 1)
+               if run_step(mid):
+                  low = mid
+               else:
+                  high = mid
+   except KeyboardInterrupt:
+      logging.warning("search interrupted, reporting completed steps")
+
+   summary = _summary(steps)
+   if args.output_format == "jsonl":
+      print(json.dumps(summary), flush=True)
+   else:
+      print(f"max rate: {summary['max_rate']} rpm: {summary['max_rpm']} tpm: {summary['max_tpm']}", flush=True)
+      for step in summary["curve"]:
+         print(f"  rate: {step['rate']:<7} rpm: {step['rpm']:<7} tpm: {step['tpm']:<8} throttle_ratio: {step['throttle_ratio']:<6} ttft_95th: {step['ttft']['95th']:<6} e2e_95th: {step['e2e']['95th']:<6} passed: {step['passed']}", flush=True)
+
+def _validate(args):
+   _validate_request(args)
+   if args.output_format == "none":
+      raise ValueError("output-format none is not supported by search")
+   if args.start_rate <= 0:
+      raise ValueError("start-rate must be > 0")
+   if args.max_rate < args.start_rate:
+      raise ValueError("max-rate must be >= start-rate")
+   if args.rate_step <= 0:
+      raise ValueError("rate-step must be > 0")
+   if args.warmup < 0:
+      raise ValueError("warmup must be >= 0")
+   if args.step_duration <= args.warmup:
+      raise ValueError("step-duration must be > warmup")
+   if args.max_throttle_ratio < 0 or args.max_throttle_ratio > 1:
+      raise ValueError("max-throttle-ratio must be between 0 and 1")
+   if args.max_ttft is not None and args.max_ttft <= 0:
+      raise ValueError("max-ttft must be > 0")
+
+def _run_step(args, request_builder, requester, rate:float) -> dict:
+   """
+   Runs load at rate for one step. Latencies and token rates come from an
+   aggregation window covering the step after warmup, request counts from
+   the difference between counters at the end of warmup and at the end of step.
+   """
+   aggregator = _StatsAggregator(
+      clients=args.clients,
+      dump_duration=1,
+      window_duration=args.step_duration - args.warmup,
+      print_stats=False)
+   warmup_counts = (0, 0)
+
+   def end_warmup():
+      nonlocal warmup_counts
+      aggregator._drain()
+      with aggregator.lock:
+         warmup_counts = (aggregator.total_requests_count, aggregator.throttled_count)
+
+   if args.arrivals == "sliding":
+      rate_limiter = RateLimiter(rate, 60)
+   else:
+      rate_limiter = ArrivalScheduler(rate, 60, arrivals=args.arrivals)
+
+   start = time.time()
+   warmup_timer = threading.Timer(args.warmup, end_warmup)
+   aggregator.start()
+   warmup_timer.start()
+   _run_load(request_builder,
+      max_concurrency=args.clients,
+      requester=requester,
+      rate_limiter=rate_limiter,
+      connection_options=_connection_options(args),
+      duration=args.step_duration,
+      loop=args.loop,
+      engine=args.engine,
+      stats_sink=aggregator)
+   warmup_timer.cancel()
+   interrupted = time.time() - start < args.step_duration
+   aggregator.stop()
+
+   with aggregator.lock:
+      snapshot = aggregator._snapshot()
+      requests = aggregator.total_requests_count - warmup_counts[0]
+      throttled = aggregator.throttled_count - warmup_counts[1]
+   throttle_ratio = round(throttled / requests, 4) if requests > 0 else "n/a"
+   ttft_95th = snapshot["ttft"]["95th"]
+   passed = throttle_ratio != "n/a" and throttle_ratio <= args.max_throttle_ratio
+   if args.max_ttft is not None:
+      passed = passed and ttft_95th != "n/a" and ttft_95th <= args.max_ttft
+   return {
+      "timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+      "rate": rate,
+      "rpm": snapshot["rpm"],
+      "tpm": snapshot["tpm"]["total"],
+      "requests": requests,
+      "throttled": throttled,
+      "throttle_ratio": throttle_ratio,
+      "ttft": snapshot["ttft"],
+      "e2e": snapshot["e2e"],
+      "util": snapshot["util"],
+      "passed": passed,
+      "interrupted": interrupted,
+   }
+
+def _print_step(step:dict, json_output:bool):
+   if json_output:
+      print(json.dumps(step), flush=True)
+   else:
+      print(f"{step['timestamp']} rate: {step['rate']:<7} rpm: {step['rpm']:<7} tpm: {step['tpm']:<8} requests: {step['requests']:<6} throttled: {step['throttled']:<5} throttle_ratio: {step['throttle_ratio']:<6} ttft_95th: {step['ttft']['95th']:<6} e2e_95th: {step['e2e']['95th']:<6} util_95th: {step['util']['95th']:<6} passed: {step['passed']}", flush=True)
+
+def _summary(steps:[dict]) -> dict:
+   """
+   Returns the highest passing step and all completed steps ordered by rate.
+   """
+   curve = sorted((step for step in steps if not step["interrupted"]), key=lambda step: step["rate"])
+   passing = [step for step in curve if step["passed"]]
+   best = passing[-1] if len(passing) > 0 else None
+   return {
+      "max_rate": best["rate"] if best is not None else "n/a",
+      "max_rpm": best["rpm"] if best is not None else "n/a",
+      "max_tpm": best["tpm"] if best is not None else "n/a",
+      "curve": curve,
+   }
@@ -1,195 +1,855 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+import collections
 import datetime
 import json
 import logging
+import math
 import threading
 import time
 
 import numpy as np
 
+from .histogram import DEFAULT_LAYOUT, HistogramLayout, LogHistogram
 from .oairequester import RequestStats
+from .prometheus import PROMETHEUS_HOST, PrometheusExporter
+from .rawlog import RawLogWriter
 
+# Percentiles reported for latency and utilization metrics.
+REPORTED_PERCENTILES = [50, 90, 95, 99, 99.9]
+# Default gap in seconds between two generated tokens counted as a stall.
+STALL_THRESHOLD = 1.0
+
+
+# Initial number of samples each _Samples buffer can hold before growing.
+SAMPLES_INITIAL_CAPACITY = 1024
 
 class _Samples:
-   def __init__(self):
-      # [0] timestamp, [1] value
-      self.samples:[(float, float)] = []
+   """
+   Columnar sample buffer backed by numpy timestamp and value arrays. Samples
+   are appended at the tail and trimmed from the head; the live samples are
+   always kept contiguous so values can be returned as zero-copy views.
+   """
+   def __init__(self, capacity:int=SAMPLES_INITIAL_CAPACITY):
+      self.timestamps = np.empty(capacity, dtype=np.float64)
+      self.values = np.empty(capacity, dtype=np.float64)
+      # running maximum of timestamps, which keeps it sorted even though
+      # requests complete (and are appended) out of start time order.
+      self.watermarks = np.empty(capacity, dtype=np.float64)
+      self.head = 0
+      self.tail = 0
 
    def _trim_oldest(self, duration:float):
-      while len(self.samples) > 0 and (time.time() - self.samples[0][0]) > duration:
-         self.samples.pop(0)
+      # Drop all samples up to the first one that is still within duration,
+      # found with a binary search over the sorted watermarks.
+      cutoff = time.time() - duration
+      self.head += int(np.searchsorted(self.watermarks[self.head:self.tail], cutoff, side="left"))
 
    def _append(self, timestamp:float, value:float):
-      self.samples.append((timestamp, value))
-
-   def _values(self) -> [float]:
-      values = []
-      for entry in self.samples:
-         values.append(entry[1])
-      return values
-   
+      if self.tail == len(self.values):
+         self._make_room()
+      watermark = timestamp
+      if self.tail > self.head and self.watermarks[self.tail - 1] > watermark:
+         watermark = self.watermarks[self.tail - 1]
+      self.timestamps[self.tail] = timestamp
+      self.values[self.tail] = value
+      self.watermarks[self.tail] = watermark
+      self.tail += 1
+
+   def _make_room(self):
+      count = self.tail - self.head
+      capacity = len(self.values)
+      # Grow when more than half full, otherwise compact live samples to the
+      # front. Either way the cost is amortized over at least capacity/2 appends.
+      if count > capacity // 2:
+         capacity *= 2
+      for name in ("timestamps", "values", "watermarks"):
+         array = getattr(self, name)
+         resized = array if capacity == len(array) else np.empty(capacity, dtype=array.dtype)
+         resized[:count] = array[self.head:self.tail]
+         setattr(self, name, resized)
+      self.head = 0
+      self.tail = count
+
+   def _values(self) -> np.ndarray:
+      """
+      Returns a read-only view of the values currently in the buffer.
+      """
+      view = self.values[self.head:self.tail]
+      view.flags.writeable = False
+      return view
+
    def _len(self) -> int:
-      return len(self.samples)
+      return self.tail - self.head
+
+class _WindowedHistogram:
+   """
+   Sliding window histogram. Values are recorded into one LogHistogram slot
+   per slot_duration seconds of sample timestamps, and the window is the merge
+   of all live slots, so its cost does not depend on the number of samples.
+   """
+   def __init__(self, window_duration:float, slot_duration:float=1.0, layout:HistogramLayout=DEFAULT_LAYOUT):
+      self.layout = layout
+      self.slot_duration = slot_duration
+      self.slot_count = int(math.ceil(window_duration / slot_duration)) + 1
+      self.counts = np.zeros((self.slot_count, layout.bucket_count), dtype=np.int64)
+      self.epochs = [-1] * self.slot_count
+      self.sizes = [0] * self.slot_count
+      self.sums = [0.0] * self.slot_count
+      self.mins = [math.inf] * self.slot_count
+      self.maxs = [-math.inf] * self.slot_count
+
+   def _slot(self, timestamp:float) -> int:
+      """
+      Returns the slot of timestamp, reset if it held an older epoch, or -1
+      if timestamp is older than the whole window.
+      """
+      epoch = int(timestamp // self.slot_duration)
+      slot = epoch % self.slot_count
+      if self.epochs[slot] != epoch:
+         if self.epochs[slot] > epoch:
+            return -1
+         self._reset_slot(slot)
+         self.epochs[slot] = epoch
+      return slot
+
+   def _append(self, timestamp:float, value:float):
+      slot = self._slot(timestamp)
+      if slot < 0:
+         return
+      self.counts[slot, self.layout.index(value)] += 1
+      self.sizes[slot] += 1
+      self.sums[slot] += value
+      if value < self.mins[slot]:
+         self.mins[slot] = value
+      if value > self.maxs[slot]:
+         self.maxs[slot] = value
+
+   def _append_many(self, timestamp:float, values:np.ndarray):
+      """
+      Appends several values sharing one timestamp.
+      """
+      if len(values) == 0:
+         return
+      slot = self._slot(timestamp)
+      if slot < 0:
+         return
+      self.counts[slot] += np.bincount(self.layout.indexes(values), minlength=self.layout.bucket_count)
+      self.sizes[slot] += len(values)
+      self.sums[slot] += float(np.sum(values))
+      self.mins[slot] = min(self.mins[slot], float(np.min(values)))
+      self.maxs[slot] = max(self.maxs[slot], float(np.max(values)))
+
+   def _merge(self, timestamp:float, histogram:LogHistogram):
+      """
+      Merges a histogram of values sharing one timestamp.
+      """
+      if histogram.count == 0:
+         return
+      slot = self._slot(timestamp)
+      if slot < 0:
+         return
+      self.counts[slot] += histogram.counts
+      self.sizes[slot] += histogram.count
+      self.sums[slot] += histogram.sum
+      self.mins[slot] = min(self.mins[slot], histogram.min)
+      self.maxs[slot] = max(self.maxs[slot], histogram.max)
+
+   def _reset_slot(self, slot:int):
+      if self.sizes[slot] > 0:
+         self.counts[slot, :] = 0
+      self.epochs[slot] = -1
+      self.sizes[slot] = 0
+      self.sums[slot] = 0.0
+      self.mins[slot] = math.inf
+      self.maxs[slot] = -math.inf
+
+   def _trim_oldest(self, duration:float):
+      cutoff_epoch = int((time.time() - duration) // self.slot_duration)
+      for slot in range(self.slot_count):
+         if 0 <= self.epochs[slot] < cutoff_epoch:
+            self._reset_slot(slot)
+
+   def _histogram(self) -> LogHistogram:
+      """
+      Returns the merge of all slots within the window.
+      """
+      histogram = LogHistogram(self.layout)
+      live = [slot for slot in range(self.slot_count) if self.sizes[slot] > 0]
+      if len(live) > 0:
+         histogram.counts = self.counts[live].sum(axis=0)
+         histogram.count = sum(self.sizes[slot] for slot in live)
+         histogram.sum = sum(self.sums[slot] for slot in live)
+         histogram.min = min(self.mins[slot] for slot in live)
+         histogram.max = max(self.maxs[slot] for slot in live)
+      return histogram
+
+   def _len(self) -> int:
+      return sum(self.sizes)
+
+class _SlotSums:
+   """
+   Sums of the values of one metric, by slot_duration seconds of sample
+   timestamps, see _IntervalMetrics.
+   """
+   def __init__(self, slot_duration:float):
+      self.slot_duration = slot_duration
+      self.slots = collections.defaultdict(float)
+
+   def _append(self, timestamp:float, value:float):
+      self.slots[int(timestamp // self.slot_duration)] += value
+
+   def _encode(self) -> list:
+      """
+      Returns [slot start time, sum] pairs.
+      """
+      return [[epoch * self.slot_duration, value] for epoch, value in self.slots.items()]
+
+class _SlotHistograms:
+   """
+   Histograms of the values of one metric, by slot_duration seconds of sample
+   timestamps, see _IntervalMetrics.
+   """
+   def __init__(self, slot_duration:float, layout:HistogramLayout=DEFAULT_LAYOUT):
+      self.slot_duration = slot_duration
+      self.layout = layout
+      self.slots = {}
+
+   def _histogram(self, timestamp:float) -> LogHistogram:
+      epoch = int(timestamp // self.slot_duration)
+      histogram = self.slots.get(epoch)
+      if histogram is None:
+         histogram = LogHistogram(self.layout)
+         self.slots[epoch] = histogram
+      return histogram
+
+   def _append(self, timestamp:float, value:float):
+      self._histogram(timestamp).record(value)
+
+   def _append_many(self, timestamp:float, values:np.ndarray):
+      if len(values) > 0:
+         self._histogram(timestamp).record_many(values)
+
+   def _encode(self) -> list:
+      """
+      Returns the slot start time, count, sum, min, max, non empty bucket
+      indexes and their counts of each slot.
+      """
+      encoded = []
+      for epoch, histogram in self.slots.items():
+         indexes = np.flatnonzero(histogram.counts)
+         encoded.append([epoch * self.slot_duration, histogram.count, histogram.sum, histogram.min, histogram.max,
+                         indexes.tolist(), histogram.counts[indexes].tolist()])
+      return encoded
+
+def _decode_histogram(record:list, layout:HistogramLayout=DEFAULT_LAYOUT) -> (float, LogHistogram):
+   """
+   Returns the slot start time and histogram of a slot encoded by _SlotHistograms.
+   """
+   timestamp, count, total, low, high, indexes, counts = record
+   histogram = LogHistogram(layout)
+   histogram.counts[np.asarray(indexes, dtype=np.int64)] = counts
+   histogram.count = int(count)
+   histogram.sum = float(total)
+   histogram.min = float(low)
+   histogram.max = float(high)
+   return timestamp, histogram
+
+def _percentile_name(percentile:float) -> str:
+   return f"{percentile:g}th"
+
+def _summary(histogram:LogHistogram, digits:int, unit:str="") -> dict:
+   """
+   Summarizes a histogram into its average and REPORTED_PERCENTILES, using
+   "n/a" when there are not enough samples.
+   """
+   def fmt(value:float):
+      value = round(value, digits)
+      return f"{value}{unit}" if unit else value
+   summary = {"avg": fmt(histogram.mean()) if histogram.count > 0 else "n/a"}
+   for percentile, value in zip(REPORTED_PERCENTILES, histogram.percentiles(REPORTED_PERCENTILES)):
+      summary[_percentile_name(percentile)] = fmt(value) if histogram.count > 1 else "n/a"
+   return summary
+
+def _request_metrics(window:float, completed:int, failures:int, throttled:int, retries:int, successes:int,
+                     context_tokens:float, generated_tokens:float, stalls:int,
+                     e2e:LogHistogram, ttft:LogHistogram, tbt:LogHistogram, util:LogHistogram,
+                     ttft_intended:LogHistogram, e2e_intended:LogHistogram,
+                     ttft_user:LogHistogram, e2e_user:LogHistogram,
+                     new_connections:int, reused_connections:int,
+                     dns:LogHistogram, connect:LogHistogram, headers:LogHistogram) -> dict:
+   """
+   Defines the reported metrics of a group of requests, shared by the live
+   aggregator and the offline analysis of raw logs so both report the same.
+   :param window: duration in seconds rates are computed over.
+   :param completed: number of completed requests since the start.
+   :param retries: number of retried attempts of completed requests since the start.
+   :param successes: number of successful requests in the window.
+   :param context_tokens: sum of context tokens of successful requests in the window.
+   :param generated_tokens: sum of generated tokens of successful requests in the window.
+   :param stalls: number of gaps between tokens longer than the stall threshold in the window.
+   :param tbt: histogram of the gaps between consecutive tokens in the window.
+   :param ttft_user: histogram of times to first token from the first attempt, retries included.
+   :param e2e_user: histogram of end to end times from the first attempt, retries included.
+   :param new_connections: number of requests in the window sent over a new connection.
+   :param reused_connections: number of requests in the window sent over a pooled connection.
+   :param dns: histogram of host resolution times of requests that resolved it.
+   :param connect: histogram of TCP connect and TLS handshake times of new connections.
+   :param headers: histogram of times from sending requests to receiving response headers.
+   """
+   context_per_minute = round(60.0 * context_tokens / window, 0) if successes > 0 else "n/a"
+   gen_per_minute = round(60.0 * generated_tokens / window, 0) if successes > 0 else "n/a"
+   tokens_per_minute = 0
+   if context_per_minute != "n/a":
+      tokens_per_minute += context_per_minute
+   if gen_per_minute != "n/a":
+      tokens_per_minute += gen_per_minute
+   rpm = round(60.0 * successes / window, 1)  if successes > 0 else "n/a"
+   return {
+      "rpm": rpm,
+      "completed": completed,
+      "failures": failures,
+      "throttled": throttled,
+      "retries": int(retries),
+      "requests": completed,
+      "tpm": {
+         "context": context_per_minute,
+         "gen": gen_per_minute,
+         "total": tokens_per_minute,
+      },
+      "stalls": int(stalls),
+      "e2e": _summary(e2e, 3),
+      "ttft": _summary(ttft, 3),
+      "tbt": _summary(tbt, 3),
+      "util": _summary(util, 1, "%"),
+      "ttft_intended": _summary(ttft_intended, 3),
+      "e2e_intended": _summary(e2e_intended, 3),
+      "ttft_user": _summary(ttft_user, 3),
+      "e2e_user": _summary(e2e_user, 3),
+      "connections": {
+         "new": int(new_connections),
+         "reused": int(reused_connections),
+      },
+      "dns": _summary(dns, 4),
+      "connect": _summary(connect, 4),
+      "headers": _summary(headers, 3),
+   }
+
+def _format_human(snapshot:dict) -> str:
+   """
+   Formats a snapshot as human readable lines, the totals then one line per
+   workload class and per routing target.
+   """
+   latencies = ""
+   metrics = ["ttft", "tbt", "e2e", "util", "lag"]
+   if snapshot["e2e_intended"]["avg"] != "n/a":
+      metrics += ["ttft_intended", "e2e_intended"]
+   if snapshot["retries"] > 0:
+      metrics += ["ttft_user", "e2e_user"]
+   for metric in metrics:
+      for name, value in snapshot[metric].items():
+         latencies += f" {metric}_{name}: {value:<6}"
+   for metric in ["dns", "connect", "headers"]:
+      for name in ["avg", "95th"]:
+         latencies += f" {metric}_{name}: {snapshot[metric][name]:<6}"
+   connections = f" conn_new: {snapshot['connections']['new']:<4} conn_reused: {snapshot['connections']['reused']:<5}"
+   lines = [f"{snapshot['timestamp']} rpm: {snapshot['rpm']:<5} processing: {snapshot['processing']:<4} completed: {snapshot['completed']:<5} failures: {snapshot['failures']:<4} throttled: {snapshot['throttled']:<4} retries: {snapshot['retries']:<4} requests: {snapshot['requests']:<5} tpm: {snapshot['tpm']['total']:<6} stalls: {snapshot['stalls']:<4}{connections}{latencies} stats_cpu: {snapshot['stats_cpu']:<6}"]
+   for kind, key in [("class", "classes"), ("endpoint", "endpoints")]:
+      for name, group in snapshot.get(key, {}).items():
+         latencies = ""
+         for metric in ["ttft", "e2e"]:
+            for stat in ["avg", "95th", "99th"]:
+               latencies += f" {metric}_{stat}: {group[metric][stat]:<6}"
+         lines.append(f"  {kind}: {name:<12} rpm: {group['rpm']:<5} completed: {group['completed']:<5} failures: {group['failures']:<4} throttled: {group['throttled']:<4} tpm: {group['tpm']['total']:<6}{latencies}")
+   return "\n".join(lines)
+
+class _RequestMetrics:
+   """
+   Counters and sliding window metrics of a group of requests, either all
+   requests of a run or the requests of one workload class or routing target.
+   """
+   # sliding window sums, by attribute name
+   SUMS = ["successes", "context_tokens", "generated_tokens", "stalls", "new_connections", "reused_connections"]
+   # sliding window histograms, by attribute name
+   HISTOGRAMS = ["request_latency", "response_latencies", "first_token_latencies", "token_latencies", "utilizations",
+                 "intended_latencies", "intended_first_token_latencies", "user_latencies", "user_first_token_latencies",
+                 "dns_latencies", "connect_latencies", "header_latencies"]
+   # cumulative histogram of the sliding window histograms exported to prometheus
+   CUMULATIVE = {"request_latency": "e2e_seconds", "first_token_latencies": "ttft_seconds", "token_latencies": "tbt_seconds", "utilizations": "utilization_percent"}
+
+   def __init__(self, window_duration:float, slot_duration:float, stall_threshold:float=STALL_THRESHOLD):
+      self.window_duration = window_duration
+      self.slot_duration = slot_duration
+      self.stall_threshold = stall_threshold
+      self.total_requests_count = 0
+      self.total_failed_count = 0
+      self.throttled_count = 0
+      self.retries_count = 0
+      self.successes = self._sums()
+      self.request_latency = self._histograms()
+      self.response_latencies = self._histograms()
+      self.first_token_latencies = self._histograms()
+      self.token_latencies = self._histograms()
+      self.context_tokens = self._sums()
+      self.generated_tokens = self._sums()
+      self.stalls = self._sums()
+      self.utilizations = self._histograms()
+      # latencies measured from the intended rather than actual start time
+      self.intended_latencies = self._histograms()
+      self.intended_first_token_latencies = self._histograms()
+      # latencies measured from the first attempt, as a user retrying would wait
+      self.user_latencies = self._histograms()
+      self.user_first_token_latencies = self._histograms()
+      # requests sent over a new connection and over a pooled one
+      self.new_connections = self._sums()
+      self.reused_connections = self._sums()
+      self.dns_latencies = self._histograms()
+      self.connect_latencies = self._histograms()
+      self.header_latencies = self._histograms()
+      # totals since the start of the run, for the prometheus exporter
+      self.total_context_tokens = 0
+      self.total_generated_tokens = 0
+      self.cumulative = {name: LogHistogram() for name in self.CUMULATIVE.values()}
+
+   def _sums(self):
+      return _Samples()
+
+   def _histograms(self):
+      return _WindowedHistogram(self.window_duration, self.slot_duration)
+
+   def _aggregate(self, stats: RequestStats):
+      self.total_requests_count += 1
+      self.retries_count += max(0, stats.calls - 1)
+      if stats.response_status_code != 200:
+         self.total_failed_count += 1
+         if stats.response_status_code == 429:
+            self.throttled_count += 1
+      else:
+         self.request_latency._append(stats.request_start_time, stats.response_end_time - stats.request_start_time)
+         self.successes._append(stats.request_start_time, 1)
+         self.response_latencies._append(stats.request_start_time, stats.response_time - stats.request_start_time)
+         if stats.first_token_time is not None:
+            self.first_token_latencies._append(stats.request_start_time, stats.first_token_time - stats.request_start_time)
+         gaps = stats.token_gaps()
+         self.token_latencies._append_many(stats.request_start_time, gaps)
+         self.stalls._append(stats.request_start_time, np.count_nonzero(gaps > self.stall_threshold))
+         self.context_tokens._append(stats.request_start_time, stats.context_tokens)
+         self.generated_tokens._append(stats.request_start_time, stats.generated_tokens)
+         self.total_context_tokens += stats.context_tokens
+         self.total_generated_tokens += stats.generated_tokens
+         self.cumulative["e2e_seconds"].record(stats.response_end_time - stats.request_start_time)
+         if stats.first_token_time is not None:
+            self.cumulative["ttft_seconds"].record(stats.first_token_time - stats.request_start_time)
+         self.cumulative["tbt_seconds"].record_many(gaps)
+         if stats.intended_start_time is not None:
+            self.intended_latencies._append(stats.request_start_time, stats.response_end_time - stats.intended_start_time)
+            if stats.first_token_time is not None:
+               self.intended_first_token_latencies._append(stats.request_start_time, stats.first_token_time - stats.intended_start_time)
+         first_attempt_time = stats.first_attempt_time if stats.first_attempt_time is not None else stats.request_start_time
+         self.user_latencies._append(stats.request_start_time, stats.response_end_time - first_attempt_time)
+         if stats.first_token_time is not None:
+            self.user_first_token_latencies._append(stats.request_start_time, stats.first_token_time - first_attempt_time)
+      if stats.deployment_utilization is not None:
+         self.utilizations._append(stats.request_start_time, stats.deployment_utilization)
+         self.cumulative["utilization_percent"].record(stats.deployment_utilization)
+      if stats.new_connection is not None:
+         self.new_connections._append(stats.request_start_time, int(stats.new_connection))
+         self.reused_connections._append(stats.request_start_time, 1 - int(stats.new_connection))
+      if stats.dns_time is not None:
+         self.dns_latencies._append(stats.request_start_time, stats.dns_time)
+      if stats.connect_time is not None:
+         self.connect_latencies._append(stats.request_start_time, stats.connect_time)
+      if stats.headers_time is not None:
+         self.header_latencies._append(stats.request_start_time, stats.headers_time)
+
+   def _snapshot(self, window:float) -> dict:
+      """
+      Computes current aggregates, with rates over window seconds.
+      """
+      return _request_metrics(window,
+         completed=self.total_requests_count,
+         failures=self.total_failed_count,
+         throttled=self.throttled_count,
+         retries=self.retries_count,
+         successes=np.sum(self.successes._values()),
+         context_tokens=np.sum(self.context_tokens._values()),
+         generated_tokens=np.sum(self.generated_tokens._values()),
+         stalls=np.sum(self.stalls._values()),
+         e2e=self.request_latency._histogram(),
+         ttft=self.first_token_latencies._histogram(),
+         tbt=self.token_latencies._histogram(),
+         util=self.utilizations._histogram(),
+         ttft_intended=self.intended_first_token_latencies._histogram(),
+         e2e_intended=self.intended_latencies._histogram(),
+         ttft_user=self.user_first_token_latencies._histogram(),
+         e2e_user=self.user_latencies._histogram(),
+         new_connections=np.sum(self.new_connections._values()),
+         reused_connections=np.sum(self.reused_connections._values()),
+         dns=self.dns_latencies._histogram(),
+         connect=self.connect_latencies._histogram(),
+         headers=self.header_latencies._histogram())
+
+   def _published(self, labels:dict) -> dict:
+      """
+      Returns a copy of counters and cumulative histograms since the start of
+      the run, see PrometheusExporter.publish.
+      """
+      published = {
+         "labels": labels,
+         "requests_total": self.total_requests_count,
+         "failures_total": self.total_failed_count,
+         "throttled_total": self.throttled_count,
+         "retries_total": self.retries_count,
+         "context_tokens_total": self.total_context_tokens,
+         "generated_tokens_total": self.total_generated_tokens,
+      }
+      for name, histogram in self.cumulative.items():
+         published[name] = histogram.counts.copy()
+         published[name + "_count"] = histogram.count
+         published[name + "_sum"] = histogram.sum
+      return published
+
+   def _merge(self, interval:dict, offset:float=0.0):
+      """
+      Merges the metrics of an interval encoded by _IntervalMetrics._encode.
+      :param offset: seconds the clock of the interval is ahead of ours.
+      """
+      self.total_requests_count += interval["completed"]
+      self.total_failed_count += interval["failures"]
+      self.throttled_count += interval["throttled"]
+      self.retries_count += interval["retries"]
+      self.total_context_tokens += interval["context_tokens"]
+      self.total_generated_tokens += interval["generated_tokens"]
+      for name in self.SUMS:
+         sums = getattr(self, name)
+         for timestamp, value in interval["sums"].get(name, []):
+            sums._append(timestamp - offset, value)
+      for name in self.HISTOGRAMS:
+         histograms = getattr(self, name)
+         for record in interval["histograms"].get(name, []):
+            timestamp, histogram = _decode_histogram(record)
+            histograms._merge(timestamp - offset, histogram)
+            if name in self.CUMULATIVE:
+               self.cumulative[self.CUMULATIVE[name]].merge(histogram)
+
+   def _trim_oldest(self, duration:float):
+      for name in self.SUMS + self.HISTOGRAMS:
+         getattr(self, name)._trim_oldest(duration)
+
+class _IntervalMetrics(_RequestMetrics):
+   """
+   Metrics of the requests of a group completed during an interval, kept as
+   counters, sums and histogram buckets by slot of request start time, which
+   _RequestMetrics._merge merges into sliding windows. Remote agents send
+   these instead of the stats of every request.
+   """
+   def __init__(self, slot_duration:float, stall_threshold:float=STALL_THRESHOLD):
+      super().__init__(None, slot_duration, stall_threshold)
+
+   def _sums(self):
+      return _SlotSums(self.slot_duration)
+
+   def _histograms(self):
+      return _SlotHistograms(self.slot_duration)
+
+   def _encode(self) -> dict:
+      return {
+         "completed": self.total_requests_count,
+         "failures": self.total_failed_count,
+         "throttled": self.throttled_count,
+         "retries": self.retries_count,
+         "context_tokens": self.total_context_tokens,
+         "generated_tokens": self.total_generated_tokens,
+         "sums": {name: getattr(self, name)._encode() for name in self.SUMS if len(getattr(self, name).slots) > 0},
+         "histograms": {name: getattr(self, name)._encode() for name in self.HISTOGRAMS if len(getattr(self, name).slots) > 0},
+      }
+
+def _encode_interval(new_requests:int, batch:[RequestStats], loop_lags:list, slot_duration:float, stall_threshold:float=STALL_THRESHOLD) -> dict:
+   """
+   Aggregates the requests completed during an interval into the metrics of
+   all requests, of each workload class and of each routing target, see
+   _StatsAggregator.aggregate_interval.
+   :param new_requests: number of requests started during the interval.
+   :param batch: stats of the requests completed during the interval.
+   :param loop_lags: (timestamp, lag) event loop lag samples of the interval.
+   :param slot_duration: duration in seconds of the slots of the aggregator the interval is merged into.
+   """
+   totals = _IntervalMetrics(slot_duration, stall_threshold)
+   classes = {}
+   endpoints = {}
+   for stats in batch:
+      totals._aggregate(stats)
+      for groups, name in [(classes, stats.workload_class), (endpoints, stats.endpoint)]:
+         if name is None:
+            continue
+         if name not in groups:
+            groups[name] = _IntervalMetrics(slot_duration, stall_threshold)
+         groups[name]._aggregate(stats)
+   lags = _SlotHistograms(slot_duration)
+   for timestamp, lag in loop_lags:
+      lags._append(timestamp, lag)
+   return {
+      "new_requests": new_requests,
+      "totals": totals._encode(),
+      "classes": {name: metrics._encode() for name, metrics in classes.items()},
+      "endpoints": {name: metrics._encode() for name, metrics in endpoints.items()},
+      "loop_lags": lags._encode(),
+   }
 
 class _StatsAggregator(threading.Thread):
    """
    A thread-safe request stats aggregator that can periodically emit statistics.
+   Metrics are kept for all requests, and separately for each workload class
+   and each routing target.
    """
    lock = threading.Lock()
-   terminate: threading.Event
 
    start_time: float = 0
    processing_requests_count: int = 0
-   total_requests_count: int = 0
-   total_failed_count: int = 0
-   throttled_count: int = 0
-
-   request_timestamps = _Samples()
-   request_latency = _Samples()
-   call_tries = _Samples()
-   response_latencies = _Samples()
-   first_token_latencies = _Samples()
-   token_latencies = _Samples()
-   context_tokens = _Samples()
-   generated_tokens = _Samples()
-   utilizations = _Samples()
-
-   def __init__(self, clients:int, dump_duration:float=5, window_duration:float=60, json_output=False, *args,**kwargs):
+   # total cpu time in seconds the aggregator thread spent aggregating and
+   # printing stats, which the event loop cannot use while it holds the GIL
+   stats_cpu_time: float = 0
+
+   def __init__(self, clients:int, dump_duration:float=5, window_duration:float=60, json_output=False, print_stats=True, raw_log_dir:str=None, stall_threshold:float=STALL_THRESHOLD, prometheus_port:int=None, prometheus_host:str=PROMETHEUS_HOST, *args,**kwargs):
       """
       :param clients: number of clients used in testing
       :param dump_duration: duration in seconds to dump current aggregates.
       :param window_duration: duration of sliding window in second to consider for aggregation.
       :param json_output: whether to dump periodic stats as json or human readable.
+      :param print_stats: whether to print periodic stats, callers reading
+      _snapshot() directly can turn printing off.
+      :param raw_log_dir: optional directory to write every request stat to, see RawLogWriter.
+      :param stall_threshold: gap in seconds between two tokens counted as a stall.
+      :param prometheus_port: optional port to serve metrics on for Prometheus, see PrometheusExporter.
+      :param prometheus_host: address to serve metrics on.
       """
       self.clients = clients
       self.dump_duration = dump_duration
       self.json_output = json_output
+      self.print_stats = print_stats
       self.window_duration = window_duration
+      self.terminate = threading.Event()
+      # stats are handed over through a deque, whose append and popleft are
+      # atomic, so ingestion never contends with the aggregator thread.
+      self.pending = collections.deque()
+      self.pending_loop_lags = collections.deque()
+      self.pending_intervals = collections.deque()
+
+      self.stall_threshold = stall_threshold
+      self.totals = _RequestMetrics(window_duration, dump_duration, stall_threshold)
+      # metrics of each workload class, by class name
+      self.classes = {}
+      # metrics of each routing target, by target name
+      self.endpoints = {}
+      self.loop_lags = _WindowedHistogram(window_duration, dump_duration)
+      self.raw_log = RawLogWriter(raw_log_dir) if raw_log_dir is not None else None
+      self.exporter = PrometheusExporter(prometheus_port, prometheus_host) if prometheus_port is not None else None
 
       super(_StatsAggregator, self).__init__(*args, **kwargs)
 
+   @property
+   def total_requests_count(self) -> int:
+      return self.totals.total_requests_count
+
+   @property
+   def total_failed_count(self) -> int:
+      return self.totals.total_failed_count
+
+   @property
+   def throttled_count(self) -> int:
+      return self.totals.throttled_count
+
    def run(self):
       """
       Start the periodic aggregator. Use stop() to stop.
       """
       self.start_time = time.time()
-      self.terminate = threading.Event()
+      if self.raw_log is not None:
+         self.raw_log.start()
+      if self.exporter is not None:
+         self.exporter.start()
       while not self.terminate.wait(self.dump_duration):
+         cpu_start = time.thread_time()
+         self._drain()
+         self._publish()
          self._dump()
          self._slide_window()
+         self.stats_cpu_time += time.thread_time() - cpu_start
 
    def stop(self):
       self.terminate.set()
+      if self.is_alive():
+         self.join()
       # Dump one more time to ensure we include the final request
+      self._drain()
+      self._publish()
       self._dump()
+      if self.raw_log is not None:
+         self.raw_log.stop()
+      if self.exporter is not None:
+         self.exporter.stop()
 
    def record_new_request(self):
       """
       Records a new request, so that the number of processing requests is known.
+      Safe to call from any thread, it never waits on the aggregator thread.
       """
-      with self.lock:
-         self.processing_requests_count += 1
+      self.pending.append(None)
 
    def aggregate_request(self, stats: RequestStats):
       """
-      Aggregates request stat within the sliding window.
+      Queues request stat for aggregation within the sliding window. Safe to
+      call from any thread, it never waits on the aggregator thread.
       :param stats: request stats object.
       """
+      self.pending.append(stats)
+
+   def record_loop_lag(self, timestamp:float, lag:float):
+      """
+      Queues an event loop lag sample for aggregation. Safe to call from any thread.
+      :param timestamp: time the sample was taken.
+      :param lag: delay in seconds of a scheduled callback.
+      """
+      self.pending_loop_lags.append((timestamp, lag))
+
+   def aggregate_interval(self, interval:dict, offset:float=0.0):
+      """
+      Queues the metrics of an interval for merging within the sliding
+      window. Safe to call from any thread.
+      :param interval: metrics encoded by _encode_interval.
+      :param offset: seconds the clock of the interval is ahead of ours.
+      """
+      self.pending_intervals.append((interval, offset))
+
+   def _drain(self):
+      """
+      Aggregates all requests queued so far.
+      """
       with self.lock:
-         self.processing_requests_count -= 1
-         self.total_requests_count += 1
-         self.call_tries._append(stats.request_start_time, stats.calls)
-         if stats.response_status_code != 200:
-            self.total_failed_count += 1
-            if stats.response_status_code == 429:
-               self.throttled_count += 1
-         else:
-            request_latency = stats.response_end_time - stats.request_start_time
-            self.request_latency._append(stats.request_start_time, request_latency)
-            if request_latency > self.window_duration:
-               logging.warning((
-                     f"request completed in {round(request_latency, 2)} seconds, while aggregation-window is {round(self.window_duration, 2)} "
-                     "seconds, consider increasing aggregation-window to at least 2x your typical request latency."
-                  )
-               )   
-            self.request_timestamps._append(stats.request_start_time, stats.request_start_time)
-            self.response_latencies._append(stats.request_start_time, stats.response_time - stats.request_start_time)
-            self.first_token_latencies._append(stats.request_start_time, stats.first_token_time - stats.request_start_time)
-            self.token_latencies._append(stats.request_start_time, (stats.response_end_time - stats.first_token_time) / stats.generated_tokens)
-            self.context_tokens._append(stats.request_start_time, stats.context_tokens)
-            self.generated_tokens._append(stats.request_start_time, stats.generated_tokens)
-         if stats.deployment_utilization is not None:
-            self.utilizations._append(stats.request_start_time, stats.deployment_utilization)
+         for _ in range(len(self.pending)):
+            stats = self.pending.popleft()
+            if stats is None:
+               self.processing_requests_count += 1
+               continue
+            if self.raw_log is not None:
+               self.raw_log.append(stats)
+            try:
+               self._aggregate(stats)
+            except Exception as e:
+               logging.warning(f"unable to aggregate request stats: {e}")
+         for _ in range(len(self.pending_loop_lags)):
+            self.loop_lags._append(*self.pending_loop_lags.popleft())
+         for _ in range(len(self.pending_intervals)):
+            try:
+               self._merge(*self.pending_intervals.popleft())
+            except Exception as e:
+               logging.warning(f"unable to merge interval stats: {e}")
+
+   def _aggregate(self, stats: RequestStats):
+      self.processing_requests_count -= 1
+      if stats.response_status_code == 200:
+         request_latency = stats.response_end_time - stats.request_start_time
+         if request_latency > self.window_duration:
+            logging.warning((
+                  f"request completed in {round(request_latency, 2)} seconds, while aggregation-window is {round(self.window_duration, 2)} "
+                  "seconds, consider increasing aggregation-window to at least 2x your typical request latency."
+               )
+            )   
+      self.totals._aggregate(stats)
+      for groups, name in [(self.classes, stats.workload_class), (self.endpoints, stats.endpoint)]:
+         if name is None:
+            continue
+         metrics = groups.get(name)
+         if metrics is None:
+            metrics = _RequestMetrics(self.window_duration, self.dump_duration, self.stall_threshold)
+            groups[name] = metrics
+         metrics._aggregate(stats)
+
+   def _merge(self, interval:dict, offset:float):
+      self.processing_requests_count += interval["new_requests"] - interval["totals"]["completed"]
+      self.totals._merge(interval["totals"], offset)
+      for groups, key in [(self.classes, "classes"), (self.endpoints, "endpoints")]:
+         for name, group in interval[key].items():
+            metrics = groups.get(name)
+            if metrics is None:
+               metrics = _RequestMetrics(self.window_duration, self.dump_duration, self.stall_threshold)
+               groups[name] = metrics
+            metrics._merge(group, offset)
+      for record in interval["loop_lags"]:
+         timestamp, histogram = _decode_histogram(record)
+         self.loop_lags._merge(timestamp - offset, histogram)
+
+   def _publish(self):
+      """
+      Hands a copy of current counters and histograms to the exporter, if any.
+      """
+      if self.exporter is None:
+         return
+      with self.lock:
+         groups = [self.totals._published({})]
+         groups += [metrics._published({"class": name}) for name, metrics in sorted(self.classes.items())]
+         groups += [metrics._published({"endpoint": name}) for name, metrics in sorted(self.endpoints.items())]
+         processing = min(self.clients, self.processing_requests_count)
+      self.exporter.publish({"processing": processing, "groups": groups})
 
    def _dump(self):
+      if not self.print_stats:
+         return
       with self.lock:
-         run_seconds = round(time.time() - self.start_time)
-         # Use dynamic aggregation window for when elapsed duration < window_duration
-         dynamic_window = min(run_seconds, self.window_duration)
-         timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-         e2e_latency_avg = round(np.average(self.request_latency._values()), 3) if self.request_latency._len() > 0 else "n/a"
-         e2e_latency_95th = round(np.percentile(self.request_latency._values(), 95), 3) if self.request_latency._len() > 1 else "n/a"
-         context_per_minute = round(60.0 * np.sum(self.context_tokens._values()) / dynamic_window, 0) if self.context_tokens._len() > 0 else "n/a"
-         gen_per_minute = round(60.0 * np.sum(self.generated_tokens._values()) / dynamic_window, 0) if self.generated_tokens._len() > 0 else "n/a"
-         tokens_per_minute = 0
-         if context_per_minute != "n/a":
-            tokens_per_minute += context_per_minute
-         if gen_per_minute != "n/a":
-            tokens_per_minute += gen_per_minute
-         ttft_avg = round(np.average(self.first_token_latencies._values()), 3) if self.first_token_latencies._len() > 0 else "n/a"
-         ttft_95th = round(np.percentile(self.first_token_latencies._values(), 95), 3) if self.first_token_latencies._len() > 1 else "n/a"
-         tbt_avg = round(np.average(self.token_latencies._values()), 3) if self.token_latencies._len() > 0 else "n/a"
-         tbt_95th = round(np.percentile(self.token_latencies._values(), 95), 3) if self.token_latencies._len() > 1 else "n/a"
-         util_avg = f"{round(np.average(self.utilizations._values()), 1)}%" if self.utilizations._len() > 0 else "n/a"
-         util_95th = f"{round(np.percentile(self.utilizations._values(), 95), 1)}%" if self.utilizations._len() > 1 else "n/a"
-         rpm = round(60.0 * self.request_timestamps._len() / dynamic_window, 1)  if self.request_timestamps._len() > 0 else "n/a"
-         # Handle the 1x extra processing_request due to next request being queued
-         processing_requests_count = min(self.clients, self.processing_requests_count)
-         if self.json_output:
-            j = {
-               "run_seconds": run_seconds,
-               "timestamp": timestamp,
-               "rpm": rpm,
-               "processing": processing_requests_count,
-               "completed": self.total_requests_count,
-               "failures": self.total_failed_count,
-               "throttled": self.throttled_count,
-               "requests": self.total_requests_count,
-               "tpm": {
-                  "context": context_per_minute,
-                  "gen": gen_per_minute,
-                  "total": tokens_per_minute,
-               },
-               "e2e": {
-                  "avg": e2e_latency_avg,
-                  "95th": e2e_latency_95th,
-               },
-               "ttft": {
-                  "avg": ttft_avg,
-                  "95th": ttft_95th,
-               },
-               "tbt": {
-                  "avg": tbt_avg,
-                  "95th": tbt_95th,
-               },
-               "util": {
-                  "avg": util_avg,
-                  "95th": util_95th,
-               },
-            }
-            print(json.dumps(j), flush=True)
-         else:
-            print(f"{timestamp} rpm: {rpm:<5} processing: {processing_requests_count:<4} completed: {self.total_requests_count:<5} failures: {self.total_failed_count:<4} throttled: {self.throttled_count:<4} requests: {self.total_requests_count:<5} tpm: {tokens_per_minute:<6} ttft_avg: {ttft_avg:<6} ttft_95th: {ttft_95th:<6} tbt_avg: {tbt_avg:<6} tbt_95th: {tbt_95th:<6} e2e_avg: {e2e_latency_avg:<6} e2e_95th: {e2e_latency_95th:<6} util_avg: {util_avg:<6} util_95th: {util_95th:<6}", flush=True)
+         snapshot = self._snapshot()
+      if self.json_output:
+         print(json.dumps(snapshot), flush=True)
+      else:
+         print(_format_human(snapshot), flush=True)
+
+   def _snapshot(self) -> dict:
+      """
+      Computes current aggregates. Caller must hold self.lock.
+      """
+      run_seconds = round(time.time() - self.start_time)
+      # Use dynamic aggregation window for when elapsed duration < window_duration
+      dynamic_window = max(1, min(run_seconds, self.window_duration))
+      timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+      # Handle the 1x extra processing_request due to next request being queued
+      processing_requests_count = min(self.clients, self.processing_requests_count)
+      totals = self.totals._snapshot(dynamic_window)
+      snapshot = {
+         "run_seconds": run_seconds,
+         "timestamp": timestamp,
+         "rpm": totals["rpm"],
+         "processing": processing_requests_count,
+         "completed": totals["completed"],
+         "failures": totals["failures"],
+         "throttled": totals["throttled"],
+         "retries": totals["retries"],
+         "requests": totals["requests"],
+         "stats_cpu": round(self.stats_cpu_time, 4),
+         "tpm": totals["tpm"],
+         "stalls": totals["stalls"],
+         "e2e": totals["e2e"],
+         "ttft": totals["ttft"],
+         "tbt": totals["tbt"],
+         "util": totals["util"],
+         "lag": _summary(self.loop_lags._histogram(), 4),
+         "ttft_intended": totals["ttft_intended"],
+         "e2e_intended": totals["e2e_intended"],
+         "ttft_user": totals["ttft_user"],
+         "e2e_user": totals["e2e_user"],
+         "connections": totals["connections"],
+         "dns": totals["dns"],
+         "connect": totals["connect"],
+         "headers": totals["headers"],
+      }
+      if len(self.classes) > 0:
+         snapshot["classes"] = {name: metrics._snapshot(dynamic_window) for name, metrics in sorted(self.classes.items())}
+      if len(self.endpoints) > 0:
+         snapshot["endpoints"] = {name: metrics._snapshot(dynamic_window) for name, metrics in sorted(self.endpoints.items())}
+      return snapshot
 
    def _slide_window(self):
       with self.lock:
-         self.call_tries._trim_oldest(self.window_duration)
-         self.request_timestamps._trim_oldest(self.window_duration)
-         self.response_latencies._trim_oldest(self.window_duration)
-         self.first_token_latencies._trim_oldest(self.window_duration)
-         self.token_latencies._trim_oldest(self.window_duration)
-         self.context_tokens._trim_oldest(self.window_duration)
-         self.generated_tokens._trim_oldest(self.window_duration)
-         self.utilizations._trim_oldest(self.window_duration)
+         self.totals._trim_oldest(self.window_duration)
+         for metrics in list(self.classes.values()) + list(self.endpoints.values()):
+            metrics._trim_oldest(self.window_duration)
+         self.loop_lags._trim_oldest(self.window_duration)
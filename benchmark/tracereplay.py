@@ -0,0 +1,111 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import asyncio
+import collections
+import json
+import logging
+import time
+from typing import Iterator
+
+from .loadcmd import _BackgroundText, _RequestBuilder, _unique_prefix
+from .oaitokenizer import num_tokens_from_messages
+from .ratelimiting import ARRIVAL_SLEEP_GRANULARITY
+
+def _read_trace(path:str, shard:int=0, shards:int=1) -> Iterator[dict]:
+   """
+   Streams records of a jsonl trace, one per line, without loading the whole
+   file. Only every shards-th record starting from shard is parsed and returned.
+   """
+   with open(path) as f:
+      index = -1
+      for line_number, line in enumerate(f, 1):
+         line = line.strip()
+         if len(line) == 0:
+            continue
+         index += 1
+         if index % shards != shard:
+            continue
+         try:
+            record = json.loads(line)
+         except ValueError as e:
+            raise ValueError(f"{path}:{line_number}: invalid json: {e}")
+         if not isinstance(record.get("timestamp"), (int, float)):
+            raise ValueError(f"{path}:{line_number}: timestamp is required")
+         if "messages" not in record and not isinstance(record.get("context_tokens"), int):
+            raise ValueError(f"{path}:{line_number}: one of context_tokens or messages is required")
+         yield record
+
+class TraceReplay(_RequestBuilder):
+   """
+   Replays requests recorded in a jsonl trace on their recorded schedule. It is
+   both the rate limiter of the run, releasing each record at its recorded time,
+   and its request builder, building the body of the records it released in
+   order. Records are streamed from disk, so traces of any size can be replayed.
+   """
+   def __init__(self, path:str, model:str, speed:float=1.0, shard:int=0, shards:int=1,
+                completions:int=None,
+                frequency_penalty:float=None,
+                presence_penalty:float=None,
+                temperature:float=None,
+                top_p:float=None):
+      """
+      :param path: path of the jsonl trace.
+      :param model: model used to count tokens.
+      :param speed: speed-up factor of the recorded schedule.
+      :param shard: index of the share of records to replay.
+      :param shards: number of shares records are split into.
+      """
+      super().__init__(model, None,
+         max_tokens=None,
+         completions=completions,
+         frequency_penalty=frequency_penalty,
+         presence_penalty=presence_penalty,
+         temperature=temperature,
+         top_p=top_p,
+         pool_size=0)
+      self.speed = speed
+      self.records = _read_trace(path, shard, shards)
+      # records released by the rate limiter, waiting for their request to be built
+      self.released = collections.deque()
+      self.start_time = None
+      self.first_timestamp = None
+      self.intended_time = None
+      self.workload_class = None
+      # for records without messages
+      self.text = _BackgroundText(model)
+
+   async def __aenter__(self):
+      record = next(self.records, None)
+      if record is None:
+         logging.info("reached end of replay trace")
+         raise StopAsyncIteration
+      if self.start_time is None:
+         # the schedule starts once text for records without messages is ready
+         self.text.get()
+      now = time.time()
+      if self.start_time is None:
+         self.start_time = now
+         self.first_timestamp = record["timestamp"]
+      self.intended_time = self.start_time + (record["timestamp"] - self.first_timestamp) / self.speed
+      delay = self.intended_time - now
+      if delay > ARRIVAL_SLEEP_GRANULARITY:
+         await asyncio.sleep(delay)
+      self.released.append(record)
+      return self
+
+   async def __aexit__(self, *args):
+      pass
+
+   def __next__(self) -> (bytes, int):
+      # requests are started in the order their records were released
+      record = self.released.popleft()
+      self.workload_class = record.get("class")
+      max_tokens = record.get("max_tokens")
+      if "messages" in record:
+         messages = record["messages"]
+         messages_tokens = num_tokens_from_messages(messages, self.model)
+      else:
+         messages, messages_tokens = self.text.get().messages(record["context_tokens"], max_tokens)
+      body_parts = self._serialize(messages, max_tokens)
+      return _unique_prefix().encode().join(body_parts), messages_tokens
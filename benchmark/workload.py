@@ -0,0 +1,204 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import json
+import logging
+import os
+
+import numpy as np
+
+from .loadcmd import SHAPE_PROFILES, _BackgroundText, _RequestBuilder, _unique_prefix
+
+# Number of samples used to estimate the mean of a token length distribution.
+MEAN_ESTIMATE_SAMPLES = 10000
+
+def _is_int(value) -> bool:
+   # json true and false are bools, which are ints in python
+   return isinstance(value, int) and not isinstance(value, bool)
+
+class TokenLength:
+   """
+   Number of tokens of a workload class, either fixed or drawn from a
+   uniform or lognormal distribution, clipped to [min, max].
+   """
+   def __init__(self, spec):
+      """
+      :param spec: fixed number of tokens, None for unset, or a dict with
+      distribution (uniform or lognormal), min and max, and for lognormal
+      median and sigma.
+      """
+      self.fixed = None
+      self.distribution = None
+      if spec is None or _is_int(spec):
+         if spec is not None and spec < 1:
+            raise ValueError(f"token length must be > 0, got {spec}")
+         self.fixed = spec
+         return
+      if not isinstance(spec, dict):
+         raise ValueError(f"token length must be an integer or a distribution, got {spec}")
+      self.distribution = spec.get("distribution")
+      self.min = spec.get("min", 1)
+      self.max = spec.get("max")
+      if not _is_int(self.min) or (self.max is not None and not _is_int(self.max)):
+         raise ValueError(f"distribution min and max must be integers, got {self.min} and {self.max}")
+      if self.distribution == "uniform":
+         if self.max is None or self.max < self.min:
+            raise ValueError("uniform distribution requires max >= min")
+      elif self.distribution == "lognormal":
+         self.median = spec.get("median")
+         self.sigma = spec.get("sigma")
+         if self.median is None or self.median <= 0 or self.sigma is None or self.sigma < 0:
+            raise ValueError("lognormal distribution requires median > 0 and sigma >= 0")
+      else:
+         raise ValueError(f"unknown distribution {self.distribution}, use uniform or lognormal")
+      if self.min < 1:
+         raise ValueError("distribution min must be > 0")
+
+   def sample(self, rng:np.random.Generator) -> int:
+      if self.distribution is None:
+         return self.fixed
+      if self.distribution == "uniform":
+         return int(rng.integers(self.min, self.max, endpoint=True))
+      value = int(rng.lognormal(np.log(self.median), self.sigma))
+      return max(self.min, value if self.max is None else min(self.max, value))
+
+   def mean(self) -> float:
+      if self.distribution is None:
+         return self.fixed or 0
+      rng = np.random.default_rng(0)
+      return float(np.mean([self.sample(rng) for _ in range(MEAN_ESTIMATE_SAMPLES)]))
+
+class WorkloadClass:
+   """
+   A request shape of a workload, mixed with the other classes by weight.
+   """
+   def __init__(self, name:str, weight:float, context_tokens, max_tokens):
+      if weight <= 0:
+         raise ValueError(f"weight of class {name} must be > 0")
+      self.name = name
+      self.weight = weight
+      self.context_tokens = TokenLength(context_tokens)
+      self.max_tokens = TokenLength(max_tokens)
+      if self.context_tokens.fixed is None and self.context_tokens.distribution is None:
+         raise ValueError(f"context_tokens of class {name} is required")
+
+def _parse_workload(spec:str) -> [WorkloadClass]:
+   """
+   Parses a workload, either the path of a json file or an inline list of
+   comma separated name:weight[:context_tokens:max_tokens] classes, where a
+   class without token counts must be named after a shape profile.
+   """
+   if os.path.isfile(spec):
+      with open(spec) as f:
+         try:
+            workload = json.load(f)
+         except ValueError as e:
+            raise ValueError(f"invalid workload file {spec}: {e}")
+      entries = workload.get("classes") if isinstance(workload, dict) else None
+      if not isinstance(entries, list):
+         raise ValueError(f"workload file {spec} must hold a classes list")
+      classes = []
+      for entry in entries:
+         if not isinstance(entry, dict) or "name" not in entry:
+            raise ValueError(f"workload class must be an object with a name, got {entry}")
+         classes.append(WorkloadClass(str(entry["name"]), entry.get("weight", 1), entry.get("context_tokens"), entry.get("max_tokens")))
+   else:
+      classes = []
+      for entry in spec.split(","):
+         fields = entry.strip().split(":")
+         try:
+            if len(fields) == 2 and fields[0] in SHAPE_PROFILES:
+               context_tokens, max_tokens = SHAPE_PROFILES[fields[0]]
+            elif len(fields) == 4:
+               context_tokens, max_tokens = int(fields[2]), int(fields[3])
+            else:
+               raise ValueError()
+            weight = float(fields[1])
+         except ValueError:
+            raise ValueError(f"invalid workload class {entry}, expected name:weight:context_tokens:max_tokens or profile:weight")
+         classes.append(WorkloadClass(fields[0], weight, context_tokens, max_tokens))
+   if len(classes) == 0:
+      raise ValueError("workload must have at least one class")
+   names = [c.name for c in classes]
+   if len(set(names)) != len(names):
+      raise ValueError("workload class names must be unique")
+   return classes
+
+class WorkloadBuilder(_RequestBuilder):
+   """
+   Request builder mixing several workload classes by weight. Classes of fixed
+   size draw from their own prompt pool, classes whose token lengths follow a
+   distribution cut a prompt of the sampled size from a shared random text.
+   The class of the last built request is in workload_class.
+   """
+   def __init__(self, classes:[WorkloadClass], model:str,
+                completions:int=None,
+                frequency_penalty:float=None,
+                presence_penalty:float=None,
+                temperature:float=None,
+                top_p:float=None,
+                pool_size:int=16,
+                seed=None):
+      """
+      :param classes: workload classes to mix.
+      :param model: model used to count tokens.
+      :param pool_size: number of prompts in the pool of each fixed size class.
+      :param seed: optional random seed for class choice and token lengths.
+      """
+      super().__init__(model, None,
+         max_tokens=None,
+         completions=completions,
+         frequency_penalty=frequency_penalty,
+         presence_penalty=presence_penalty,
+         temperature=temperature,
+         top_p=top_p,
+         pool_size=0)
+      self.classes = classes
+      weights = np.array([c.weight for c in classes], dtype=float)
+      self.cumulative_weights = np.cumsum(weights / np.sum(weights))
+      self.rng = np.random.default_rng(seed)
+      self.workload_class = None
+      # only generated when a class follows a distribution
+      self.text = None
+      self.pools = []
+      for c in classes:
+         if c.context_tokens.distribution is None and c.max_tokens.distribution is None:
+            logging.info(f"class {c.name}: context tokens: {c.context_tokens.fixed}, max tokens: {c.max_tokens.fixed}")
+            self.pools.append(_RequestBuilder(model, c.context_tokens.fixed,
+               max_tokens=c.max_tokens.fixed,
+               completions=completions,
+               frequency_penalty=frequency_penalty,
+               presence_penalty=presence_penalty,
+               temperature=temperature,
+               top_p=top_p,
+               pool_size=pool_size))
+         else:
+            logging.info(f"class {c.name}: context tokens: {round(c.context_tokens.mean())} on average, max tokens: {round(c.max_tokens.mean())} on average")
+            self.pools.append(None)
+            if self.text is None:
+               self.text = _BackgroundText(model)
+
+   def expected_tokens(self) -> float:
+      """
+      Returns the expected number of tokens used by a request, averaged over
+      classes by weight.
+      """
+      weights = np.diff(self.cumulative_weights, prepend=0.0)
+      expected = 0.0
+      for weight, c, pool in zip(weights, self.classes, self.pools):
+         if pool is not None:
+            expected += weight * pool.expected_tokens()
+         else:
+            expected += weight * (c.context_tokens.mean() + c.max_tokens.mean() * (self.completions or 1))
+      return expected
+
+   def __next__(self) -> (bytes, int):
+      index = min(int(np.searchsorted(self.cumulative_weights, self.rng.random(), side="right")), len(self.classes) - 1)
+      c = self.classes[index]
+      self.workload_class = c.name
+      pool = self.pools[index]
+      if pool is not None:
+         return pool.__next__()
+      max_tokens = c.max_tokens.sample(self.rng)
+      messages, messages_tokens = self.text.get().messages(c.context_tokens.sample(self.rng), max_tokens)
+      return _unique_prefix().encode().join(self._serialize(messages, max_tokens)), messages_tokens
@@ -0,0 +1,100 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import argparse
+import contextlib
+import io
+import json
+import tempfile
+import unittest
+from unittest import mock
+from benchmark.analyzecmd import _Requests, analyze
+from benchmark.oairequester import RequestStats
+from benchmark.rawlog import RawLogWriter, read_raw_log
+
+def _request_stats(start, status_code=200, latency=1.0, workload_class=None, stall=False):
+    stats = RequestStats()
+    stats.request_start_time = start
+    stats.response_status_code = status_code
+    stats.calls = 1
+    stats.workload_class = workload_class
+    stats.response_time = start + 0.1
+    if status_code == 200:
+        stats.first_token_time = start + 0.2
+        stats.response_end_time = start + latency
+        stats.context_tokens = 100
+        stats.generated_tokens = 10
+        # 10 tokens every 50ms, the last one after a stall if requested
+        for i in range(10):
+            stats.token_times.append(start + 0.2 + 0.05 * i)
+        if stall:
+            stats.token_times[-1] = start + latency
+    return stats
+
+class TestAnalyze(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        writer = RawLogWriter(self.directory)
+        # one request per second for 120 seconds, every 10th is throttled,
+        # appended in completion order as the aggregator does
+        for i in range(120):
+            if i % 10 == 9:
+                writer.append(_request_stats(1000.0 + i, status_code=429, workload_class="rag"))
+            elif i % 2 == 0:
+                writer.append(_request_stats(1000.0 + i, latency=1.0, workload_class="chat"))
+            else:
+                writer.append(_request_stats(1000.0 + i, latency=3.0, workload_class="rag", stall=True))
+        writer.stop()
+
+    def _analyze(self, **kwargs):
+        args = argparse.Namespace(raw_log=self.directory, aggregation_window=60, step=60, start=None, end=None, stall_threshold=1.0, output_format="jsonl")
+        for name, value in kwargs.items():
+            setattr(args, name, value)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            analyze(args)
+        return [json.loads(line) for line in output.getvalue().splitlines()]
+
+    def test_windows(self):
+        snapshots = self._analyze()
+        self.assertEqual([s["run_seconds"] for s in snapshots], [60, 120])
+        second = snapshots[1]
+        # 53 successes started in (60, 120]
+        self.assertEqual(second["rpm"], 53.0)
+        self.assertEqual(second["tpm"]["context"], 5300)
+        self.assertEqual(second["throttled"], 12)
+        self.assertEqual(second["completed"], 120)
+        self.assertEqual(second["processing"], 0)
+        self.assertAlmostEqual(second["ttft"]["avg"], 0.2, delta=0.01)
+        self.assertEqual(second["classes"]["chat"]["rpm"], 29.0)
+        self.assertEqual(snapshots[0]["processing"], 1)
+        self.assertAlmostEqual(second["classes"]["rag"]["e2e"]["avg"], 3.0, delta=0.03)
+        self.assertEqual(second["classes"]["rag"]["throttled"], 12)
+        # one stall per successful rag request
+        self.assertEqual(second["stalls"], 24)
+        self.assertEqual(second["classes"]["chat"]["stalls"], 0)
+        self.assertAlmostEqual(second["classes"]["chat"]["tbt"]["avg"], 0.05, delta=0.001)
+
+    def test_range(self):
+        snapshots = self._analyze(aggregation_window=10, step=10, start=30, end=50)
+        self.assertEqual([s["run_seconds"] for s in snapshots], [40, 50])
+        # 9 successes started in (30, 40], but the one started at 40 completes
+        # after the window ends, so the live aggregator had not seen it yet
+        self.assertEqual(snapshots[0]["rpm"], 48.0)
+
+    def test_start_reads_range(self):
+        # requests completed before the first window are only counted, the
+        # rag request started at 57 is still running, and the log is read in
+        # several chunks
+        with mock.patch("benchmark.analyzecmd.SCAN_CHUNK_ROWS", 7):
+            requests = _Requests.from_log(read_raw_log(self.directory), since=1059.5)
+            self.assertEqual(len(requests.start), 61)
+            self.assertEqual(requests.base["requests"], 59)
+            self.assertEqual(requests.base["throttled"], 6)
+            snapshots = self._analyze(aggregation_window=10, step=10, start=60)
+        expected = self._analyze(aggregation_window=10, step=10)
+        self.assertEqual(snapshots, expected[-len(snapshots):])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,44 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+import asyncio
+import threading
 import unittest
 import time
-from benchmark.asynchttpexecuter import AsyncHTTPExecuter
-from benchmark.ratelimiting import RateLimiter
+from benchmark.asynchttpexecuter import AsyncHTTPExecuter, intended_start_time
+from benchmark.concurrency import AdaptiveConcurrency
+from benchmark.ratelimiting import ArrivalScheduler, RateLimiter, TokenRateLimiter
+
+def _stopped_run(engine: str, stop_after: int) -> (int, int):
+    """
+    Runs up to 1000 calls, setting the stop event of the executer once
+    stop_after calls started. Returns the number of started and completed calls.
+    """
+    stop = threading.Event()
+    if stop_after == 0:
+        stop.set()
+    started = 0
+    completed = 0
+    async def work_fn(*_):
+        nonlocal started, completed
+        started += 1
+        if started == stop_after:
+            stop.set()
+        await asyncio.sleep(0.01)
+        completed += 1
+
+    AsyncHTTPExecuter(work_fn, max_concurrency=4, engine=engine, stop=stop).run(1000)
+    return started, completed
 
 class TestExecuter(unittest.TestCase):
 
+    def test_stop(self):
+        self.assertEqual(_stopped_run("tasks", 0), (0, 0))
+        started, completed = _stopped_run("tasks", 10)
+        # requests running when stop is set drain
+        self.assertLess(started, 20)
+        self.assertEqual(completed, started)
+
     def test_norate(self):
         call_count = 0
         async def work_fn(*_):
@@ -60,5 +91,190 @@ class TestExecuter(unittest.TestCase):
         self.assertEqual(call_count, 5)
         self.assertAlmostEqual(duration, 5.0, delta=0.1)
 
+    def test_arrivals_constant(self):
+        intended_times = []
+        async def work_fn(*_):
+            intended_times.append(intended_start_time.get())
+
+        exec = AsyncHTTPExecuter(work_fn, max_concurrency=10, rate_limiter=ArrivalScheduler(100, 1.0))
+        start_time = time.time()
+        exec.run(50)
+        duration = time.time() - start_time
+        self.assertEqual(len(intended_times), 50)
+        self.assertAlmostEqual(duration, 0.49, delta=0.05)
+        for i in range(1, 50):
+            self.assertAlmostEqual(intended_times[i] - intended_times[i-1], 0.01, delta=1e-6)
+
+    def test_arrivals_poisson(self):
+        call_count = 0
+        async def work_fn(*_):
+            nonlocal call_count
+            call_count += 1
+
+        exec = AsyncHTTPExecuter(work_fn, max_concurrency=10, rate_limiter=ArrivalScheduler(1000, 1.0, arrivals="poisson", seed=1))
+        start_time = time.time()
+        exec.run(1000)
+        duration = time.time() - start_time
+        self.assertEqual(call_count, 1000)
+        self.assertAlmostEqual(duration, 1.0, delta=0.1)
+
+    def test_arrivals_concurrency_lag(self):
+        # intended times stay on schedule while calls are held back by concurrency
+        delays = []
+        async def work_fn(*_):
+            delays.append(time.time() - intended_start_time.get())
+            time.sleep(0.1)
+
+        exec = AsyncHTTPExecuter(work_fn, max_concurrency=1, rate_limiter=ArrivalScheduler(100, 1.0))
+        exec.run(10)
+        self.assertEqual(len(delays), 10)
+        self.assertGreater(delays[-1], 0.5)
+
+    def test_token_rate(self):
+        call_count = 0
+        async def work_fn(*_):
+            nonlocal call_count
+            call_count += 1
+
+        # 100 tokens per call at 2000 tokens per second
+        exec = AsyncHTTPExecuter(work_fn, max_concurrency=10, rate_limiter=TokenRateLimiter(2000, 1.0, 100))
+        start_time = time.time()
+        exec.run(21)
+        duration = time.time() - start_time
+        self.assertEqual(call_count, 21)
+        self.assertAlmostEqual(duration, 1.0, delta=0.05)
+
+    def test_token_rate_correction(self):
+        rate_limiter = TokenRateLimiter(2000, 1.0, 100)
+        async def work_fn(*_):
+            # calls use half of the expected tokens
+            rate_limiter.record_usage(50)
+
+        exec = AsyncHTTPExecuter(work_fn, max_concurrency=10, rate_limiter=rate_limiter)
+        start_time = time.time()
+        exec.run(41)
+        duration = time.time() - start_time
+        self.assertAlmostEqual(duration, 1.0, delta=0.1)
+        self.assertLess(rate_limiter.expected_tokens, 60)
+
+class TestWorkersEngine(unittest.TestCase):
+
+    def test_call_count(self):
+        running = 0
+        max_running = 0
+        call_count = 0
+        async def work_fn(*_):
+            nonlocal running, max_running, call_count
+            call_count += 1
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        exec = AsyncHTTPExecuter(work_fn, max_concurrency=5, engine="workers")
+        exec.run(103)
+        self.assertEqual(call_count, 103)
+        # unlike the tasks engine, exactly max_concurrency requests run at once
+        self.assertEqual(max_running, 5)
+
+    def test_rate(self):
+        call_count = 0
+        async def work_fn(*_):
+            nonlocal call_count
+            call_count += 1
+
+        exec = AsyncHTTPExecuter(work_fn, max_concurrency=10, rate_limiter=RateLimiter(2, 1.0), engine="workers")
+        start_time = time.time()
+        exec.run(10)
+        duration = time.time() - start_time
+        self.assertEqual(call_count, 10)
+        # use 4.0 seconds since first 1 second has no rate limit
+        self.assertAlmostEqual(duration, 4.0, delta=0.05)
+
+    def test_duration(self):
+        async def work_fn(*_):
+            await asyncio.sleep(0.01)
+
+        exec = AsyncHTTPExecuter(work_fn, max_concurrency=10, engine="workers")
+        start_time = time.time()
+        exec.run(duration=0.5)
+        self.assertAlmostEqual(time.time() - start_time, 0.5, delta=0.05)
+
+    def test_arrivals(self):
+        intended_times = []
+        async def work_fn(*_):
+            intended_times.append(intended_start_time.get())
+            await asyncio.sleep(0.05)
+
+        exec = AsyncHTTPExecuter(work_fn, max_concurrency=10, rate_limiter=ArrivalScheduler(100, 1.0), engine="workers")
+        exec.run(50)
+        self.assertEqual(len(intended_times), 50)
+        for i in range(1, 50):
+            self.assertAlmostEqual(intended_times[i] - intended_times[i-1], 0.01, delta=1e-6)
+
+    def test_drain(self):
+        completed = 0
+        async def work_fn(*_):
+            nonlocal completed
+            await asyncio.sleep(0.2)
+            completed += 1
+
+        class _Limited:
+            # releases three calls, then ends the run while they are still running
+            permits = 3
+            async def __aenter__(self):
+                if self.permits == 0:
+                    raise StopAsyncIteration
+                self.permits -= 1
+            async def __aexit__(self, *_):
+                pass
+
+        exec = AsyncHTTPExecuter(work_fn, max_concurrency=10, rate_limiter=_Limited(), engine="workers")
+        exec.run()
+        self.assertEqual(completed, 3)
+
+    def test_failure(self):
+        call_count = 0
+        async def work_fn(*_):
+            nonlocal call_count
+            call_count += 1
+            raise RuntimeError("failed")
+
+        exec = AsyncHTTPExecuter(work_fn, max_concurrency=2, engine="workers")
+        exec.run(10)
+        self.assertEqual(call_count, 10)
+
+    def test_adaptive_limit(self):
+        controller = AdaptiveConcurrency(8)
+        controller.limit = 2
+        running = 0
+        max_running = []
+        async def work_fn(*_):
+            nonlocal running
+            running += 1
+            max_running.append(running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            if len(max_running) == 20:
+                controller.limit = 6
+
+        exec = AsyncHTTPExecuter(work_fn, concurrency_controller=controller, engine="workers")
+        exec.run(100)
+        self.assertEqual(len(max_running), 100)
+        self.assertEqual(max(max_running[:20]), 2)
+        # parked workers join once the limit grows
+        self.assertEqual(max(max_running[20:]), 6)
+        self.assertTrue(controller.saturated)
+
+    def test_stop(self):
+        self.assertEqual(_stopped_run("workers", 0), (0, 0))
+        started, completed = _stopped_run("workers", 10)
+        self.assertLess(started, 20)
+        self.assertEqual(completed, started)
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            AsyncHTTPExecuter(None, engine="threads")
+
 if __name__ == '__main__':
     unittest.main()
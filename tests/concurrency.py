@@ -0,0 +1,93 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import asyncio
+import time
+import unittest
+from benchmark.asynchttpexecuter import AsyncHTTPExecuter
+from benchmark.concurrency import AdaptiveConcurrency
+from benchmark.oairequester import RequestStats
+
+def _request_stats(status_code=200, utilization=None, ttft=0.1):
+    stats = RequestStats()
+    stats.request_start_time = time.time()
+    stats.response_status_code = status_code
+    stats.deployment_utilization = utilization
+    if status_code == 200:
+        stats.first_token_time = stats.request_start_time + ttft
+    return stats
+
+class TestAdaptiveConcurrency(unittest.TestCase):
+
+    def _interval(self, controller, saturated=True, **kwargs):
+        """
+        Records one request completing at the end of a control interval.
+        """
+        if saturated:
+            controller.record_saturation()
+        stats = _request_stats(**kwargs)
+        controller.interval_start -= controller.interval
+        controller.record(stats)
+
+    def test_slow_start(self):
+        controller = AdaptiveConcurrency(100)
+        for _ in range(4):
+            self._interval(controller, utilization=50.0)
+        self.assertEqual(controller.limit, 16)
+        # limited by the rate rather than concurrency
+        self._interval(controller, saturated=False, utilization=50.0)
+        self.assertEqual(controller.limit, 16)
+        for _ in range(4):
+            self._interval(controller, utilization=50.0)
+        self.assertEqual(controller.limit, 100)
+
+    def test_decrease(self):
+        controller = AdaptiveConcurrency(100)
+        controller.limit = 40
+        self._interval(controller, status_code=429)
+        self.assertEqual(controller.limit, 30)
+        self.assertFalse(controller.slow_start)
+        self._interval(controller, utilization=97.0)
+        self.assertEqual(controller.limit, 22)
+        # additive increase scaled by the headroom left
+        self._interval(controller, utilization=85.0)
+        self.assertEqual(controller.limit, 23)
+        self._interval(controller, utilization=None)
+        self.assertEqual(controller.limit, 25)
+        self.assertEqual([limit for _, limit in controller.trajectory], [1, 30, 22, 23, 25])
+
+    def test_ttft(self):
+        controller = AdaptiveConcurrency(100, max_ttft=1.0)
+        controller.limit = 8
+        self._interval(controller, ttft=2.0)
+        self.assertEqual(controller.limit, 6)
+
+    def test_ignores_previous_limit(self):
+        controller = AdaptiveConcurrency(100)
+        controller.limit = 8
+        stale = _request_stats(status_code=429)
+        self._interval(controller, status_code=429)
+        self.assertEqual(controller.limit, 6)
+        # started before the change, so not counted
+        controller.interval_start -= controller.interval
+        controller.record(stale)
+        self.assertEqual(controller.limit, 6)
+
+    def test_executer_limit(self):
+        controller = AdaptiveConcurrency(100)
+        controller.limit = 3
+        running = 0
+        max_running = 0
+        async def work_fn(*_):
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+        AsyncHTTPExecuter(work_fn, concurrency_controller=controller).run(call_count=50)
+        # same bound as max_concurrency, which lets one more request start
+        self.assertEqual(max_running, 4)
+        self.assertTrue(controller.saturated)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import unittest
+from benchmark.asynchttpexecuter import AsyncHTTPExecuter
+from benchmark.connectiontrace import connection_trace_config
+from benchmark.mockserver import MockServer
+from benchmark.oairequester import OAIRequester
+from benchmark.statsaggregator import _StatsAggregator
+
+BODY = {"messages": [{"role": "user", "content": "hello"}], "max_tokens": 5}
+
+class TestConnectionTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MockServer(ttft=0.05)
+        # resolved through DNS rather than a literal address
+        self.url = self.server.start_in_thread().replace("127.0.0.1", "localhost") + "/openai/deployments/depl/chat/completions?api-version=2023-05-15"
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _run(self, count, sequential, **kwargs):
+        """
+        Runs count requests, each running sequential requests one after the other.
+        """
+        requester = OAIRequester("", self.url)
+        stats = []
+        async def request_func(session):
+            for _ in range(sequential):
+                stats.append(await requester.call(session, dict(BODY)))
+        # the executer runs up to max_concurrency + 1 requests at once
+        AsyncHTTPExecuter(request_func, max_concurrency=count - 1, trace_configs=[connection_trace_config()], prewarm_urls=[self.url], **kwargs).run(call_count=count)
+        return stats
+
+    def test_timings(self):
+        stats = self._run(1, 4)
+        self.assertEqual([s.new_connection for s in stats], [True, False, False, False])
+        self.assertIsNotNone(stats[0].dns_time)
+        self.assertIsNotNone(stats[0].connect_time)
+        self.assertIsNone(stats[1].connect_time)
+        for s in stats:
+            self.assertAlmostEqual(s.headers_time, 0.05, delta=0.03)
+
+    def test_prewarm(self):
+        stats = self._run(4, 2, prewarm_connections=4)
+        self.assertEqual([s.new_connection for s in stats], [False] * 8)
+
+    def test_aggregator(self):
+        aggregator = _StatsAggregator(clients=1, dump_duration=1, print_stats=False)
+        for s in self._run(1, 3):
+            aggregator._aggregate(s)
+        snapshot = aggregator._snapshot()
+        self.assertEqual(snapshot["connections"], {"new": 1, "reused": 2})
+        self.assertNotEqual(snapshot["headers"]["avg"], "n/a")
+
+if __name__ == '__main__':
+    unittest.main()
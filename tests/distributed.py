@@ -0,0 +1,236 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from array import array
+from benchmark.distributed import AGENT_PORT, _AgentRun, _clock_offset, _parse_agents
+from benchmark.loadworkers import _worker_args
+from benchmark.mockserver import MockServer
+from benchmark.oairequester import RequestStats
+from benchmark.rawlog import read_raw_log
+from benchmark.statsaggregator import _StatsAggregator, _encode_interval
+
+KEY_ENV = "AOAI_BENCHMARK_AGENT_KEY"
+TOKEN_ENV = "AOAI_BENCHMARK_AGENT_TOKEN"
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _connect(port:int) -> socket.socket:
+    # agents may still be starting
+    deadline = time.time() + 30
+    while True:
+        try:
+            return socket.create_connection(("127.0.0.1", port))
+        except ConnectionRefusedError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+class TestProtocol(unittest.TestCase):
+
+    def _stats(self, start:float, status:int, workload_class:str, endpoint:str) -> RequestStats:
+        stats = RequestStats()
+        stats.request_start_time = start
+        stats.first_attempt_time = start - 1.0
+        stats.response_time = start + 0.1
+        stats.first_token_time = start + 0.2
+        stats.response_end_time = start + 0.5
+        stats.response_status_code = status
+        stats.workload_class = workload_class
+        stats.endpoint = endpoint
+        stats.context_tokens = 100
+        stats.generated_tokens = 2
+        stats.calls = 2
+        stats.new_connection = status == 200
+        stats.deployment_utilization = 50.0
+        stats.token_times = array('d', [start + 0.2, start + 0.5])
+        stats.token_choices = array('H', [0, 0])
+        return stats
+
+    def test_interval_round_trip(self):
+        # requests aggregated by the controller, and by an agent whose clock is 2 seconds ahead
+        now = time.time()
+        local = _StatsAggregator(clients=4, dump_duration=1, print_stats=False)
+        remote = _StatsAggregator(clients=4, dump_duration=1, print_stats=False)
+        batch = []
+        for i, (status, workload_class) in enumerate([(200, "chat"), (200, "summary"), (429, "chat"), (200, "chat")]):
+            local.record_new_request()
+            local.aggregate_request(self._stats(now - 3 * i, status, workload_class, "east"))
+            batch.append(self._stats(now - 3 * i + 2.0, status, workload_class, "east"))
+        interval = json.loads(json.dumps(_encode_interval(4, batch, [(now + 2.0, 0.01)], slot_duration=1)))
+        local.record_loop_lag(now, 0.01)
+        remote.aggregate_interval(interval, offset=2.0)
+        local._drain()
+        remote._drain()
+        local.start_time = remote.start_time = now
+        expected = local._snapshot()
+        snapshot = remote._snapshot()
+        self.assertEqual(snapshot["completed"], 4)
+        self.assertEqual(snapshot["throttled"], 1)
+        for name in ["timestamp", "run_seconds"]:
+            del expected[name]
+            del snapshot[name]
+        self.assertEqual(snapshot, expected)
+        # counters and cumulative histograms exported to prometheus
+        self.assertEqual(remote.totals.total_context_tokens, local.totals.total_context_tokens)
+        for name, histogram in local.totals.cumulative.items():
+            self.assertEqual(remote.totals.cumulative[name].counts.tolist(), histogram.counts.tolist())
+
+    def test_clock_offset(self):
+        # agent clock 5 seconds ahead, 10ms each way, except a slow exchange
+        exchanges = [
+            (0.0, 5.010, 5.011, 0.021),
+            (1.0, 6.100, 6.101, 1.111),
+        ]
+        offset, round_trip = _clock_offset(exchanges)
+        self.assertAlmostEqual(offset, 5.0)
+        self.assertAlmostEqual(round_trip, 0.02)
+
+    def test_parse_agents(self):
+        self.assertEqual(_parse_agents("10.0.0.1:9000,host"), [("10.0.0.1", 9000), ("host", AGENT_PORT)])
+        with self.assertRaises(ValueError):
+            _parse_agents("host:port")
+
+    def test_replay_shards(self):
+        # worker shares of agent shares cover every record exactly once
+        args = argparse.Namespace(clients=12, requests=None, rate=None, tpm=None)
+        shards = []
+        for agent in range(3):
+            agent_args = _worker_args(args, agent, 3)
+            for worker in range(2):
+                shards.append(tuple(_worker_args(agent_args, worker, 2).replay_shard))
+        self.assertEqual(sorted(shards), [(i, 6) for i in range(6)])
+
+    def test_agent_files(self):
+        options = argparse.Namespace(workers=1, api_key_env=KEY_ENV, allow_endpoint=None, data_dir="/data")
+        run = _AgentRun(None, options)
+        args = dict(clients=0, api_key_env="PATH", api_base_endpoint=None, targets=None, replay=None, workload=None)
+        # agents keep their own api key env and resolve files in their data dir
+        agent_args = run._args(dict(args, targets="targets.json", workload="chat:1"))
+        self.assertEqual(agent_args.api_key_env, KEY_ENV)
+        self.assertEqual(agent_args.targets, os.path.join("/data", "targets.json"))
+        self.assertEqual(agent_args.workload, "chat:1")
+        for values in [dict(targets="../targets.json"), dict(replay="/etc/passwd"), dict(workload="/etc/passwd"),
+                       dict(api_base_endpoint="https://attacker.example.com")]:
+            with self.assertRaises(ValueError):
+                run._args(dict(args, **values))
+        run.options.data_dir = None
+        with self.assertRaises(ValueError):
+            run._args(dict(args, replay="trace.jsonl"))
+
+class TestAgents(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MockServer()
+        self.endpoint = self.server.start_in_thread()
+        self.ports = [_free_port(), _free_port()]
+        self.raw_logs = [tempfile.mkdtemp() for _ in self.ports]
+        env = dict(os.environ, **{KEY_ENV: "key", TOKEN_ENV: "secret"})
+        self.agents = [
+            subprocess.Popen([sys.executable, "-m", "benchmark.bench", "agent", "--listen", f"127.0.0.1:{port}",
+                              "-k", KEY_ENV, "--allow-endpoint", self.endpoint, "--raw-log", raw_log],
+                             env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            for port, raw_log in zip(self.ports, self.raw_logs)]
+
+    def tearDown(self):
+        for agent in self.agents:
+            agent.kill()
+            agent.wait()
+        self.server.stop()
+        for raw_log in self.raw_logs:
+            shutil.rmtree(raw_log)
+
+    def _controller(self, *args, endpoint=None, token="secret") -> subprocess.Popen:
+        agents = ",".join(f"127.0.0.1:{port}" for port in self.ports)
+        # the controller has no api key, agents use their own
+        env = dict(os.environ, **{TOKEN_ENV: token})
+        env.pop(KEY_ENV, None)
+        return subprocess.Popen(
+            [sys.executable, "-m", "benchmark.bench", "load", "--controller", "--agents", agents,
+             "-s", "custom", "-p", "100", "-m", "10", "-f", "jsonl", "-k", "AOAI_BENCHMARK_CONTROLLER_KEY", "-e", "agents",
+             *args, endpoint or self.endpoint],
+            env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+    def _run(self, *args, **kwargs) -> subprocess.CompletedProcess:
+        controller = self._controller(*args, **kwargs)
+        stdout, stderr = controller.communicate(timeout=120)
+        return subprocess.CompletedProcess(controller.args, controller.returncode, stdout, stderr)
+
+    def _load(self, *args):
+        result = self._run(*args)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return json.loads(result.stdout.strip().splitlines()[-1])
+
+    def test_load(self):
+        snapshot = self._load("-n", "21", "-c", "4")
+        self.assertEqual(snapshot["completed"], 21)
+        self.assertEqual(snapshot["failures"], 0)
+        self.assertNotEqual(snapshot["e2e"]["avg"], "n/a")
+        # each agent records its own requests
+        rows = 0
+        for raw_log in self.raw_logs:
+            runs = os.listdir(raw_log)
+            self.assertEqual(len(runs), 1)
+            rows += len(read_raw_log(os.path.join(raw_log, runs[0]))["request_start_time"])
+        self.assertEqual(rows, 21)
+        # agents serve the next run once one completes
+        snapshot = self._load("-n", "5", "-c", "2")
+        self.assertEqual(snapshot["completed"], 5)
+
+    def test_stop(self):
+        # runs without a request count, drained by the controller while agents
+        # build large prompts for --tpm, then while they send requests
+        for delay, args in [(2.5, ["-p", "60000", "--tpm", "6000000"]), (4, [])]:
+            controller = self._controller("-c", "2", *args)
+            time.sleep(delay)
+            controller.send_signal(signal.SIGTERM)
+            _, stderr = controller.communicate(timeout=60)
+            self.assertEqual(controller.returncode, 0, stderr)
+            for agent in self.agents:
+                self.assertIsNone(agent.poll())
+        snapshot = self._load("-n", "5", "-c", "2")
+        self.assertEqual(snapshot["completed"], 5)
+
+    def test_invalid_messages(self):
+        for port in self.ports:
+            for data in [b"GET / HTTP/1.1\r\n\r\n", b"[]\n", b"{}\n", b"\xff\n"]:
+                with _connect(port) as sock:
+                    sock.sendall(data)
+                    sock.settimeout(5)
+                    # agents refuse the connection, or close it
+                    try:
+                        while sock.recv(1024):
+                            pass
+                    except ConnectionResetError:
+                        pass
+        # agents still serve controllers
+        snapshot = self._load("-n", "5", "-c", "2")
+        self.assertEqual(snapshot["completed"], 5)
+        for agent in self.agents:
+            self.assertIsNone(agent.poll())
+
+    def test_invalid_token(self):
+        result = self._run("-n", "5", "-c", "2", token="guess")
+        self.assertEqual(result.returncode, 1)
+        self.assertIn("invalid token", result.stdout)
+
+    def test_endpoint_not_allowed(self):
+        result = self._run("-n", "5", "-c", "2", endpoint="http://127.0.0.1:1")
+        self.assertIn("not allowed", result.stderr)
+        self.assertNotIn('"completed": 5', result.stdout)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import json
+import unittest
+from benchmark.harnesscmd import STARTUP_COMMANDS, _run_level, _startup_times
+from benchmark.mockserver import MockServer
+
+class TestHarness(unittest.TestCase):
+
+    def test_level(self):
+        server = MockServer()
+        url = server.start_in_thread() + "/openai/deployments/harness/chat/completions?api-version=2023-05-15"
+        body = json.dumps({"messages": [{"role": "user", "content": "harness"}], "max_tokens": 10, "stream": True}).encode()
+        try:
+            level = _run_level(url, body, concurrency=4, duration=1)
+        finally:
+            server.stop()
+        self.assertEqual(level["concurrency"], 4)
+        self.assertEqual(level["failures"], 0)
+        self.assertGreater(level["requests"], 0)
+        self.assertGreater(level["rps"], 0)
+        self.assertNotEqual(level["header_send_gap"]["avg"], "n/a")
+        self.assertGreater(level["cpu_seconds_per_request"], 0)
+
+    def test_startup(self):
+        server = MockServer()
+        endpoint = server.start_in_thread()
+        try:
+            times = _startup_times(endpoint, runs=1)
+        finally:
+            server.stop()
+        self.assertEqual(list(times), list(STARTUP_COMMANDS))
+        for name, samples in times.items():
+            self.assertGreater(samples["min"], 0)
+            self.assertEqual(samples["min"], samples["max"])
+
+if __name__ == '__main__':
+    unittest.main()
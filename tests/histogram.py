@@ -0,0 +1,53 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import unittest
+import numpy as np
+from benchmark.histogram import HISTOGRAM_RELATIVE_ACCURACY, HistogramLayout, LogHistogram
+
+class TestLogHistogram(unittest.TestCase):
+
+    def test_percentiles(self):
+        values = np.random.default_rng(1).lognormal(0, 1, 100000)
+        histogram = LogHistogram()
+        for v in values:
+            histogram.record(v)
+        for q in (50, 90, 95, 99, 99.9):
+            self.assertAlmostEqual(histogram.percentile(q), np.percentile(values, q), delta=np.percentile(values, q) * 2 * HISTOGRAM_RELATIVE_ACCURACY)
+        self.assertAlmostEqual(histogram.mean(), np.average(values))
+        self.assertEqual(histogram.max, np.max(values))
+
+    def test_record_many(self):
+        values = np.random.default_rng(2).uniform(0, 100, 1000)
+        one = LogHistogram()
+        for v in values:
+            one.record(v)
+        many = LogHistogram()
+        many.record_many(values)
+        self.assertTrue(np.array_equal(one.counts, many.counts))
+        self.assertEqual(one.count, many.count)
+
+    def test_merge(self):
+        values = np.random.default_rng(3).exponential(1, 2000)
+        merged = LogHistogram()
+        for chunk in np.split(values, 4):
+            part = LogHistogram()
+            part.record_many(chunk)
+            merged.merge(part)
+        full = LogHistogram()
+        full.record_many(values)
+        self.assertTrue(np.array_equal(merged.counts, full.counts))
+        self.assertEqual(merged.percentile(99), full.percentile(99))
+
+    def test_merge_layout_mismatch(self):
+        with self.assertRaises(ValueError):
+            LogHistogram().merge(LogHistogram(HistogramLayout(relative_accuracy=0.05)))
+
+    def test_zero(self):
+        histogram = LogHistogram()
+        histogram.record(0.0)
+        histogram.record(0.0)
+        self.assertEqual(histogram.percentile(50), 0.0)
+
+if __name__ == '__main__':
+    unittest.main()
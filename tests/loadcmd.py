@@ -0,0 +1,91 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import unittest
+from benchmark.loadcmd import _RequestBuilder
+from benchmark.loadworkers import _worker_args
+from benchmark.mockserver import MockServer
+from benchmark.oaitokenizer import num_tokens_from_messages
+
+class TestRequestBuilder(unittest.TestCase):
+
+    def test_pool(self):
+        builder = _RequestBuilder("gpt-4-0613", 500, max_tokens=100, completions=1,
+            frequency_penalty=None, presence_penalty=None, temperature=0.5, top_p=None,
+            pool_size=4)
+        prompts = set()
+        for _ in range(8):
+            body, messages_tokens = next(builder)
+            request = json.loads(body)
+            self.assertTrue(request["stream"])
+            self.assertEqual(request["max_tokens"], 100)
+            self.assertEqual(request["temperature"], 0.5)
+            self.assertNotIn("@@prefix@@", body.decode())
+            self.assertEqual(num_tokens_from_messages(request["messages"], "gpt-4-0613"), messages_tokens)
+            self.assertGreaterEqual(messages_tokens, 500)
+            # prompts differ by pool entry, prefixes differ by request
+            prompts.add(request["messages"][0]["content"].split(" ", 1)[1])
+        self.assertEqual(len(prompts), 4)
+
+    def test_pool_error(self):
+        class FailingBuilder(_RequestBuilder):
+            def _build_body(self, text, offset):
+                raise ValueError("no prompt")
+        builder = FailingBuilder("gpt-4-0613", 100, max_tokens=None, completions=None,
+            frequency_penalty=None, presence_penalty=None, temperature=None, top_p=None,
+            pool_size=2)
+        # raised from the background thread on first use
+        with self.assertRaises(ValueError):
+            next(builder)
+
+class TestLoadCommand(unittest.TestCase):
+
+    def test_workers(self):
+        # parsed arguments, subcommand function included, are pickled into workers
+        server = MockServer()
+        endpoint = server.start_in_thread()
+        try:
+            result = subprocess.run(
+                [sys.executable, "-m", "benchmark.bench", "load", "--workers", "2", "-n", "6", "-c", "2",
+                 "-s", "custom", "-p", "100", "-m", "10", "-f", "jsonl", "-k", "AOAI_BENCHMARK_TEST_KEY", "-e", "workers", endpoint],
+                env=dict(os.environ, AOAI_BENCHMARK_TEST_KEY="key"), capture_output=True, text=True, timeout=120)
+        finally:
+            server.stop()
+        self.assertEqual(result.returncode, 0, result.stderr)
+        snapshot = json.loads(result.stdout.strip().splitlines()[-1])
+        self.assertEqual(snapshot["completed"], 6)
+        self.assertEqual(snapshot["failures"], 0)
+
+    def test_worker_args(self):
+        args = argparse.Namespace(workers=2, clients=3, requests=5, rate=10.0, tpm=None)
+        shares = [_worker_args(args, i, 2) for i in range(2)]
+        self.assertEqual([a.clients for a in shares], [2, 1])
+        self.assertEqual([a.requests for a in shares], [3, 2])
+        self.assertEqual([a.rate for a in shares], [5.0, 5.0])
+        self.assertEqual([a.replay_shard for a in shares], [(0, 2), (1, 2)])
+        self.assertTrue(all(a.workers == 1 and a.tpm is None for a in shares))
+        self.assertEqual(args.workers, 2)
+
+    def test_workers_failures(self):
+        # requests failing in every worker are merged into the parent stats
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        result = subprocess.run(
+            [sys.executable, "-m", "benchmark.bench", "load", "--workers", "2", "-n", "5", "-c", "3",
+             "-s", "custom", "-p", "100", "-m", "10", "-f", "jsonl", "-k", "AOAI_BENCHMARK_TEST_KEY", "-e", "workers", f"http://127.0.0.1:{port}"],
+            env=dict(os.environ, AOAI_BENCHMARK_TEST_KEY="key"), capture_output=True, text=True, timeout=120)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        snapshot = json.loads(result.stdout.strip().splitlines()[-1])
+        self.assertEqual(snapshot["completed"], 5)
+        self.assertEqual(snapshot["failures"], 5)
+        self.assertNotIn("unable to aggregate", result.stderr)
+
+if __name__ == '__main__':
+    unittest.main()
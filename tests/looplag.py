@@ -0,0 +1,27 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import asyncio
+import time
+import unittest
+from benchmark.looplag import LoopLagProbe
+
+class TestLoopLagProbe(unittest.TestCase):
+
+    def test_lag(self):
+        lags = []
+        async def run():
+            probe = LoopLagProbe(lambda _, lag: lags.append(lag), interval=0.01)
+            probe.start(asyncio.get_running_loop())
+            await asyncio.sleep(0.1)
+            # block the loop, the next probe must see the delay
+            time.sleep(0.2)
+            await asyncio.sleep(0.05)
+            probe.stop()
+        asyncio.run(run())
+        self.assertGreater(len(lags), 5)
+        self.assertAlmostEqual(max(lags), 0.2, delta=0.02)
+        self.assertLess(min(lags), 0.01)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import asyncio
+import json
+import time
+import unittest
+import aiohttp
+from benchmark.asynchttpexecuter import AsyncHTTPExecuter
+from benchmark.mockserver import CapacityModel, MockServer
+from benchmark.oairequester import OAIRequester, RETRY_AFTER_MS_HEADER, UTILIZATION_HEADER
+from benchmark.statsaggregator import _StatsAggregator
+
+BODY = {"messages": [{"role": "user", "content": "hello " * 100}], "max_tokens": 10}
+
+class TestCapacityModel(unittest.TestCase):
+
+    def test_admit(self):
+        model = CapacityModel(60000)
+        self.assertEqual(model.admit(60500), (True, 0.0))
+        self.assertAlmostEqual(model.utilization(), 100.8, delta=0.1)
+        admitted, retry_after = model.admit(1)
+        self.assertFalse(admitted)
+        self.assertAlmostEqual(retry_after, 0.5, delta=0.01)
+        time.sleep(0.6)
+        self.assertTrue(model.admit(1)[0])
+
+class TestMockServer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MockServer(ttft=0.05, token_delay=0.01, capacity_tpm=100)
+        self.url = self.server.start_in_thread() + "/openai/deployments/depl/chat/completions?api-version=2023-05-15"
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_stream(self):
+        async def call():
+            async with aiohttp.ClientSession() as session:
+                return await OAIRequester("", self.url).call(session, dict(BODY))
+        stats = asyncio.run(call())
+        self.assertIsNone(stats.last_exception)
+        self.assertEqual(stats.response_status_code, 200)
+        self.assertIsNotNone(stats.deployment_utilization)
+        # role and finish chunks are not counted as tokens
+        self.assertEqual(stats.generated_tokens, 10)
+        self.assertEqual(len(stats.token_gaps()), 9)
+        self.assertAlmostEqual(stats.first_token_time - stats.request_start_time, 0.05, delta=0.03)
+        self.assertAlmostEqual(stats.response_end_time - stats.first_token_time, 0.09, delta=0.03)
+
+    def test_throttle(self):
+        async def post():
+            async with aiohttp.ClientSession() as session:
+                statuses = []
+                for _ in range(2):
+                    async with session.post(self.url, data=json.dumps(BODY)) as response:
+                        await response.read()
+                        statuses.append((response.status, dict(response.headers)))
+                return statuses
+        (first, _), (second, headers) = asyncio.run(post())
+        self.assertEqual(first, 200)
+        self.assertEqual(second, 429)
+        self.assertIn(RETRY_AFTER_MS_HEADER, headers)
+        self.assertIn(UTILIZATION_HEADER, headers)
+
+class TestEndToEnd(unittest.TestCase):
+
+    def test_load(self):
+        server = MockServer(ttft=0.01, token_delay=0.001)
+        url = server.start_in_thread() + "/openai/deployments/depl/chat/completions?api-version=2023-05-15"
+        aggregator = _StatsAggregator(clients=10, dump_duration=1, window_duration=60, json_output=True)
+        requester = OAIRequester("", url)
+        async def request_func(session):
+            aggregator.record_new_request()
+            aggregator.aggregate_request(await requester.call(session, dict(BODY)))
+        aggregator.start()
+        AsyncHTTPExecuter(request_func, max_concurrency=10).run(call_count=100)
+        aggregator.stop()
+        server.stop()
+        self.assertEqual(aggregator.total_requests_count, 100)
+        self.assertEqual(aggregator.total_failed_count, 0)
+        self.assertEqual(aggregator.totals.first_token_latencies._len(), 100)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,7 +4,8 @@
 import unittest
 import time
 import httpretty
-from benchmark.oairequester import OAIRequester, UTILIZATION_HEADER, RETRY_AFTER_MS_HEADER
+import numpy as np
+from benchmark.oairequester import OAIRequester, RequestStats, UTILIZATION_HEADER, RETRY_AFTER_MS_HEADER, _content_choice
 
 TEST_URL = "https://testresource.openai.azure.com/openai/deployments/depl/chat/completion?api-version=2023-05-15"
 
@@ -78,3 +79,20 @@ class TestRequesterRetryAfter(unittest.TestCase):
         self.assertEqual(stats.response_status_code, 429)
         self.assertIsNotNone(stats.last_exception)
         self.assertAlmostEqual(time.time()-stats.request_start_time, 5.0, delta=0.1)
+
+class TestTokenParsing(unittest.TestCase):
+    def test_content_choice(self):
+        self.assertEqual(_content_choice(b'data: {"choices":[{"index":0,"delta":{"role":"assistant","content":""}}]}'), -1)
+        self.assertEqual(_content_choice(b'data: {"choices":[{"index":0,"delta":{"content":"Hi"}}]}'), 0)
+        self.assertEqual(_content_choice(b'data: {"choices":[{"index":2,"delta":{"content":"\\"quoted"}}]}'), 2)
+        self.assertEqual(_content_choice(b'data: {"choices":[{"index":0,"delta":{},"finish_reason":"stop"}]}'), -1)
+        self.assertEqual(_content_choice(b'data: {"choices":[{"index":0,"content_filter_results":{}}]}'), -1)
+        self.assertEqual(_content_choice(b'data: [DONE]'), -1)
+        self.assertEqual(_content_choice(b''), -1)
+
+    def test_token_gaps(self):
+        stats = RequestStats()
+        for t, choice in [(1.0, 0), (1.1, 1), (1.3, 0), (1.6, 1), (2.0, 0)]:
+            stats.token_times.append(t)
+            stats.token_choices.append(choice)
+        self.assertTrue(np.allclose(np.sort(stats.token_gaps()), [0.3, 0.5, 0.7]))
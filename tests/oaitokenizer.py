@@ -0,0 +1,41 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import unittest
+import tiktoken
+from benchmark.oaitokenizer import _token_counts, num_tokens_from_messages, num_tokens_from_text, num_tokens_from_texts
+
+class TestTokenizer(unittest.TestCase):
+
+    def test_text(self):
+        self.assertEqual(num_tokens_from_text("this is my context", "gpt-4"), 4)
+
+    def test_texts(self):
+        texts = ["this is my context", "", "hello world", "this is my context"]
+        encoding = tiktoken.encoding_for_model("gpt-4")
+        self.assertEqual(num_tokens_from_texts(texts, "gpt-4"), [len(encoding.encode(t)) for t in texts])
+        self.assertEqual(_token_counts.get((encoding.name, "hello world")), 2)
+
+    def test_messages(self):
+        messages = [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "name": "example_user", "content": "New synergies will help drive top-line growth."},
+        ]
+        encoding = tiktoken.encoding_for_model("gpt-4-0613")
+        expected = 3
+        for message in messages:
+            expected += 3
+            for key, value in message.items():
+                expected += len(encoding.encode(value))
+                if key == "name":
+                    expected += 1
+        self.assertEqual(num_tokens_from_messages(messages, "gpt-4-0613"), expected)
+        # unpinned models are counted as their pinned version
+        self.assertEqual(num_tokens_from_messages(messages, "gpt-4"), expected)
+
+    def test_unknown_model(self):
+        with self.assertRaises(NotImplementedError):
+            num_tokens_from_messages([], "davinci")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import time
+import unittest
+import urllib.error
+import urllib.request
+from benchmark.oairequester import RequestStats
+from benchmark.statsaggregator import _StatsAggregator
+
+def _request_stats(status_code=200, latency=1.0, workload_class=None):
+    stats = RequestStats()
+    stats.workload_class = workload_class
+    stats.request_start_time = time.time() - latency
+    stats.response_status_code = status_code
+    stats.calls = 1
+    if status_code == 200:
+        stats.response_time = stats.request_start_time + 0.1
+        stats.first_token_time = stats.request_start_time + 0.2
+        stats.response_end_time = stats.request_start_time + latency
+        stats.context_tokens = 100
+        stats.generated_tokens = 10
+        stats.deployment_utilization = 55.0
+    return stats
+
+def _scrape(port, path="/metrics"):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}") as response:
+        return response.headers["Content-Type"], response.read().decode()
+
+class TestPrometheusExporter(unittest.TestCase):
+
+    def setUp(self):
+        self.aggregator = _StatsAggregator(clients=4, dump_duration=1, print_stats=False, prometheus_port=0)
+        self.port = self.aggregator.exporter.port
+        self.aggregator.start()
+
+    def tearDown(self):
+        self.aggregator.stop()
+
+    def test_metrics(self):
+        self.aggregator._aggregate(_request_stats(latency=0.4, workload_class="chat"))
+        self.aggregator._aggregate(_request_stats(latency=3.0, workload_class="rag"))
+        self.aggregator._aggregate(_request_stats(status_code=429, workload_class="rag"))
+        self.aggregator._publish()
+        content_type, text = _scrape(self.port)
+        self.assertTrue(content_type.startswith("text/plain"))
+        lines = text.splitlines()
+        self.assertIn("# TYPE aoai_benchmark_e2e_seconds histogram", lines)
+        self.assertIn("aoai_benchmark_requests_total 3", lines)
+        self.assertIn("aoai_benchmark_throttled_total 1", lines)
+        self.assertIn('aoai_benchmark_throttled_total{class="rag"} 1', lines)
+        self.assertIn("aoai_benchmark_generated_tokens_total 20", lines)
+        self.assertIn('aoai_benchmark_e2e_seconds_bucket{le="0.5"} 1', lines)
+        self.assertIn('aoai_benchmark_e2e_seconds_bucket{le="2"} 1', lines)
+        self.assertIn('aoai_benchmark_e2e_seconds_bucket{le="4"} 2', lines)
+        self.assertIn('aoai_benchmark_e2e_seconds_bucket{le="+Inf"} 2', lines)
+        self.assertIn('aoai_benchmark_e2e_seconds_count{class="chat"} 1', lines)
+        self.assertIn('aoai_benchmark_utilization_percent_bucket{le="60"} 2', lines)
+
+    def test_loopback(self):
+        # metrics name deployments, so they are not exposed to the network by default
+        self.assertEqual(self.aggregator.exporter.server.server_address[0], "127.0.0.1")
+
+    def test_not_found(self):
+        with self.assertRaises(urllib.error.HTTPError):
+            _scrape(self.port, "/")
+
+    def test_before_publish(self):
+        _, text = _scrape(self.port)
+        self.assertIn("aoai_benchmark_processing 0", text.splitlines())
+
+if __name__ == '__main__':
+    unittest.main()
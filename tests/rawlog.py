@@ -0,0 +1,96 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import json
+import os
+import tempfile
+import time
+import unittest
+import numpy as np
+from benchmark.oairequester import RequestStats
+from benchmark.rawlog import RAW_LOG_SCHEMA_FILE, RawLogWriter, read_raw_log
+from benchmark.statsaggregator import _StatsAggregator
+
+def _request_stats(i, status_code=200, workload_class=None):
+    stats = RequestStats()
+    stats.request_start_time = 1000.0 + i
+    stats.response_status_code = status_code
+    stats.calls = 1
+    stats.workload_class = workload_class
+    if status_code == 200:
+        stats.response_time = stats.request_start_time + 0.1
+        stats.first_token_time = stats.request_start_time + 0.2
+        stats.response_end_time = stats.request_start_time + 1.0
+        stats.context_tokens = 100 + i
+        stats.generated_tokens = 10
+        stats.deployment_utilization = 50.0
+        for j in range(i + 1):
+            stats.token_times.append(stats.request_start_time + 0.2 + 0.1 * j)
+    return stats
+
+class TestRawLog(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def test_round_trip(self):
+        writer = RawLogWriter(self.directory, flush_interval=0.01)
+        writer.start()
+        writer.append(_request_stats(0, workload_class="chat"))
+        writer.append(_request_stats(1, status_code=429, workload_class="rag"))
+        time.sleep(0.1)
+        writer.append(_request_stats(2))
+        writer.append(_request_stats(3, workload_class="chat"))
+        writer.stop()
+        log = read_raw_log(self.directory)
+        self.assertEqual(len(log["request_start_time"]), 4)
+        self.assertTrue(np.array_equal(log["request_start_time"], [1000.0, 1001.0, 1002.0, 1003.0]))
+        self.assertTrue(np.array_equal(log["status"], [200, 429, 200, 200]))
+        self.assertTrue(np.isnan(log["first_token_time"][1]))
+        self.assertEqual(log["generated_tokens"][1], -1)
+        self.assertEqual(log["context_tokens"][3], 103)
+        self.assertEqual(log["categories"]["workload_class"], ["chat", "rag"])
+        self.assertTrue(np.array_equal(log["workload_class"], [0, 1, -1, 0]))
+        self.assertTrue(np.array_equal(log["token_gap_count"], [0, 0, 2, 3]))
+        self.assertTrue(np.allclose(log["token_gaps"], 0.1))
+
+    def test_existing(self):
+        RawLogWriter(self.directory).stop()
+        with self.assertRaises(ValueError):
+            RawLogWriter(self.directory)
+
+    def test_partial_rows(self):
+        writer = RawLogWriter(self.directory)
+        writer.append(_request_stats(0))
+        writer.stop()
+        # a row being written while the log is read
+        with open(os.path.join(self.directory, "status.bin"), "ab") as f:
+            f.write(b"\x00")
+        self.assertEqual(len(read_raw_log(self.directory)["status"]), 1)
+
+    def test_partial_ragged(self):
+        writer = RawLogWriter(self.directory)
+        writer.append(_request_stats(1))
+        writer.append(_request_stats(2))
+        writer.stop()
+        # gaps of the last row not written yet
+        path = os.path.join(self.directory, "token_gaps.bin")
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 4)
+        log = read_raw_log(self.directory)
+        self.assertEqual(len(log["status"]), 1)
+        self.assertEqual(len(log["token_gaps"]), 1)
+
+    def test_aggregator(self):
+        aggregator = _StatsAggregator(clients=1, dump_duration=1, raw_log_dir=self.directory, print_stats=False)
+        aggregator.start()
+        for i in range(1000):
+            aggregator.aggregate_request(_request_stats(i))
+        aggregator.stop()
+        with open(os.path.join(self.directory, RAW_LOG_SCHEMA_FILE)) as f:
+            schema = json.load(f)
+        self.assertEqual(schema["columns"][0]["name"], "request_start_time")
+        self.assertEqual(len(read_raw_log(self.directory)["calls"]), 1000)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import asyncio
+import socket
+import time
+import unittest
+import aiohttp
+from benchmark.mockserver import MockServer
+from benchmark.oairequester import OAIRequester, RequestStats
+from benchmark.retry import RetryBudget, backoff_delay
+from benchmark.statsaggregator import _StatsAggregator
+
+BODY = {"messages": [{"role": "user", "content": "hello"}], "max_tokens": 5}
+PATH = "/openai/deployments/depl/chat/completions?api-version=2023-05-15"
+
+def _call(requester):
+    async def call():
+        async with aiohttp.ClientSession() as session:
+            return await requester.call(session, dict(BODY))
+    return asyncio.run(call())
+
+class TestRetryBudget(unittest.TestCase):
+
+    def test_budget(self):
+        budget = RetryBudget(0.5, reserve=2)
+        self.assertTrue(budget.try_retry())
+        self.assertTrue(budget.try_retry())
+        self.assertFalse(budget.try_retry())
+        # two requests earn one retry
+        budget.record_request()
+        budget.record_request()
+        self.assertTrue(budget.try_retry())
+        self.assertFalse(budget.try_retry())
+        self.assertEqual((budget.retries, budget.denied), (3, 2))
+        # unused retries do not accumulate past the reserve
+        for _ in range(100):
+            budget.record_request()
+        self.assertEqual(budget.balance, 2)
+
+    def test_backoff_delay(self):
+        for attempt in range(1, 10):
+            delay = backoff_delay(attempt, cap=4)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, min(4, 2 ** (attempt - 1)))
+
+class TestRequesterRetry(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MockServer(capacity_tpm=6000)
+        self.url = self.server.start_in_thread() + PATH
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _throttle(self, seconds):
+        # fill the bucket past capacity for about seconds
+        self.server.capacity.level = self.server.capacity.capacity + seconds * self.server.capacity.drain_rate
+
+    def test_retry_after(self):
+        self._throttle(0.3)
+        stats = _call(OAIRequester("", self.url, backoff=True))
+        self.assertEqual(stats.response_status_code, 200)
+        self.assertIsNone(stats.last_exception)
+        self.assertEqual(stats.calls, 2)
+        self.assertEqual([a.status for a in stats.attempts], [429, 200])
+        self.assertEqual(stats.attempts[0].start_time, stats.first_attempt_time)
+        self.assertEqual(stats.attempts[1].start_time, stats.request_start_time)
+        # the user waited for the retry-after delay on top of the last attempt,
+        # which the mock server shortens by the time the throttled request took
+        self.assertGreaterEqual(stats.request_start_time - stats.first_attempt_time, 0.25)
+        self.assertAlmostEqual(stats.total_time, stats.response_end_time - stats.first_attempt_time, delta=0.05)
+
+    def test_no_retry(self):
+        self._throttle(0.3)
+        stats = _call(OAIRequester("", self.url))
+        self.assertEqual(stats.response_status_code, 429)
+        self.assertEqual(stats.calls, 1)
+        self.assertIsNone(stats.last_exception)
+        self.assertAlmostEqual(stats.retry_after, 0.3, delta=0.05)
+
+    def test_budget_exhausted(self):
+        self._throttle(0.3)
+        budget = RetryBudget(0, reserve=1)
+        budget.balance = 0
+        stats = _call(OAIRequester("", self.url, backoff=True, retry_budget=budget))
+        self.assertEqual(stats.response_status_code, 429)
+        self.assertEqual(stats.calls, 1)
+        self.assertIsNotNone(stats.last_exception)
+        self.assertEqual(budget.denied, 1)
+
+    def test_connection_error(self):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        budget = RetryBudget(0, reserve=1)
+        stats = _call(OAIRequester("", f"http://127.0.0.1:{port}{PATH}", backoff=True, retry_budget=budget))
+        self.assertIsInstance(stats.last_exception, aiohttp.ClientError)
+        self.assertEqual([a.status for a in stats.attempts], [0, 0])
+        self.assertEqual(stats.response_status_code, 0)
+
+class TestUserLatency(unittest.TestCase):
+
+    def test_aggregator(self):
+        aggregator = _StatsAggregator(clients=1, dump_duration=1, print_stats=False)
+        for retried in [False, True]:
+            stats = RequestStats()
+            stats.request_start_time = time.time() - 1.0
+            stats.first_attempt_time = stats.request_start_time - (2.0 if retried else 0.0)
+            stats.response_status_code = 200
+            stats.calls = 3 if retried else 1
+            stats.response_time = stats.request_start_time + 0.1
+            stats.first_token_time = stats.request_start_time + 0.2
+            stats.response_end_time = stats.request_start_time + 1.0
+            stats.generated_tokens = 10
+            aggregator._aggregate(stats)
+        snapshot = aggregator._snapshot()
+        self.assertEqual(snapshot["retries"], 2)
+        self.assertEqual(snapshot["e2e"]["avg"], 1.0)
+        self.assertEqual(snapshot["e2e_user"]["avg"], 2.0)
+        self.assertEqual(snapshot["ttft_user"]["avg"], 1.2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import asyncio
+import collections
+import json
+import os
+import tempfile
+import time
+import unittest
+import aiohttp
+from benchmark.mockserver import MockServer
+from benchmark.retry import RetryBudget
+from benchmark.routing import Router, Target, _parse_targets
+from benchmark.statsaggregator import _StatsAggregator
+
+BODY = {"messages": [{"role": "user", "content": "hello " * 100}], "max_tokens": 10}
+PATH = "/openai/deployments/depl/chat/completions?api-version=2023-05-15"
+
+def _call_all(router, count):
+    async def call():
+        async with aiohttp.ClientSession() as session:
+            return [await router.call(session, dict(BODY)) for _ in range(count)]
+    return asyncio.run(call())
+
+class TestParseTargets(unittest.TestCase):
+
+    def _parse(self, config):
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump(config, f)
+        return _parse_targets(f.name, "2023-05-15", "ROUTING_TEST_KEY")
+
+    def setUp(self):
+        os.environ["ROUTING_TEST_KEY"] = "key"
+
+    def test_targets(self):
+        targets = self._parse({"targets": [
+            {"name": "ptu", "endpoint": "https://a.openai.azure.com/", "deployment": "gpt-4"},
+            {"endpoint": "https://b.openai.azure.com", "deployment": "gpt-4-paygo", "weight": 3, "api_version": "2024-02-01"},
+        ]})
+        self.assertEqual([t.name for t in targets], ["ptu", "gpt-4-paygo"])
+        self.assertEqual(targets[0].url, "https://a.openai.azure.com/openai/deployments/gpt-4/chat/completions?api-version=2023-05-15")
+        self.assertTrue(targets[1].url.endswith("api-version=2024-02-01"))
+        self.assertEqual(targets[1].weight, 3)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            self._parse({"targets": []})
+        with self.assertRaises(ValueError):
+            self._parse({"targets": [{"endpoint": "https://a"}]})
+        with self.assertRaises(ValueError):
+            self._parse({"targets": [{"endpoint": "https://a", "deployment": "d"}, {"endpoint": "https://b", "deployment": "d"}]})
+        with self.assertRaises(ValueError):
+            self._parse({"targets": [{"endpoint": "https://a", "deployment": "d", "api_key_env": "ROUTING_TEST_MISSING_KEY"}]})
+
+class TestRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+
+    def _target(self, name, weight=1, **kwargs):
+        server = MockServer(**kwargs)
+        self.servers.append(server)
+        return Target(name, server.start_in_thread() + PATH, "key", weight)
+
+    def test_round_robin(self):
+        router = Router([self._target("a"), self._target("b")], "round-robin")
+        stats = _call_all(router, 4)
+        self.assertEqual([s.endpoint for s in stats], ["a", "b", "a", "b"])
+        self.assertTrue(all(s.response_status_code == 200 for s in stats))
+
+    def test_weighted(self):
+        router = Router([self._target("a", weight=1), self._target("b", weight=3)], "weighted", seed=0)
+        counts = collections.Counter(s.endpoint for s in _call_all(router, 200))
+        self.assertAlmostEqual(counts["b"] / 200, 0.75, delta=0.1)
+
+    def test_spillover(self):
+        # ptu admits the first request, then throttles for about 10 seconds
+        ptu = self._target("ptu", capacity_tpm=100)
+        router = Router([ptu, self._target("paygo")], "spillover")
+        stats = _call_all(router, 4)
+        self.assertEqual([s.endpoint for s in stats], ["ptu", "paygo", "paygo", "paygo"])
+        self.assertTrue(all(s.response_status_code == 200 for s in stats))
+        # the spilled request went to ptu first, the next ones skipped it
+        self.assertEqual([s.calls for s in stats], [1, 2, 1, 1])
+        self.assertGreater(ptu.cooldown_until, time.time())
+
+    def test_spillover_retry_budget(self):
+        budget = RetryBudget(0.5)
+        budget.balance = 0.0
+        targets = [self._target("ptu1", capacity_tpm=100), self._target("ptu2", capacity_tpm=100), self._target("paygo")]
+        # both ptu targets are already at capacity and throttle the request
+        for server in self.servers[:2]:
+            server.capacity.level = 2 * server.capacity.capacity
+        router = Router(targets, "spillover", backoff=True, retry_budget=budget)
+        stats = _call_all(router, 1)[0]
+        self.assertEqual(stats.endpoint, "paygo")
+        self.assertEqual([a.status for a in stats.attempts], [429, 429, 200])
+        # a single deposit for the request, however many targets it went through
+        self.assertEqual(budget.balance, 0.5)
+        self.assertEqual(budget.retries, 0)
+
+    def test_aggregator(self):
+        router = Router([self._target("a"), self._target("b")], "round-robin")
+        aggregator = _StatsAggregator(clients=1, dump_duration=1, print_stats=False)
+        for stats in _call_all(router, 3):
+            aggregator._aggregate(stats)
+        snapshot = aggregator._snapshot()
+        self.assertEqual(snapshot["endpoints"]["a"]["completed"], 2)
+        self.assertEqual(snapshot["endpoints"]["b"]["completed"], 1)
+        self.assertNotIn("classes", snapshot)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import unittest
+from benchmark.mockserver import MockServer
+from benchmark.searchcmd import _summary, search
+
+def _step(rate, passed, interrupted=False):
+    return {"rate": rate, "rpm": rate, "tpm": rate * 100, "passed": passed, "interrupted": interrupted}
+
+class TestSummary(unittest.TestCase):
+
+    def test_highest_passing(self):
+        summary = _summary([_step(100, True), _step(400, False), _step(250, True), _step(325, False)])
+        self.assertEqual(summary["max_rate"], 250)
+        self.assertEqual(summary["max_tpm"], 25000)
+        self.assertEqual([step["rate"] for step in summary["curve"]], [100, 250, 325, 400])
+
+    def test_none_passing(self):
+        summary = _summary([_step(100, False), _step(200, True, interrupted=True)])
+        self.assertEqual(summary["max_rate"], "n/a")
+        self.assertEqual(len(summary["curve"]), 1)
+
+class TestSearch(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MockServer(capacity_tpm=1200)
+        self.endpoint = self.server.start_in_thread()
+        os.environ["SEARCH_TEST_KEY"] = "key"
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_staircase(self):
+        args = argparse.Namespace(
+            api_version="2023-05-15", api_key_env="SEARCH_TEST_KEY", clients=8, loop="asyncio",
+            shape_profile="custom", context_tokens=100, max_tokens=20, workload=None, prompt_pool_size=4, completions=1,
+            frequency_penalty=None, presence_penalty=None, temperature=None, top_p=None,
+            output_format="jsonl", retry="none", retry_budget=None, engine="tasks", deployment="depl", api_base_endpoint=self.endpoint, targets=None, routing="round-robin",
+            keepalive_timeout=15, dns_cache_ttl=10, limit_per_host=0, prewarm_connections=0,
+            strategy="staircase", start_rate=60, max_rate=3000, rate_step=1140, step_duration=3, warmup=1,
+            max_throttle_ratio=0.1, max_ttft=None, arrivals="constant")
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            search(args)
+        lines = [json.loads(line) for line in output.getvalue().splitlines()]
+        summary = lines[-1]
+        # 60 rpm fits in capacity, 1200 rpm is throttled and ends the search
+        self.assertEqual([step["rate"] for step in summary["curve"]], [60, 1200])
+        self.assertEqual(summary["max_rate"], 60)
+        self.assertGreater(summary["curve"][1]["throttle_ratio"], 0.1)
+
+if __name__ == '__main__':
+    unittest.main()
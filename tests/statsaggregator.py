@@ -0,0 +1,148 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import unittest
+import time
+from benchmark.oairequester import RequestStats
+from benchmark.statsaggregator import _Samples, _StatsAggregator, _WindowedHistogram
+
+def _request_stats(status_code=200, latency=1.0, generated_tokens=10, workload_class=None):
+    stats = RequestStats()
+    stats.workload_class = workload_class
+    stats.request_start_time = time.time() - latency
+    stats.response_status_code = status_code
+    stats.calls = 1
+    if status_code == 200:
+        stats.response_time = stats.request_start_time + 0.1
+        stats.first_token_time = stats.request_start_time + 0.2
+        stats.response_end_time = stats.request_start_time + latency
+        stats.context_tokens = 100
+        stats.generated_tokens = generated_tokens
+    return stats
+
+class TestSamples(unittest.TestCase):
+
+    def test_append_grow(self):
+        samples = _Samples(capacity=4)
+        now = time.time()
+        for i in range(100):
+            samples._append(now, i)
+        self.assertEqual(samples._len(), 100)
+        self.assertEqual(list(samples._values()), list(range(100)))
+
+    def test_trim_oldest(self):
+        samples = _Samples(capacity=4)
+        now = time.time()
+        for i in range(10):
+            samples._append(now - 100 + i, i)
+        for i in range(10):
+            samples._append(now - 5 + i * 0.1, 10 + i)
+        samples._trim_oldest(10)
+        self.assertEqual(list(samples._values()), list(range(10, 20)))
+
+    def test_trim_out_of_order(self):
+        # a recent sample stops trimming, even if older samples follow it
+        samples = _Samples()
+        now = time.time()
+        samples._append(now - 100, 0)
+        samples._append(now - 1, 1)
+        samples._append(now - 50, 2)
+        samples._trim_oldest(10)
+        self.assertEqual(list(samples._values()), [1, 2])
+
+    def test_compaction(self):
+        samples = _Samples(capacity=8)
+        start = time.time() - 1000
+        for i in range(1000):
+            samples._append(start + i, i)
+            samples._trim_oldest(3.5)
+        self.assertEqual(list(samples._values()), [997, 998, 999])
+        self.assertLessEqual(len(samples.values), 8)
+
+    def test_values_readonly(self):
+        samples = _Samples()
+        samples._append(time.time(), 1)
+        with self.assertRaises(ValueError):
+            samples._values()[0] = 2
+
+class TestWindowedHistogram(unittest.TestCase):
+
+    def test_window(self):
+        window = _WindowedHistogram(10)
+        now = time.time()
+        window._append(now - 100, 100)
+        for i in range(5):
+            window._append(now - 20, 20)
+            window._append(now - i, i)
+        self.assertEqual(window._len(), 10)
+        window._trim_oldest(10)
+        self.assertEqual(window._len(), 5)
+        histogram = window._histogram()
+        self.assertEqual(histogram.max, 4)
+        self.assertAlmostEqual(histogram.mean(), 2)
+
+    def test_stale_sample(self):
+        window = _WindowedHistogram(10)
+        now = time.time()
+        window._append(now, 1)
+        # same slot as now, but one full window older
+        window._append(now - 11, 2)
+        self.assertEqual(window._len(), 1)
+
+class TestStatsAggregator(unittest.TestCase):
+
+    def test_aggregate(self):
+        aggregator = _StatsAggregator(clients=10, dump_duration=1, window_duration=60)
+        aggregator.start_time = time.time() - 60
+        for _ in range(3):
+            aggregator.record_new_request()
+        aggregator.aggregate_request(_request_stats())
+        aggregator.aggregate_request(_request_stats(status_code=429))
+        # nothing is aggregated until the aggregator thread drains the queue
+        self.assertEqual(aggregator.total_requests_count, 0)
+        aggregator._drain()
+        snapshot = aggregator._snapshot()
+        self.assertEqual(snapshot["processing"], 1)
+        self.assertEqual(snapshot["completed"], 2)
+        self.assertEqual(snapshot["failures"], 1)
+        self.assertEqual(snapshot["throttled"], 1)
+        self.assertEqual(snapshot["rpm"], 1.0)
+        self.assertAlmostEqual(snapshot["e2e"]["avg"], 1.0, delta=0.01)
+        self.assertAlmostEqual(snapshot["ttft"]["avg"], 0.2, delta=0.01)
+
+    def test_classes(self):
+        aggregator = _StatsAggregator(clients=10, dump_duration=1, window_duration=60)
+        aggregator.start_time = time.time() - 60
+        aggregator.aggregate_request(_request_stats(latency=1.0, workload_class="chat"))
+        aggregator.aggregate_request(_request_stats(latency=1.0, workload_class="chat"))
+        aggregator.aggregate_request(_request_stats(latency=5.0, workload_class="rag"))
+        aggregator.aggregate_request(_request_stats(status_code=429, workload_class="rag"))
+        aggregator._drain()
+        snapshot = aggregator._snapshot()
+        self.assertEqual(snapshot["completed"], 4)
+        self.assertEqual(sorted(snapshot["classes"]), ["chat", "rag"])
+        self.assertEqual(snapshot["classes"]["chat"]["completed"], 2)
+        self.assertEqual(snapshot["classes"]["rag"]["throttled"], 1)
+        self.assertAlmostEqual(snapshot["classes"]["chat"]["e2e"]["avg"], 1.0, delta=0.01)
+        self.assertAlmostEqual(snapshot["classes"]["rag"]["e2e"]["avg"], 5.0, delta=0.01)
+
+    def test_stats_cpu(self):
+        aggregator = _StatsAggregator(clients=10, dump_duration=0.05, print_stats=False)
+        for _ in range(2000):
+            aggregator.aggregate_request(_request_stats())
+        aggregator.start()
+        time.sleep(0.2)
+        aggregator.stop()
+        # time spent by the aggregator thread draining the queue
+        self.assertGreater(aggregator.stats_cpu_time, 0)
+        self.assertEqual(aggregator._snapshot()["stats_cpu"], round(aggregator.stats_cpu_time, 4))
+
+    def test_stop_without_start(self):
+        aggregator = _StatsAggregator(clients=1, json_output=True)
+        aggregator.start_time = time.time() - 1
+        aggregator.aggregate_request(_request_stats())
+        aggregator.stop()
+        self.assertEqual(aggregator.total_requests_count, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import json
+import os
+import tempfile
+import time
+import unittest
+from benchmark.asynchttpexecuter import AsyncHTTPExecuter, intended_start_time
+from benchmark.oaitokenizer import num_tokens_from_messages
+from benchmark.tracereplay import TraceReplay, _read_trace
+
+def _write_trace(records):
+    f = tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False)
+    for record in records:
+        f.write(json.dumps(record) + "\n")
+    f.close()
+    return f.name
+
+class TestReadTrace(unittest.TestCase):
+
+    def test_shards(self):
+        path = _write_trace([{"timestamp": i, "context_tokens": 10} for i in range(10)])
+        try:
+            shards = [[r["timestamp"] for r in _read_trace(path, shard, 3)] for shard in range(3)]
+        finally:
+            os.unlink(path)
+        self.assertEqual(shards, [[0, 3, 6, 9], [1, 4, 7], [2, 5, 8]])
+
+    def test_invalid(self):
+        path = _write_trace([{"timestamp": 0, "context_tokens": 10}, {"timestamp": 1}])
+        try:
+            with self.assertRaisesRegex(ValueError, ":2: one of context_tokens or messages"):
+                list(_read_trace(path))
+        finally:
+            os.unlink(path)
+
+class TestTraceReplay(unittest.TestCase):
+
+    def test_replay(self):
+        records = [
+            {"timestamp": 50.0, "context_tokens": 100, "max_tokens": 10},
+            {"timestamp": 50.2, "context_tokens": 3000},
+            {"timestamp": 50.4, "messages": [{"role": "user", "content": "hello"}], "max_tokens": 5},
+            {"timestamp": 50.8, "context_tokens": 60, "max_tokens": 10},
+        ]
+        path = _write_trace(records)
+        replay = TraceReplay(path, "gpt-4-0613", speed=2.0)
+        sent = []
+
+        async def work_fn(session):
+            body, tokens = replay.__next__()
+            sent.append((time.time(), intended_start_time.get(), json.loads(body), tokens))
+
+        try:
+            AsyncHTTPExecuter(work_fn, rate_limiter=replay, max_concurrency=4).run()
+        finally:
+            os.unlink(path)
+        self.assertEqual(len(sent), 4)
+        start = sent[0][1]
+        for (sent_time, intended, body, tokens), record in zip(sent, records):
+            self.assertAlmostEqual(intended - start, (record["timestamp"] - 50.0) / 2, delta=0.001)
+            self.assertAlmostEqual(sent_time, intended, delta=0.1)
+            self.assertEqual(body.get("max_tokens"), record.get("max_tokens"))
+            if "context_tokens" in record:
+                self.assertAlmostEqual(tokens, record["context_tokens"], delta=5)
+                self.assertAlmostEqual(num_tokens_from_messages(body["messages"], "gpt-4-0613"), record["context_tokens"], delta=5)
+            else:
+                self.assertEqual(body["messages"], record["messages"])
+
+if __name__ == '__main__':
+    unittest.main()
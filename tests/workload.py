@@ -0,0 +1,82 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import collections
+import json
+import os
+import tempfile
+import unittest
+import numpy as np
+from benchmark.workload import TokenLength, WorkloadBuilder, _parse_workload
+
+class TestParseWorkload(unittest.TestCase):
+
+    def test_inline(self):
+        classes = _parse_workload("chat:3:200:100,context:1")
+        self.assertEqual([c.name for c in classes], ["chat", "context"])
+        self.assertEqual([c.weight for c in classes], [3, 1])
+        self.assertEqual(classes[1].context_tokens.fixed, 2000)
+        self.assertEqual(classes[1].max_tokens.fixed, 200)
+
+    def test_invalid(self):
+        for spec in ["chat:1", "chat:x:200:100", "a:1:100:10,a:1:100:10", "chat:0:200:100"]:
+            with self.assertRaises(ValueError):
+                _parse_workload(spec)
+
+    def test_file(self):
+        workload = {"classes": [
+            {"name": "chat", "weight": 3, "context_tokens": 200, "max_tokens": 100},
+            {"name": "rag", "context_tokens": {"distribution": "lognormal", "median": 2000, "sigma": 0.5, "max": 6000}, "max_tokens": {"distribution": "uniform", "min": 50, "max": 150}},
+        ]}
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump(workload, f)
+        try:
+            classes = _parse_workload(f.name)
+        finally:
+            os.unlink(f.name)
+        self.assertEqual(classes[1].weight, 1)
+        self.assertEqual(classes[1].context_tokens.distribution, "lognormal")
+
+class TestTokenLength(unittest.TestCase):
+
+    def test_lognormal(self):
+        length = TokenLength({"distribution": "lognormal", "median": 1000, "sigma": 1.0, "min": 100, "max": 8000})
+        samples = [length.sample(np.random.default_rng(i)) for i in range(2000)]
+        self.assertAlmostEqual(np.median(samples), 1000, delta=100)
+        self.assertEqual(min(samples) >= 100 and max(samples) <= 8000, True)
+        self.assertGreater(length.mean(), 1000)
+
+    def test_invalid(self):
+        for spec in [True, 0, 1.5, "100", {"distribution": "uniform", "min": 1, "max": 2.5},
+                     {"distribution": "uniform", "min": False, "max": 10}, {"distribution": "normal", "max": 10}]:
+            with self.assertRaises(ValueError):
+                TokenLength(spec)
+
+class TestWorkloadBuilder(unittest.TestCase):
+
+    def test_mix(self):
+        classes = _parse_workload("chat:3:100:20,long:1:1000:50")
+        builder = WorkloadBuilder(classes, "gpt-4-0613", pool_size=2, seed=1)
+        self.assertIsNone(builder.text)
+        tokens = collections.defaultdict(list)
+        for _ in range(2000):
+            body, messages_tokens = builder.__next__()
+            tokens[builder.workload_class].append(messages_tokens)
+            self.assertIn(b'"stream": true', body)
+        self.assertAlmostEqual(len(tokens["chat"]) / 2000, 0.75, delta=0.03)
+        # pool prompts overshoot the target by a few tokens
+        self.assertTrue(all(100 <= t <= 105 for t in tokens["chat"]))
+        self.assertTrue(all(1000 <= t <= 1005 for t in tokens["long"]))
+        self.assertAlmostEqual(builder.expected_tokens(), 0.75 * 120 + 0.25 * 1050, delta=5)
+
+    def test_distribution(self):
+        classes = _parse_workload("chat:1:100:20")
+        classes[0].context_tokens = TokenLength({"distribution": "uniform", "min": 200, "max": 3000})
+        builder = WorkloadBuilder(classes, "gpt-4-0613", seed=2)
+        for _ in range(20):
+            body, messages_tokens = builder.__next__()
+            self.assertTrue(200 <= messages_tokens <= 3000)
+            self.assertEqual(json.loads(body)["max_tokens"], 20)
+
+if __name__ == '__main__':
+    unittest.main()